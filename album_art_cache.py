@@ -0,0 +1,131 @@
+import os
+import io
+import hashlib
+import logging
+import threading
+from config import get_folders, get_album_art_settings
+import metrics
+from file_operations import scan_files
+
+_session = None
+_settings = None
+_cache_folder = None
+_lock = threading.Lock()
+# url key -> Event set when the download in progress finishes
+_inflight = {}
+
+def _init():
+    global _session, _settings, _cache_folder
+    with _lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            _settings = get_album_art_settings()
+            _cache_folder = os.path.join(get_folders()['cache_folder'], 'album_art')
+            os.makedirs(_cache_folder, exist_ok=True)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+
+def _cache_path(url):
+    # Downscaled and full-size variants of the same URL are cached separately
+    key = hashlib.sha256(f"{url}|{_settings['max_size']}".encode('utf-8')).hexdigest()
+    return os.path.join(_cache_folder, key[:2], f"{key}.img")
+
+def _read_cached(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    # Touching the file keeps it at the recent end of the LRU order
+    os.utime(path)
+    return data
+
+def downscale(data, max_size):
+    try:
+        from PIL import Image
+    except ImportError:
+        logging.warning("Pillow is not installed; embedding album art at full size")
+        return data
+    image = Image.open(io.BytesIO(data))
+    if max(image.size) <= max_size:
+        return data
+    image.thumbnail((max_size, max_size))
+    output = io.BytesIO()
+    image.convert('RGB').save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+def _download(url, path):
+    with metrics.span('album_art_download') as span:
+        response = _session.get(url, timeout=(_settings['connect_timeout'], _settings['read_timeout']))
+        span.status = response.status_code
+    response.raise_for_status()
+    data = response.content
+    if _settings['max_size']:
+        data = downscale(data, _settings['max_size'])
+
+    # Write under a temp name and rename so readers never see a partial image
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    evict()
+    return data
+
+def get_album_art(url):
+    """
+    Returns the image bytes for url, downloading it at most once however many tracks
+    (or threads) ask for it. Returns None if the download fails.
+    """
+    _init()
+    path = _cache_path(url)
+    data = _read_cached(path)
+    if data is not None:
+        return data
+
+    with _lock:
+        event = _inflight.get(path)
+        owner = event is None
+        if owner:
+            event = _inflight[path] = threading.Event()
+
+    if not owner:
+        # Another thread is already fetching this URL; share its result
+        event.wait()
+        return _read_cached(path)
+
+    try:
+        return _download(url, path)
+    except Exception as e:
+        logging.error(f"Error downloading album art {url}: {e}")
+        return None
+    finally:
+        with _lock:
+            del _inflight[path]
+        event.set()
+
+def evict():
+    # Drop least recently used images until the cache fits in its size budget
+    limit = _settings['cache_max_mb'] * 1024 * 1024
+    entries = []
+    total = 0
+    for entry in scan_files(_cache_folder, suffixes=('.img',)):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+    if total <= limit:
+        return
+    for _, size, file_path in sorted(entries):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        if total <= limit:
+            break
@@ -1,103 +1,267 @@
 import subprocess
-import json
 import logging
 import os
-import shutil
-from config import get_folders, setup_logging
+import uuid
+from collections import namedtuple
+import probe_cache
+from audio_file_error_check import verify_mp3_output, Verdict, REASON_EMPTY, REASON_VERIFIED
+from config import get_output_profiles, get_work_queue_settings
+import run_journal
+import metrics
+import resources
+import storage
 
-setup_logging()
+# List of supported input formats
+SUPPORTED_FORMATS = ['.wav', '.m4a', '.m4p', '.aac', '.flac', '.ogg', '.wma']
 
-def create_directories():
-    folders = get_folders()
-    for folder in folders.values():
-        os.makedirs(folder, exist_ok=True)
-
-create_directories()  # Ensure folders are created at the start
+# Suffix of conversion outputs that are still being written
+PARTIAL_SUFFIX = '.part'
 
 def get_bitrate(input_file_path):
-    try:
-        # Run ffprobe command to get audio stream details
-        ffprobe_command = [
-            'ffprobe', '-v', 'quiet', '-print_format', 'json', 
-            '-show_streams', input_file_path
-        ]
-        result = subprocess.run(
-            ffprobe_command, capture_output=True, text=True, timeout=30, stderr=subprocess.PIPE
-        )
-
-        if result.returncode != 0:
-            logging.warning(f"FFprobe error for {input_file_path}: {result.stderr}")
-            return 320  # Fallback default bitrate
-
-        data = json.loads(result.stdout)
-        for stream in data['streams']:
-            if stream['codec_type'] == 'audio':
-                bitrate = min(int(stream.get('bit_rate', '320000')) // 1000, 320)
-                logging.info(f"Determined bitrate for {input_file_path}: {bitrate} kbps")
-                return bitrate
+    bitrate = probe_cache.get_bitrate(input_file_path)
+    logging.info(f"Determined bitrate for {input_file_path}: {bitrate} kbps")
+    return bitrate
+
+def move_to_folder(file_path, folder):
+    # Move file_path into folder under a name no other worker can claim concurrently
+    return storage.place(file_path, folder)
+
+# Codecs whose source has no generation loss to preserve; these are encoded at the maximum bitrate
+LOSSLESS_CODECS = {'flac', 'alac', 'wavpack', 'ape', 'tta', 'wmalossless', 'mlp', 'truehd'}
+
+# Bitrates libmp3lame can write (kbps)
+MP3_BITRATES = [32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+
+# Profile codec -> (ffmpeg encoder, muxer, file extension)
+OUTPUT_CODECS = {
+    'mp3':    ('libmp3lame', 'mp3', '.mp3'),
+    'aac':    ('aac', 'ipod', '.m4a'),
+    'opus':   ('libopus', 'ogg', '.opus'),
+    'vorbis': ('libvorbis', 'ogg', '.ogg'),
+    'flac':   ('flac', 'flac', '.flac'),
+}
 
+# bitrate is the most an output may use without exceeding the source's quality
+TranscodePlan = namedtuple('TranscodePlan', ['action', 'bitrate', 'reason'])
+
+def source_bitrate(info):
+    # Bitrate of the audio stream in kbps, falling back to the container's; None if unknown
+    stream = probe_cache.get_audio_stream(info) or {}
+    for value in (stream.get('bit_rate'), (info or {}).get('format', {}).get('bit_rate')):
+        try:
+            if value:
+                return int(value) // 1000
+        except ValueError:
+            pass
+    return None
+
+def standard_mp3_bitrate(kbps):
+    # Highest bitrate libmp3lame supports that does not exceed kbps
+    return max([rate for rate in MP3_BITRATES if rate <= kbps], default=MP3_BITRATES[0])
+
+def plan_transcode(input_file_path, max_bitrate=320):
+    """
+    Chooses the cheapest correct way to get an MP3 out of input_file_path:
+      copy   - the audio already is MP3 (in another container); stream-copied, no re-encode
+      encode - libmp3lame at the highest standard bitrate that does not exceed the source's,
+               or max_bitrate for lossless or unknown sources
+    """
+    try:
+        info = probe_cache.probe(input_file_path)
     except Exception as e:
-        logging.warning(f"Failed to get bitrate for {input_file_path}: {e}")
-    return 320  # Default to 320 kbps if unable to determine
+        # ffmpeg may still decode what ffprobe could not read; plan for the unknown
+        logging.warning(f"Could not probe {input_file_path}: {e}")
+        info = None
+    stream = probe_cache.get_audio_stream(info) or {}
+    codec = stream.get('codec_name')
+    bitrate = source_bitrate(info)
 
-def convert_to_mp3(input_file_path, processed_folder, error_folder, temp_folder, original_folder):
-    filename = os.path.basename(input_file_path)
-    temp_output_path = os.path.join(temp_folder, f"{os.path.splitext(filename)[0]}.mp3")
-    final_output_path = os.path.join(processed_folder, f"{os.path.splitext(filename)[0]}.mp3")
+    if codec == 'mp3':
+        return TranscodePlan('copy', min(bitrate or max_bitrate, max_bitrate), "source is already MP3")
+    if codec in LOSSLESS_CODECS or (codec or '').startswith('pcm_'):
+        return TranscodePlan('encode', max_bitrate, f"lossless {codec} source")
+    if bitrate is None:
+        return TranscodePlan('encode', max_bitrate, f"unknown bitrate for {codec or 'unprobed'} source")
+    # Encoding lossy audio above its own bitrate only spends bytes on artifacts
+    return TranscodePlan('encode', standard_mp3_bitrate(min(bitrate, max_bitrate)), f"{codec} source at {bitrate} kbps")
+
+def profile_folder(profile, processed_folder, primary):
+    # The first profile feeds recognition from processed_folder; the others get a subfolder each
+    if profile['folder']:
+        return profile['folder']
+    return processed_folder if primary else os.path.join(processed_folder, profile['name'])
 
-    # List of supported input formats
-    supported_formats = ['.wav', '.m4a', '.m4p', '.aac', '.flac', '.ogg', '.wma']
+def output_profile_folders(processed_folder):
+    return [profile_folder(profile, processed_folder, index == 0) for index, profile in enumerate(get_output_profiles())]
 
-    # Check if the input file is already an MP3
-    if input_file_path.lower().endswith('.mp3'):
+def clean_partial_files(folders):
+    """
+    Removes what interrupted runs left behind: scratch files in temp_folder, and partial
+    outputs and staged copies in every folder conversion and validation write into. Other
+    converters (a watch daemon, a pipeline run) may share these folders with or without the
+    work queue, so only files older than a lease count as left behind.
+    """
+    min_age = get_work_queue_settings()['lease_seconds']
+    run_journal.clean_temp_folder(folders['temp_folder'], min_age=min_age)
+    staging_folders = output_profile_folders(folders['processed_folder']) + [
+        folders['original_folder'], folders['error_folder'], folders['video_folder']]
+    for folder in staging_folders:
+        run_journal.clean_temp_folder(folder, suffix=PARTIAL_SUFFIX, min_age=min_age)
+
+def build_output_args(profile, plan, output_path):
+    encoder, muxer, _ = OUTPUT_CODECS[profile['codec']]
+    args = ['-map', '0:a:0']
+    # Output-side trims: the source is still decoded once for every output
+    if profile['start']:
+        args += ['-ss', str(profile['start'])]
+    if profile['duration']:
+        args += ['-t', str(profile['duration'])]
+
+    if plan.action == 'copy' and profile['codec'] == 'mp3' and not profile['bitrate'] and not profile['sample_rate']:
+        args += ['-c:a', 'copy']
+    else:
+        args += ['-c:a', encoder]
+        if profile['codec'] != 'flac':
+            # A profile can ask for less than the source supports, never more
+            bitrate = min(profile['bitrate'] or plan.bitrate, plan.bitrate)
+            if profile['codec'] == 'mp3':
+                bitrate = standard_mp3_bitrate(bitrate)
+            args += ['-b:a', f'{bitrate}k']
+        if profile['sample_rate']:
+            args += ['-ar', str(profile['sample_rate'])]
+    # Outputs have a .part name until they are complete, so the muxer is given explicitly
+    return args + ['-f', muxer, output_path]
+
+def build_ffmpeg_command(input_file_path, outputs, plan):
+    # One process, one decode of the source, fanned out to every (profile, path) in outputs.
+    # DRM-free .m4p files are plain AAC in MP4 and need no separate remux; only the first
+    # audio stream is kept (no cover art video).
+    command = ['ffmpeg', '-v', 'error', '-nostdin', '-y', '-i', input_file_path]
+    for profile, output_path in outputs:
+        command += build_output_args(profile, plan, output_path)
+    return command
+
+def verify_output(output_path, profile, source_duration):
+    if profile['codec'] != 'mp3':
+        # ffmpeg's exit status covered the encode; only an empty result is caught here
+        if os.path.getsize(output_path) == 0:
+            return Verdict(False, REASON_EMPTY, None)
+        return Verdict(True, REASON_VERIFIED, f"{os.path.getsize(output_path)} bytes")
+    expected_duration = None
+    if source_duration:
+        expected_duration = max(source_duration - (profile['start'] or 0), 0)
+        if profile['duration']:
+            expected_duration = min(expected_duration, profile['duration'])
+    return verify_mp3_output(output_path, expected_duration)
+
+def create_partial_output(folder, base_name, extension):
+    # Hidden, uniquely named partial output next to its destination, so parallel workers and
+    # scanners never pick it up and publishing it is a rename on the same filesystem. Created
+    # with the umask's permissions, unlike mkstemp's 0600, since it becomes the output.
+    os.makedirs(folder, exist_ok=True)
+    partial_output_path = os.path.join(folder, f".{base_name}.{uuid.uuid4().hex[:12]}{extension}{PARTIAL_SUFFIX}")
+    os.close(os.open(partial_output_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+    return partial_output_path
+
+@metrics.traced
+def convert_to_mp3(input_file_path, processed_folder, error_folder, original_folder, timeout=300):
+    """
+    Converts one source to every configured output profile in a single ffmpeg process and
+    returns the path of the first profile's output, which goes on to recognition. Partial
+    outputs are written next to their destinations.
+    """
+    filename = os.path.basename(input_file_path)
+    base_name = os.path.splitext(filename)[0]
+    profiles = get_output_profiles()
+    unknown = [profile['codec'] for profile in profiles if profile['codec'] not in OUTPUT_CODECS]
+    if unknown:
+        raise ValueError(f"Unknown output profile codec(s) {unknown}; expected one of {sorted(OUTPUT_CODECS)}")
+    already_mp3 = input_file_path.lower().endswith('.mp3')
+
+    # Check if the input file is already an MP3 and nothing else is wanted from it
+    if already_mp3 and len(profiles) == 1:
         logging.info(f"File {filename} is already an MP3. Moving to processed folder.")
-        shutil.move(input_file_path, final_output_path)
+        final_output_path = move_to_folder(input_file_path, processed_folder)
+        run_journal.record_stage(input_file_path, 'converted', new_path=final_output_path)
         return final_output_path
 
     # Check if the input file is a supported format
-    if not any(input_file_path.lower().endswith(fmt) for fmt in supported_formats):
+    if not already_mp3 and not any(input_file_path.lower().endswith(fmt) for fmt in SUPPORTED_FORMATS):
         logging.warning(f"Unsupported file format: {filename}. Moving to error folder.")
-        shutil.move(input_file_path, os.path.join(error_folder, filename))
+        move_to_folder(input_file_path, error_folder)
         return None
 
+    # An MP3 source is itself the primary output; only the other profiles are encoded
+    outputs = []
+    for index, profile in enumerate(profiles):
+        if index == 0 and already_mp3:
+            continue
+        folder = profile_folder(profile, processed_folder, index == 0)
+        extension = OUTPUT_CODECS[profile['codec']][2]
+        outputs.append((profile, create_partial_output(folder, base_name, extension)))
+
     try:
-        bitrate = get_bitrate(input_file_path)
+        plan = plan_transcode(input_file_path)
+        logging.info(f"Planned {plan.action} for {filename} (up to {plan.bitrate} kbps, "
+                     f"{len(outputs)} output(s)): {plan.reason}")
+        # Encoding time grows with the length of the source and the number of outputs
+        source_duration = probe_cache.get_duration(input_file_path)
+        work_seconds = source_duration * len(outputs) if source_duration else None
+        resources.run(f'ffmpeg_{plan.action}', build_ffmpeg_command(input_file_path, outputs, plan),
+                      memory_mb=resources.estimate_memory_mb(input_file_path, source_duration, len(outputs)),
+                      capture_output=True, check=True,
+                      timeout=resources.scaled_timeout(timeout, work_seconds, input_file_path))
 
-        # For .m4p files, we need to remove DRM protection first
-        if input_file_path.lower().endswith('.m4p'):
-            temp_m4a = os.path.join(temp_folder, f"{os.path.splitext(filename)[0]}.m4a")
-            subprocess.run(['ffmpeg', '-i', input_file_path, '-acodec', 'copy', temp_m4a], check=True, timeout=300)
-            conversion_input = temp_m4a
-        else:
-            conversion_input = input_file_path
+        # Verify every output in the same job (check=True already covered the exit status)
+        for profile, partial_output_path in outputs:
+            verdict = verify_output(partial_output_path, profile, source_duration)
+            if not verdict.ok:
+                raise RuntimeError(f"Output verification failed for profile {profile['name']} [{verdict.reason}]: {verdict.detail}")
+            logging.info(f"Verified {profile['name']} output for {filename}: {verdict.detail}")
+
+        # Publish each output under a free name; the partial lives in the same folder, so this is a link
+        published = []
+        for profile, partial_output_path in outputs:
+            folder = os.path.dirname(partial_output_path)
+            output_path = storage.publish(partial_output_path, folder, f"{base_name}{OUTPUT_CODECS[profile['codec']][2]}")
+            published.append(output_path)
+            logging.info(f"Converted {filename} to {profile['name']} output at {output_path}")
 
-        # Convert to MP3
-        ffmpeg_command = [
-            'ffmpeg', '-i', conversion_input, '-acodec', 'libmp3lame', '-b:a', f'{bitrate}k',
-            '-map', '0:a', temp_output_path
-        ]
-        subprocess.run(ffmpeg_command, check=True, timeout=300)
+        if already_mp3:
+            final_output_path = move_to_folder(input_file_path, processed_folder)
+            extra_outputs = published
+        else:
+            final_output_path, extra_outputs = published[0], published[1:]
+            # Recorded before the original is moved so a crash in between is resumable
+            run_journal.record_stage(input_file_path, 'converted')
 
-        # Move the converted file to the processed folder
-        shutil.move(temp_output_path, final_output_path)
-        logging.info(f"Converted {filename} to MP3 and saved at {final_output_path}")
+            # Move the original file to the original_files folder
+            original_in_original_files = move_to_folder(input_file_path, original_folder)
+            logging.info(f"Moved original file to {original_in_original_files}")
 
-        # Move the original file to the original_files folder
-        original_in_original_files = os.path.join(original_folder, filename)
-        shutil.move(input_file_path, original_in_original_files)
-        logging.info(f"Moved original file to {original_in_original_files}")
+        run_journal.record_stage(input_file_path, 'converted', new_path=final_output_path)
+        # Secondary outputs were verified above, so later validation passes skip them too
+        for output_path in extra_outputs:
+            run_journal.record_stage(output_path, 'converted')
 
         return final_output_path
+    except resources.ResourceExhausted as e:
+        # Nothing is wrong with the file; leave it in place to be retried (or requeued) later
+        logging.warning(f"Conversion of {filename} deferred: {e}. Leaving it in place to retry.")
+    except subprocess.TimeoutExpired as e:
+        logging.error(f"Conversion timed out for {filename} after {e.timeout}s. Moving to error folder.")
+        move_to_folder(input_file_path, error_folder)
     except subprocess.CalledProcessError as e:
-        logging.error(f"Subprocess failed for {filename}: {e}. Moving to error folder.")
-        shutil.move(input_file_path, os.path.join(error_folder, filename))
+        stderr = (e.stderr or b'').decode('utf-8', 'replace').strip()
+        logging.error(f"Subprocess failed for {filename}: {e}{f' ({stderr})' if stderr else ''}. Moving to error folder.")
+        move_to_folder(input_file_path, error_folder)
     except Exception as e:
         logging.error(f"Conversion failed for {filename}: {e}. Moving to error folder.")
-        shutil.move(input_file_path, os.path.join(error_folder, filename))
+        move_to_folder(input_file_path, error_folder)
     finally:
-        # Clean up temp files if they exist
-        for temp_file in [temp_output_path, temp_m4a if 'temp_m4a' in locals() else None]:
-            if temp_file and os.path.exists(temp_file):
-                os.remove(temp_file)
+        # Clean up partial outputs that were not published
+        for _, partial_output_path in outputs:
+            if os.path.exists(partial_output_path):
+                os.remove(partial_output_path)
 
-    return None
\ No newline at end of file
+    return None
@@ -1,106 +1,316 @@
 import os
+import mmap
 import subprocess
 import logging
-import shutil
-import json
-
-# 1. Define project root relative to the script's location
-project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) # This will correctly go up two levels, into song-recover folder
-log_folder = os.path.join(project_root, 'logs')
-log_file_path = os.path.join(log_folder, 'audio_file_processing_log.txt')
-
-# Ensure log folder exists
-os.makedirs(log_folder, exist_ok=True)
-
-logging.basicConfig(filename=log_file_path, level=logging.INFO, format='%(asctime)s - %(message)s')
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from config import get_validation_settings
+import run_journal
+from file_operations import scan_files
+import metrics
+import probe_cache
+import resources
+import storage
 
 def move_file(file_path, destination_folder):
+    # Files from different inbox subfolders can share a name; place never overwrites one
     try:
-        os.makedirs(destination_folder, exist_ok=True)
-        destination_path = os.path.join(destination_folder, os.path.basename(file_path))
-        shutil.move(file_path, destination_path)
+        destination_path = storage.place(file_path, destination_folder)
         logging.info(f"✅ Moved file {file_path} to {destination_path}")
         print(f"✅ Moved file {file_path} to {destination_path}")
+        return destination_path
     except Exception as e:
         logging.error(f"❌ Failed to move file {file_path} to {destination_folder}: {str(e)}")
         print(f"❌ Failed to move file {file_path} to {destination_folder}: {str(e)}")
+        return None
 
-def check_audio_file(file_path):
-    # First, try to get file info with increased analyzeduration and probesize
-    probe_command = [
-        'ffprobe',
-        '-v', 'quiet',
-        '-print_format', 'json',
-        '-show_format',
-        '-show_streams',
-        '-analyzeduration', '100M',
-        '-probesize', '100M',
-        file_path
-    ]
+# Verdict reason codes
+REASON_HEADER_OK = 'header_ok'
+REASON_DECODED_OK = 'decoded_ok'
+REASON_UNREADABLE = 'unreadable'
+REASON_EMPTY = 'empty_file'
+REASON_BAD_HEADER = 'bad_header'
+REASON_NO_FRAME_SYNC = 'no_frame_sync'
+REASON_TRUNCATED = 'truncated'
+REASON_NO_AUDIO_STREAM = 'no_audio_stream'
+REASON_DECODE_ERROR = 'decode_error'
+REASON_DECODE_TIMEOUT = 'decode_timeout'
+REASON_VERIFIED = 'verified'
+REASON_FRAME_ERRORS = 'frame_errors'
+REASON_DURATION_MISMATCH = 'duration_mismatch'
+
+# Reasons the header check reports for files that may still decode; these get a full decode
+SUSPICIOUS_REASONS = {REASON_BAD_HEADER, REASON_NO_FRAME_SYNC, REASON_TRUNCATED}
+
+Verdict = namedtuple('Verdict', ['ok', 'reason', 'detail'])
+
+HEADER_READ_SIZE = 64 * 1024
 
+MP3_BITRATES = {
+    'mpeg1': [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    'mpeg2': [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+ASF_HEADER_GUID = bytes.fromhex('3026b2758e66cf11a6d900aa0062ce6c')
+
+def mp3_frame_length(header):
+    # Length in bytes of the MPEG Layer III frame starting with these 4 bytes, or None if not a valid header
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    bitrate = MP3_BITRATES['mpeg1' if version == 3 else 'mpeg2'][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    return (144 if version == 3 else 72) * bitrate // sample_rate + padding
+
+def mp3_samples_per_frame(header):
+    # Layer III: 1152 samples per frame for MPEG1, 576 for MPEG2/2.5
+    return 1152 if (header[1] >> 3) & 0x03 == 3 else 576
+
+def mp3_sample_rate(header):
+    return MP3_SAMPLE_RATES[(header[1] >> 3) & 0x03][(header[2] >> 2) & 0x03]
+
+def scan_mp3_frames(file_path):
+    """
+    Walks every MPEG frame of an MP3 without decoding it.
+    Returns (frame_count, duration_seconds, skipped_bytes); skipped bytes are garbage between frames.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0, 0.0, 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = len(data)
+            if end >= 128 and data[end - 128:end - 125] == b'TAG':
+                end -= 128
+            position = 0
+            if data[:3] == b'ID3' and end >= 10:
+                position = 10 + ((data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9])
+
+            frames = 0
+            samples = 0.0
+            skipped = 0
+            while position + 4 <= end:
+                header = data[position:position + 4]
+                length = mp3_frame_length(header)
+                if length and position + length <= end:
+                    frames += 1
+                    samples += mp3_samples_per_frame(header) / mp3_sample_rate(header)
+                    position += length
+                else:
+                    # Resync on the next candidate sync byte
+                    next_sync = data.find(b'\xff', position + 1, end)
+                    next_sync = end if next_sync == -1 else next_sync
+                    skipped += next_sync - position
+                    position = next_sync
+            return frames, samples, skipped + max(end - position, 0)
+
+def verify_mp3_output(file_path, expected_duration=None, tolerance=0.01):
+    """
+    Verifies an encoded MP3 in one pass over its frames: the stream must be free of garbage
+    between frames and, when the source duration is known, match it within max(0.5s, tolerance).
+    """
     try:
-        probe_output = subprocess.check_output(probe_command, stderr=subprocess.STDOUT)
-        file_info = json.loads(probe_output)
-        
-        # Check if we have valid audio stream information
-        if 'streams' in file_info:
-            for stream in file_info['streams']:
-                if stream['codec_type'] == 'audio':
-                    if 'channels' in stream and stream['channels'] > 0:
-                        logging.info(f"✅ File appears valid: {file_path}")
-                        return True
-        
-        logging.warning(f"⚠️ File seems corrupt (no valid audio stream): {file_path}")
-        return False
+        frames, duration, skipped = scan_mp3_frames(file_path)
+    except (OSError, ValueError) as e:
+        return Verdict(False, REASON_UNREADABLE, str(e))
+    if frames == 0:
+        return Verdict(False, REASON_NO_FRAME_SYNC, None)
+    if skipped:
+        return Verdict(False, REASON_FRAME_ERRORS, f"{skipped} bytes outside valid frames")
+    if expected_duration:
+        allowed = max(0.5, expected_duration * tolerance)
+        if abs(duration - expected_duration) > allowed:
+            return Verdict(False, REASON_DURATION_MISMATCH, f"source {expected_duration:.2f}s, output {duration:.2f}s")
+    return Verdict(True, REASON_VERIFIED, f"{frames} frames, {duration:.2f}s")
 
-    except subprocess.CalledProcessError:
-        logging.error(f"❌ FFprobe failed to analyze the file: {file_path}")
-        return False
+def check_mp3_frames(data, start, frames=3):
+    # Find the first frame sync and require `frames` consecutive well-formed frames after it
+    position = data.find(b'\xff', start)
+    while 0 <= position < len(data) - 4:
+        offset = position
+        for _ in range(frames):
+            length = mp3_frame_length(data[offset:offset + 4])
+            if not length:
+                break
+            offset += length
+        else:
+            return True
+        position = data.find(b'\xff', position + 1)
+    return False
 
-    # If FFprobe doesn't give conclusive results, try playing a small portion of the file
-    play_command = [
-        'ffplay',
-        '-v', 'error',
-        '-t', '1',  # Try to play only the first second
-        '-autoexit',
-        '-nodisp',
-        file_path
-    ]
+def quick_check(file_path):
+    """
+    Cheap in-process check of the container header (and MP3 frame sync). Never spawns a process.
+    """
+    try:
+        size = os.path.getsize(file_path)
+        with open(file_path, 'rb') as f:
+            data = f.read(HEADER_READ_SIZE)
+    except OSError as e:
+        return Verdict(False, REASON_UNREADABLE, str(e))
+    if size == 0:
+        return Verdict(False, REASON_EMPTY, None)
 
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.mp3':
+        start = 0
+        if data[:3] == b'ID3' and len(data) >= 10:
+            # Skip the ID3v2 tag; its size is a 28-bit syncsafe integer
+            tag_size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+            start = 10 + tag_size
+            if start >= len(data):
+                with open(file_path, 'rb') as f:
+                    f.seek(start)
+                    data = f.read(HEADER_READ_SIZE)
+                start = 0
+        if not check_mp3_frames(data, start):
+            return Verdict(False, REASON_NO_FRAME_SYNC, None)
+    elif ext == '.wav':
+        if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+            return Verdict(False, REASON_BAD_HEADER, None)
+        riff_size = int.from_bytes(data[4:8], 'little')
+        if riff_size + 8 > size:
+            return Verdict(False, REASON_TRUNCATED, f"header declares {riff_size + 8} bytes, file has {size}")
+    elif ext == '.flac':
+        if data[:4] != b'fLaC':
+            return Verdict(False, REASON_BAD_HEADER, None)
+    elif ext == '.ogg':
+        if data[:4] != b'OggS':
+            return Verdict(False, REASON_BAD_HEADER, None)
+    elif ext in ('.m4a', '.m4p'):
+        if data[4:8] != b'ftyp':
+            return Verdict(False, REASON_BAD_HEADER, None)
+    elif ext == '.aac':
+        # Raw ADTS stream or an MP4 container with an .aac name
+        if not (data[:2] and data[0] == 0xFF and (data[1] & 0xF6) == 0xF0) and data[4:8] != b'ftyp':
+            return Verdict(False, REASON_BAD_HEADER, None)
+    elif ext == '.wma':
+        if data[:16] != ASF_HEADER_GUID:
+            return Verdict(False, REASON_BAD_HEADER, None)
+    return Verdict(True, REASON_HEADER_OK, None)
+
+def decode_check(file_path, timeout=600):
+    """
+    Decodes the whole audio stream with ffmpeg into the null muxer; any decoder error fails the file.
+    timeout is the allowance for a short file and grows with the duration.
+    """
+    duration = probe_cache.get_duration(file_path)
+    timeout = resources.scaled_timeout(timeout, duration, file_path)
+    decode_command = [
+        'ffmpeg', '-v', 'error', '-nostdin',
+        '-i', file_path,
+        '-map', '0:a:0',
+        '-f', 'null', '-'
+    ]
     try:
-        subprocess.run(play_command, check=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        logging.info(f"✅ File played successfully: {file_path}")
-        return True
-    except subprocess.CalledProcessError as e:
-        logging.error(f"❌ File failed to play: {file_path}")
-        logging.error(f"❌ Error: {e.stderr.decode('utf-8')}")
-        return False
+        result = resources.run('ffmpeg_decode', decode_command, capture_output=True, text=True, timeout=timeout,
+                               memory_mb=resources.estimate_memory_mb(file_path, duration))
+    except subprocess.TimeoutExpired:
+        return Verdict(False, REASON_DECODE_TIMEOUT, f"no result after {timeout:.0f}s")
+    except OSError as e:
+        return Verdict(False, REASON_UNREADABLE, str(e))
+
+    errors = result.stderr.strip()
+    if result.returncode != 0:
+        if 'matches no streams' in errors:
+            return Verdict(False, REASON_NO_AUDIO_STREAM, None)
+        return Verdict(False, REASON_DECODE_ERROR, errors.splitlines()[-1] if errors else None)
+    if errors:
+        return Verdict(False, REASON_DECODE_ERROR, errors.splitlines()[0])
+    return Verdict(True, REASON_DECODED_OK, None)
+
+def validate_audio_file(file_path, deep=False, decode_timeout=600):
+    """
+    Tiered check: the header check runs first; a full decode runs only for suspicious files
+    or when deep is set. Returns a Verdict with a reason code for triage.
+    """
+    verdict = quick_check(file_path)
+    if verdict.ok and not deep:
+        return verdict
+    if not verdict.ok and verdict.reason not in SUSPICIOUS_REASONS:
+        return verdict
+
+    decoded = decode_check(file_path, decode_timeout)
+    if not decoded.ok and not verdict.ok:
+        # Keep the header finding as the reason but report what the decoder said
+        return Verdict(False, verdict.reason, decoded.detail or verdict.detail)
+    return decoded
+
+def check_audio_file(file_path):
+    verdict = validate_audio_file(file_path)
+    if verdict.ok:
+        logging.info(f"✅ File appears valid: {file_path}")
+    else:
+        logging.warning(f"⚠️ File seems corrupt ({verdict.reason}): {file_path}")
+    return verdict.ok
+
+CHECKED_EXTENSIONS = ('.mp3', '.wma', '.m4a', '.m4p', '.wav', '.flac', '.ogg', '.aac')
 
 def is_video_file(filename):
     video_extensions = ['.mp4', '.avi', '.mov', '.mkv', '.flv', '.wmv']
     return any(filename.lower().endswith(ext) for ext in video_extensions)
 
-def detect_corruption(input_folder, error_folder, video_folder):
-    for filename in os.listdir(input_folder):
-        input_file_path = os.path.join(input_folder, filename)
-        logging.info(f"ℹ️ Checking file: {input_file_path}")
-        print(f"ℹ️ Checking file: {input_file_path}")
+@metrics.traced
+def check_file(input_file_path, error_folder, video_folder, use_journal=False, deep=False, decode_timeout=600):
+    """
+    Routes a single file: videos go to video_folder and corrupt audio to error_folder.
+    Returns True if the file is still in place and can continue down the pipeline.
+    """
+    filename = os.path.basename(input_file_path)
+    logging.info(f"ℹ️ Checking file: {input_file_path}")
+    print(f"ℹ️ Checking file: {input_file_path}")
+
+    if is_video_file(filename):
+        move_file(input_file_path, video_folder)
+        return False
+
+    if filename.lower().endswith(CHECKED_EXTENSIONS):
+        if use_journal and run_journal.has_reached(input_file_path, 'validated'):
+            logging.info(f"ℹ️ Already validated, skipping: {input_file_path}")
+            return True
+
+        try:
+            verdict = validate_audio_file(input_file_path, deep, decode_timeout)
+        except resources.ResourceExhausted as e:
+            # Not the file's fault: leave it where it is for a later attempt
+            logging.warning(f"⚠️ Validation deferred ({e}): {input_file_path}")
+            return False
+        if not verdict.ok:
+            detail = f" ({verdict.detail})" if verdict.detail else ""
+            logging.warning(f"⚠️ File failed validation [{verdict.reason}]{detail}: {input_file_path}")
+            print(f"⚠️ File failed validation [{verdict.reason}]: {input_file_path}")
+            if use_journal:
+                run_journal.record_failure(input_file_path, verdict.reason)
+            move_file(input_file_path, error_folder)
+            return False
+
+        logging.info(f"✅ File passed all checks [{verdict.reason}]: {input_file_path}")
+        print(f"✅ File passed all checks: {input_file_path}")
+        if use_journal:
+            run_journal.record_stage(input_file_path, 'validated')
+    return True
 
-        if is_video_file(filename):
-            move_file(input_file_path, video_folder)
-            continue
+def detect_corruption(input_folder, error_folder, video_folder, use_journal=False, deep=None, workers=None):
+    # With use_journal, files already validated in an earlier run (and unchanged since) are skipped
+    settings = get_validation_settings()
+    deep = settings['deep_scan'] if deep is None else deep
+    workers = workers or settings['workers']
 
-        if filename.endswith(('.mp3', '.wma', '.m4a', '.m4p', '.wav')):
-            if not check_audio_file(input_file_path):
-                move_file(input_file_path, error_folder)
-            else:
-                logging.info(f"✅ File passed all checks: {input_file_path}")
-                print(f"✅ File passed all checks: {input_file_path}")
+    file_paths = (entry.path for entry in scan_files(input_folder))
+    # Header checks are I/O bound and decodes run in ffmpeg, so threads are enough to fill the cores
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(
+            lambda path: check_file(path, error_folder, video_folder, use_journal, deep, settings['decode_timeout']),
+            file_paths
+        ))
 
 if __name__ == "__main__":
-    # 2. Define paths for testing relative to the project root
-    input_folder = os.path.join(project_root, 'input_files', 'audio_files')
-    error_folder = os.path.join(project_root, 'input_files', 'error_files')
-    video_folder = os.path.join(project_root, 'input_files', 'video_files')
-    
-    detect_corruption(input_folder, error_folder, video_folder)
\ No newline at end of file
+    from config import setup_logging, get_audio_log_file_path, get_folders
+    setup_logging(get_audio_log_file_path())
+    folders = get_folders()
+    detect_corruption(folders['audio_folder'], folders['error_folder'], folders['video_folder'])
@@ -1,39 +1,160 @@
+import argparse
 import os
 import logging
-from config import setup_logging, get_folders
-from audio_file_conversion import convert_to_mp3
-from audio_file_error_check import detect_corruption
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from config import setup_logging, create_directories, get_audio_log_file_path, get_folders, get_conversion_settings, get_validation_settings
+import run_journal
+from file_operations import scan_files
+import metrics
+import storage
+from audio_file_conversion import convert_to_mp3, move_to_folder, clean_partial_files
+from audio_file_error_check import detect_corruption, check_file
+from work_queue import get_work_queue
 
-def main():
-    setup_logging()
-    folders = get_folders()
+def convert_folder(folders, workers, timeout):
+    input_files = []
+    for entry in scan_files(folders['audio_folder']):
+        file_path = entry.path
+        if run_journal.has_reached(file_path, 'converted'):
+            # Converted by an earlier run that stopped before archiving the original
+            original_path = move_to_folder(file_path, folders['original_folder'])
+            logging.info(f"Archived already converted original {file_path} to {original_path}")
+            continue
+        input_files.append(file_path)
 
-    # Step 1: Check for corrupted files and move video files
-    detect_corruption(
-        folders['audio_folder'],
+    print(f"Converting {len(input_files)} files with {workers} worker(s)")
+    conversion_args = (
+        folders['processed_folder'],
         folders['error_folder'],
-        folders['video_folder']
+        folders['original_folder'],
     )
 
-    # Step 2: Convert audio files to MP3
-    for filename in os.listdir(folders['audio_folder']):
-        file_path = os.path.join(folders['audio_folder'], filename)
-        if os.path.isfile(file_path):
-            convert_to_mp3(
-                file_path,
-                folders['processed_folder'],
-                folders['error_folder'],
-                folders['temp_folder'],
-                folders['original_folder']
-            )
+    if workers <= 1:
+        results = (convert_to_mp3(path, *conversion_args, timeout=timeout) for path in input_files)
+        report_results(input_files, results)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Each worker hands back its timings with the result so they reach the parent's exporters
+        futures = [executor.submit(metrics.collect, convert_to_mp3, path, *conversion_args, timeout=timeout) for path in input_files]
+        # Futures are consumed in submission order so results are reported in the same order as the input
+        report_results(input_files, (future_result(future) for future in futures))
+
+def validate_and_convert(file_path, folders, timeout, deep=None):
+    # One claimed file end to end in a pool worker: the validation pass over the whole inbox
+    # is skipped when the inbox is shared, so each file is checked right before conversion
+    settings = get_validation_settings()
+    deep = settings['deep_scan'] if deep is None else deep
+    if not check_file(file_path, folders['error_folder'], folders['video_folder'], use_journal=True,
+                      deep=deep, decode_timeout=settings['decode_timeout']):
+        return None
+    return convert_to_mp3(file_path, folders['processed_folder'], folders['error_folder'],
+                          folders['original_folder'], timeout=timeout)
+
+def convert_claimed(queue, folders, workers, timeout, deep=None):
+    """
+    Claims inbox files one at a time as conversion slots free up, so processes sharing the
+    inbox split the work between them instead of one claiming everything up front.
+    """
+    print(f"Claiming and converting files with {workers} worker(s) as {queue.worker_id}")
+    converted = total = 0
+    in_flight = deque()
+
+    def report_next():
+        file_path, future = in_flight.popleft()
+        output_path = future_result(future)
+        queue.finish(file_path)
+        return report_result(file_path, output_path)
+
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for file_path in queue.iter_claims():
+            if run_journal.has_reached(file_path, 'converted'):
+                original_path = move_to_folder(file_path, folders['original_folder'])
+                logging.info(f"Archived already converted original {file_path} to {original_path}")
+                queue.finish(file_path)
+                continue
+            total += 1
+            in_flight.append((file_path, executor.submit(metrics.collect, validate_and_convert, file_path, folders, timeout, deep)))
+            if len(in_flight) >= max(workers, 1) * 2:
+                converted += report_next()
+        while in_flight:
+            converted += report_next()
+    logging.info(f"Converted {converted} of {total} claimed files")
+
+def future_result(future):
+    try:
+        result, worker_metrics = future.result()
+        metrics.merge(worker_metrics)
+        return result
+    except Exception as e:
+        logging.error(f"Conversion worker failed: {e}")
+        return None
+
+def report_result(file_path, output_path):
+    if output_path:
+        print(f"✅ {os.path.basename(file_path)} -> {output_path}")
+        return True
+    print(f"❌ {os.path.basename(file_path)} failed to convert")
+    return False
+
+def report_results(input_files, results):
+    converted = 0
+    for file_path, output_path in zip(input_files, results):
+        converted += report_result(file_path, output_path)
+    logging.info(f"Converted {converted} of {len(input_files)} files")
+
+def main():
+    settings = get_conversion_settings()
+    parser = argparse.ArgumentParser(description="Validate and convert audio files to MP3")
+    parser.add_argument('--workers', type=int, default=settings['workers'],
+                        help="Number of parallel conversion processes (default: number of cores)")
+    parser.add_argument('--timeout', type=int, default=settings['timeout'],
+                        help="Seconds a single conversion may run before it is killed")
+    parser.add_argument('--deep-scan', action='store_true', default=None,
+                        help="Fully decode every file instead of only the ones the header check flags")
+    args = parser.parse_args()
+
+    setup_logging(get_audio_log_file_path())
+    metrics.setup_metrics()
+    create_directories()
+    folders = get_folders()
+    storage.log_filesystem_boundaries(folders)
+
+    # Other processes or hosts may be draining the same inbox
+    queue = get_work_queue(folders['audio_folder'])
+
+    # Scratch files left behind by an interrupted run are never picked up again
+    clean_partial_files(folders)
+
+    if queue:
+        # Steps 1 and 2 per claimed file
+        try:
+            convert_claimed(queue, folders, args.workers, args.timeout, args.deep_scan)
+        finally:
+            queue.close()
+    else:
+        # Step 1: Check for corrupted files and move video files
+        detect_corruption(
+            folders['audio_folder'],
+            folders['error_folder'],
+            folders['video_folder'],
+            use_journal=True,
+            deep=args.deep_scan
+        )
+
+        # Step 2: Convert audio files to MP3
+        convert_folder(folders, args.workers, args.timeout)
 
     logging.info("Audio file processing completed.")
 
-    # Recheck for corrupted files after conversion
+    # Recheck for corrupted files after conversion. Outputs verified during conversion (or
+    # validated by an earlier run) are journaled, so only new or changed files are checked.
     detect_corruption(
         folders['processed_folder'],
         folders['error_folder'],
-        folders['video_folder']
+        folders['video_folder'],
+        use_journal=True
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,340 @@
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import random
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Encoder settings used to synthesize each supported input format
+FORMAT_ENCODERS = {
+    '.wav':  ['-c:a', 'pcm_s16le'],
+    '.m4a':  ['-c:a', 'aac', '-f', 'mp4'],
+    '.m4p':  ['-c:a', 'aac', '-f', 'mp4'],
+    '.aac':  ['-c:a', 'aac', '-f', 'adts'],
+    '.flac': ['-c:a', 'flac'],
+    '.ogg':  ['-c:a', 'libvorbis', '-f', 'ogg'],
+    '.wma':  ['-c:a', 'wmav2', '-f', 'asf'],
+    '.mp3':  ['-c:a', 'libmp3lame'],
+}
+
+STAGES = ['detect_corruption', 'convert_to_mp3', 'convert_audio_to_shazam_format', 'process_audio_file']
+
+def synth_source(index, duration):
+    # Two gliding tones plus noise: enough spectral detail for fingerprinting and stable encoder load.
+    # random(0) keeps its state in variable 0, seeded per track on the first sample so that
+    # distinct tracks do not share noise and match each other in the fingerprint index
+    base = 200 + (index * 37) % 600
+    expression = (
+        f"if(eq(n,0),st(0,{index}),0)"
+        f"+0.4*sin(2*PI*({base}+150*sin({0.5 + index % 7}*t))*t)"
+        f"+0.3*sin(2*PI*({base * 3}+400*sin(0.3*t))*t)+0.05*random(0)"
+    )
+    return ['-f', 'lavfi', '-i', f"aevalsrc='{expression}':s=44100:d={duration}"]
+
+def generate_corpus(folder, formats, durations, bitrates, corrupted):
+    """
+    Writes one file per format x duration x bitrate with ffmpeg lavfi sources, plus
+    `corrupted` damaged files (truncated, zeroed headers, random bytes).
+    """
+    os.makedirs(folder, exist_ok=True)
+    files = []
+    index = 0
+    for ext in formats:
+        for duration in durations:
+            # Bitrate only applies to lossy encoders
+            for bitrate in (bitrates if ext not in ('.wav', '.flac') else [None]):
+                index += 1
+                name = f"synth_{index:04d}_{duration}s{'_' + str(bitrate) + 'k' if bitrate else ''}{ext}"
+                path = os.path.join(folder, name)
+                command = ['ffmpeg', '-v', 'error', '-nostdin', '-y'] + synth_source(index, duration) + ['-ac', '2']
+                command += FORMAT_ENCODERS[ext] + (['-b:a', f'{bitrate}k'] if bitrate else []) + [path]
+                subprocess.run(command, check=True)
+                files.append(path)
+
+    rng = random.Random(1234)
+    valid = list(files)
+    for number in range(corrupted):
+        source = valid[number % len(valid)]
+        path = os.path.join(folder, f"corrupt_{number:03d}_{os.path.basename(source)}")
+        with open(source, 'rb') as f:
+            data = f.read()
+        kind = number % 3
+        if kind == 0:
+            data = data[:max(len(data) // 3, 1)]
+        elif kind == 1:
+            data = b'\0' * 4096 + data[4096:]
+        else:
+            data = bytes(rng.getrandbits(8) for _ in range(16384))
+        with open(path, 'wb') as f:
+            f.write(data)
+        files.append(path)
+    return files
+
+class ShazamStub:
+    """
+    Local stand-in for /songs/v2/detect and /songs/v2/get-details with configurable
+    latency and a fraction of requests answered with 429.
+    """
+    def __init__(self, latency_ms, error_rate):
+        stub = self
+        self.latency = latency_ms / 1000.0
+        self.error_rate = error_rate
+        self.rng = random.Random(42)
+        self.lock = threading.Lock()
+        self.requests = {'detect': 0, 'details': 0, 'throttled': 0}
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if stub.respond_throttled(self):
+                    return
+                if urlparse(self.path).path != '/songs/v2/detect':
+                    self.send_error(404)
+                    return
+                stub.count('detect')
+                song_id = str(int(hashlib.sha1(body).hexdigest()[:8], 16) % 100000)
+                stub.send_json(self, {
+                    'track': {
+                        'title': f"Track {song_id}",
+                        'subtitle': "Benchmark Artist",
+                        'images': {'coverart': ''},
+                        'genres': {'primary': 'Test'},
+                        'hub': {'actions': [{'id': song_id}]},
+                        'sections': [{'type': 'SONG', 'metadata': [
+                            {'title': 'Album', 'text': 'Benchmark Album'},
+                            {'title': 'Released', 'text': '2024'},
+                        ]}],
+                    }
+                })
+
+            def do_GET(self):
+                if stub.respond_throttled(self):
+                    return
+                url = urlparse(self.path)
+                if url.path != '/songs/v2/get-details':
+                    self.send_error(404)
+                    return
+                stub.count('details')
+                song_id = parse_qs(url.query).get('id', ['0'])[0]
+                stub.send_json(self, {'data': [{'attributes': {
+                    'albumName': 'Benchmark Album',
+                    'composerName': 'Benchmark Composer',
+                    'releaseDate': '2024-01-01',
+                    'trackNumber': int(song_id) % 20 + 1,
+                    'discNumber': 1,
+                }}]})
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def count(self, key):
+        with self.lock:
+            self.requests[key] += 1
+
+    def respond_throttled(self, handler):
+        time.sleep(self.latency)
+        with self.lock:
+            throttled = self.rng.random() < self.error_rate
+        if throttled:
+            self.count('throttled')
+            handler.send_response(429)
+            handler.send_header('Retry-After', '0')
+            handler.end_headers()
+        return throttled
+
+    def send_json(self, handler, payload):
+        body = json.dumps(payload).encode('utf-8')
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)]
+
+def summarize(latencies, wall_seconds):
+    return {
+        'files': len(latencies),
+        'wall_seconds': round(wall_seconds, 3),
+        'files_per_second': round(len(latencies) / wall_seconds, 2) if wall_seconds else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+    }
+
+def timed_calls(func, items):
+    latencies = []
+    started = time.perf_counter()
+    for item in items:
+        call_started = time.perf_counter()
+        func(item)
+        latencies.append(time.perf_counter() - call_started)
+    return latencies, time.perf_counter() - started
+
+def run_stage(stage, workdir, stub_url, results):
+    # Runs in a fresh process so peak RSS belongs to this stage alone
+    os.environ['SONGMEND_CONFIG'] = os.path.join(workdir, 'config.json')
+    from config import get_folders, setup_logging
+    setup_logging()
+    folders = get_folders()
+
+    if stage == 'detect_corruption':
+        import audio_file_error_check
+        latencies = []
+        check_file = audio_file_error_check.check_file
+
+        def timed_check_file(*args, **kwargs):
+            call_started = time.perf_counter()
+            try:
+                return check_file(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - call_started)
+
+        audio_file_error_check.check_file = timed_check_file
+        started = time.perf_counter()
+        audio_file_error_check.detect_corruption(folders['audio_folder'], folders['error_folder'], folders['video_folder'])
+        wall = time.perf_counter() - started
+    elif stage == 'convert_to_mp3':
+        from audio_file_conversion import convert_to_mp3
+        inputs = sorted(os.path.join(folders['audio_folder'], name) for name in os.listdir(folders['audio_folder']))
+        latencies, wall = timed_calls(
+            lambda path: convert_to_mp3(path, folders['processed_folder'], folders['error_folder'],
+                                        folders['original_folder']),
+            inputs
+        )
+    elif stage == 'convert_audio_to_shazam_format':
+        from metadata_shazam_api import convert_audio_to_shazam_format
+        inputs = sorted(os.path.join(folders['processed_folder'], name) for name in os.listdir(folders['processed_folder']))
+        latencies, wall = timed_calls(convert_audio_to_shazam_format, inputs)
+    else:
+        import metadata_shazam_api
+        from main import process_audio_file
+        metadata_shazam_api.SHAZAM_API_URL = stub_url
+        inputs = sorted(os.path.join(folders['processed_folder'], name) for name in os.listdir(folders['processed_folder']))
+        latencies, wall = timed_calls(
+            lambda path: process_audio_file(path, 'benchmark', folders['success_folder'], folders['failed_folder']),
+            inputs
+        )
+
+    summary = summarize(latencies, wall)
+    # ru_maxrss is in KiB on Linux; children covers the ffmpeg/ffprobe subprocesses
+    summary['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    summary['peak_child_rss_mb'] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    results.put(summary)
+
+def wait_for_result(process, results, poll_seconds=1.0):
+    # A stage process that dies before reporting (crash, OOM kill, import error) fails the stage
+    # instead of leaving the benchmark waiting forever
+    while True:
+        try:
+            return results.get(timeout=poll_seconds)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+        try:
+            # It may have reported just before exiting
+            return results.get(timeout=poll_seconds)
+        except queue.Empty:
+            return {'failed': True, 'exitcode': process.exitcode}
+
+def write_config(workdir):
+    config = {
+        'api_key': 'benchmark',
+        'log_file_path': os.path.join(workdir, 'logs', 'benchmark_log.txt'),
+        'audio_folder': os.path.join(workdir, 'input_files', 'audio_files'),
+        'error_folder': os.path.join(workdir, 'input_files', 'error_files'),
+        'video_folder': os.path.join(workdir, 'input_files', 'video_files'),
+        'processed_folder': os.path.join(workdir, 'input_files', 'processed_files'),
+        'original_folder': os.path.join(workdir, 'input_files', 'original_files'),
+        'success_folder': os.path.join(workdir, 'output_files', 'success'),
+        'failed_folder': os.path.join(workdir, 'output_files', 'failed'),
+        'temp_folder': os.path.join(workdir, 'temp_files'),
+        'cache_folder': os.path.join(workdir, 'cache'),
+        'shazam_requests_per_second': 1000,
+        'shazam_burst': 100,
+        'shazam_backoff_seconds': 0.05,
+    }
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2)
+    return config
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SongMend pipeline on a synthetic corpus")
+    parser.add_argument('--durations', type=int, nargs='+', default=[10, 60, 300], help="Track durations in seconds")
+    parser.add_argument('--bitrates', type=int, nargs='+', default=[128, 320], help="Bitrates (kbps) for lossy formats")
+    parser.add_argument('--corrupted', type=int, default=6, help="Number of deliberately corrupted files")
+    parser.add_argument('--latency-ms', type=float, default=150, help="Latency of the local Shazam stand-in")
+    parser.add_argument('--error-rate', type=float, default=0.05, help="Fraction of stand-in requests answered with 429")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--workdir', help="Keep the corpus and outputs here instead of a temp folder")
+    parser.add_argument('--output', help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='songmend_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    config = write_config(workdir)
+
+    from audio_file_conversion import SUPPORTED_FORMATS
+    corpus_started = time.perf_counter()
+    corpus = generate_corpus(config['audio_folder'], SUPPORTED_FORMATS + ['.mp3'],
+                             args.durations, args.bitrates, args.corrupted)
+    corpus_seconds = time.perf_counter() - corpus_started
+
+    stub = ShazamStub(args.latency_ms, args.error_rate)
+    stub.start()
+    report = {
+        'corpus': {'files': len(corpus), 'generation_seconds': round(corpus_seconds, 2),
+                   'durations': args.durations, 'bitrates': args.bitrates, 'corrupted': args.corrupted},
+        'shazam_stub': {'latency_ms': args.latency_ms, 'error_rate': args.error_rate},
+        'stages': {},
+    }
+    context = multiprocessing.get_context('spawn')
+    try:
+        for stage in STAGES:
+            if stage not in args.stages:
+                continue
+            results = context.Queue()
+            process = context.Process(target=run_stage, args=(stage, workdir, stub.url, results))
+            process.start()
+            report['stages'][stage] = wait_for_result(process, results)
+            process.join()
+            if report['stages'][stage].get('failed'):
+                print(f"Stage {stage} failed (exit code {process.exitcode})", file=sys.stderr)
+    finally:
+        stub.stop()
+    report['shazam_stub']['requests'] = stub.requests
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,22 @@
+import os
+import sqlite3
+import threading
+
+# One connection per thread and per process; sqlite3 connections must not be
+# shared across threads or survive a fork into pool workers.
+_local = threading.local()
+
+def get_connection(db_path, schema):
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+
+    conn = _local.connections.get(db_path)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(schema)
+        _local.connections[db_path] = conn
+    return conn
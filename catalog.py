@@ -0,0 +1,216 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from cache_db import get_connection
+from config import setup_logging, get_folders
+from metadata_extractor import extract_metadata, clean_metadata, validate_metadata
+from metadata_updater import TaggingSession
+from file_operations import track_filename, layout_folder
+import library_index
+import run_journal
+import storage
+
+# Query columns are copies of the cleaned metadata written to the tags; the raw responses
+# are what a re-tag rebuilds everything else from
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    path         TEXT PRIMARY KEY,
+    song_id      TEXT,
+    title        TEXT COLLATE NOCASE,
+    artist       TEXT COLLATE NOCASE,
+    album_artist TEXT COLLATE NOCASE,
+    album        TEXT COLLATE NOCASE,
+    year         TEXT,
+    disc         TEXT,
+    track        TEXT,
+    metadata     TEXT NOT NULL,
+    detection    TEXT NOT NULL,
+    details      TEXT,
+    updated_at   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tracks_song_id ON tracks (song_id);
+CREATE INDEX IF NOT EXISTS tracks_artist ON tracks (artist);
+CREATE INDEX IF NOT EXISTS tracks_album_artist ON tracks (album_artist);
+CREATE INDEX IF NOT EXISTS tracks_album ON tracks (album);
+CREATE INDEX IF NOT EXISTS tracks_year ON tracks (year);
+"""
+
+QUERY_FIELDS = ['artist', 'album_artist', 'album', 'year', 'song_id']
+COLUMNS = ['path', 'song_id', 'title', 'artist', 'album_artist', 'album', 'year', 'disc', 'track']
+
+_db_path = None
+
+def get_db():
+    global _db_path
+    if _db_path is None:
+        _db_path = os.path.join(get_folders()['cache_folder'], 'catalog.sqlite')
+    conn = get_connection(_db_path, SCHEMA)
+    # The catalog is the only copy of what Shazam returned, so commits must survive a power loss
+    conn.execute('PRAGMA synchronous=FULL')
+    return conn
+
+def _write(conn, path, song_id, metadata, raw_metadata, detection, details):
+    conn.execute(
+        'INSERT OR REPLACE INTO tracks (path, song_id, title, artist, album_artist, album, year, disc, track, '
+        'metadata, detection, details, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (path, str(song_id) if song_id else None, metadata.get('title'), metadata.get('artist'),
+         metadata.get('album_artist'), metadata.get('album'), metadata.get('year'), metadata.get('disc'),
+         metadata.get('track'), json.dumps(raw_metadata), json.dumps(detection),
+         json.dumps(details) if details is not None else None, time.time())
+    )
+
+def record_track(file_path, song_id, raw_metadata, metadata, detection, details):
+    """
+    Stores what recognition produced for file_path: the raw Shazam responses, the
+    extract_metadata result and the cleaned metadata that goes into the tags.
+    """
+    conn = get_db()
+    _write(conn, os.path.abspath(file_path), song_id, metadata, raw_metadata, detection, details)
+    conn.commit()
+
+def move_track(file_path, new_path):
+    # The file was renamed or moved; its catalog entry follows it
+    conn = get_db()
+    conn.execute('UPDATE OR REPLACE tracks SET path = ? WHERE path = ?', (os.path.abspath(new_path), os.path.abspath(file_path)))
+    conn.commit()
+
+def remove_track(file_path):
+    conn = get_db()
+    conn.execute('DELETE FROM tracks WHERE path = ?', (os.path.abspath(file_path),))
+    conn.commit()
+
+def find_tracks(artist=None, album_artist=None, album=None, year=None, song_id=None, limit=None):
+    """
+    Catalog entries matching every given field (text fields case-insensitively), as dicts,
+    ordered by artist, album and track. Each field is indexed.
+    """
+    filters = {'artist': artist, 'album_artist': album_artist, 'album': album, 'year': year,
+               'song_id': str(song_id) if song_id else None}
+    clauses = [f'{field} = ?' for field, value in filters.items() if value]
+    params = [value for value in filters.values() if value]
+    sql = f"SELECT {', '.join(COLUMNS)} FROM tracks"
+    if clauses:
+        sql += f" WHERE {' AND '.join(clauses)}"
+    sql += ' ORDER BY artist, album, CAST(disc AS INTEGER), CAST(track AS INTEGER)'
+    if limit:
+        sql += f' LIMIT {int(limit)}'
+    return [dict(zip(COLUMNS, row)) for row in get_db().execute(sql, params)]
+
+def _is_variant_name(file_path, folder, filename):
+    # "NN - Title (2).mp3" is where a name clash put the file earlier; it need not move again
+    if os.path.dirname(file_path) != folder:
+        return False
+    base, ext = os.path.splitext(filename)
+    return re.fullmatch(re.escape(base) + r'( \(\d+\))?' + re.escape(ext), os.path.basename(file_path)) is not None
+
+def target_path(file_path, metadata, library_folder=None):
+    # Where the current naming rule (and, inside library_folder, the output layout) puts
+    # file_path; file_path itself if it is already there
+    filename = track_filename(metadata)
+    folder = os.path.dirname(file_path)
+    if library_folder and file_path.startswith(library_folder + os.sep):
+        folder = layout_folder(library_folder, filename, metadata)
+    if _is_variant_name(file_path, folder, filename):
+        return file_path
+    return os.path.join(folder, filename)
+
+def retag_track(path, rename=True, dry_run=False, library_folder=None):
+    """
+    Rebuilds the tags (and with rename, the file name and location) of one catalogued file
+    from its stored Shazam responses. Album art is left as embedded, so nothing touches the
+    network. Returns 'retagged', 'renamed', 'unchanged', 'missing' or 'invalid'.
+    """
+    conn = get_db()
+    row = conn.execute('SELECT song_id, detection, details FROM tracks WHERE path = ?', (path,)).fetchone()
+    if row is None or not os.path.exists(path):
+        if row is not None and not dry_run:
+            remove_track(path)
+        return 'missing'
+    song_id, detection, details = row[0], json.loads(row[1]), json.loads(row[2]) if row[2] else None
+
+    raw_metadata = extract_metadata(detection, details)
+    metadata = clean_metadata(raw_metadata)
+    if not validate_metadata(metadata):
+        logging.warning(f"Catalog metadata for {path} no longer validates; left as is")
+        return 'invalid'
+    tag_metadata = {key: value for key, value in metadata.items() if key != 'album_art_url'}
+
+    session = TaggingSession(path)
+    changes = session.diff(tag_metadata)
+    new_path = target_path(path, metadata, library_folder) if rename else path
+    if dry_run:
+        if changes or new_path != path:
+            logging.info(f"Would update {path}: {changes}{f' -> {new_path}' if new_path != path else ''}")
+        return 'renamed' if new_path != path else 'retagged' if changes else 'unchanged'
+
+    if changes:
+        session.apply(tag_metadata)
+        session.save()
+    if new_path != path:
+        # Linked in under a free name, so a clash with another track never overwrites it
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        new_path = storage.publish(path, os.path.dirname(new_path), os.path.basename(new_path))
+        run_journal.move_entry(path, new_path)
+        conn.execute('DELETE FROM tracks WHERE path = ?', (path,))
+    if changes or new_path != path:
+        library_index.refresh_file(path, new_path)
+    _write(conn, new_path, song_id, metadata, raw_metadata, detection, details)
+    conn.commit()
+    if new_path != path:
+        logging.info(f"Renamed {path} -> {new_path}")
+        return 'renamed'
+    return 'retagged' if changes else 'unchanged'
+
+def retag_all(workers=None, rename=True, dry_run=False, **filters):
+    """
+    Re-tags every catalogued track (or those matching filters, as for find_tracks) in a thread
+    pool; mutagen work is file I/O, so threads keep the disk busy. Returns counts by outcome.
+    """
+    library_folder = os.path.abspath(get_folders()['success_folder'])
+    paths = [track['path'] for track in find_tracks(**filters)]
+
+    def retag_one(path):
+        try:
+            return retag_track(path, rename, dry_run, library_folder)
+        except Exception as e:
+            logging.error(f"Could not re-tag {path}: {e}")
+            return 'error'
+
+    counts = {}
+    with ThreadPoolExecutor(max_workers=workers or (os.cpu_count() or 1) * 2) as executor:
+        for outcome in executor.map(retag_one, paths):
+            counts[outcome] = counts.get(outcome, 0) + 1
+    logging.info(f"Catalog re-tag of {len(paths)} tracks: {counts}")
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the track catalog or rebuild tags and file names from it")
+    parser.add_argument('command', choices=['query', 'retag', 'status'],
+                        help="query: list matching tracks; retag: rewrite tags and names offline; status: count entries")
+    for field in QUERY_FIELDS:
+        parser.add_argument(f"--{field.replace('_', '-')}", dest=field, default=None)
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None, help="Tagging threads (default: twice the number of cores)")
+    parser.add_argument('--no-rename', action='store_true', help="Rewrite tags but keep file names and locations")
+    parser.add_argument('--dry-run', action='store_true', help="Report what retag would change without writing")
+    args = parser.parse_args()
+    filters = {field: getattr(args, field) for field in QUERY_FIELDS}
+
+    if args.command == 'query':
+        for track in find_tracks(limit=args.limit, **filters):
+            print(f"{track['artist'] or '':<30} {track['album'] or '':<30} {track['year'] or '':<4}  {track['path']}")
+    elif args.command == 'retag':
+        setup_logging()
+        counts = retag_all(args.workers, not args.no_rename, args.dry_run, **filters)
+        print(', '.join(f"{outcome}: {count}" for outcome, count in sorted(counts.items())) or "No tracks matched")
+    else:
+        print(f"Catalog entries: {get_db().execute('SELECT COUNT(*) FROM tracks').fetchone()[0]}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,34 +1,163 @@
 import os
 import json
 import logging
+import functools
+from types import MappingProxyType
 
 # Get the directory of the current file
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
-def load_config():
-    # Use BASE_DIR to construct the path to config.json
-    config_path = os.path.join(BASE_DIR, 'config', 'config.json')
+# Durations, rates and memory sizes; counts, ports and pixel sizes are int, since 2.0 breaks range() and slicing
+NUMBER = (int, float)
+
+# Expected JSON types of the keys read by the getters below; unknown keys are left alone
+CONFIG_TYPES = {
+    'api_key': str,
+    'log_file_path': str,
+    'audio_log_file_path': str,
+    'audio_folder': str,
+    'error_folder': str,
+    'video_folder': str,
+    'processed_folder': str,
+    'original_folder': str,
+    'success_folder': str,
+    'failed_folder': str,
+    'temp_folder': str,
+    'cache_folder': str,
+    'trace_file': str,
+    'metrics_file': str,
+    'metrics_http_host': str,
+    'output_layout': str,
+    'resource_ionice_class': str,
+    'work_queue_worker_id': str,
+    'album_art_cache_max_mb': NUMBER,
+    'album_art_connect_timeout': NUMBER,
+    'album_art_max_size': int,
+    'album_art_read_timeout': NUMBER,
+    'conversion_timeout': NUMBER,
+    'conversion_workers': int,
+    'daemon_poll_interval': NUMBER,
+    'daemon_settle_seconds': NUMBER,
+    'daemon_workers': int,
+    'fingerprint_compact_every': int,
+    'fingerprint_min_matches': int,
+    'metrics_http_port': int,
+    'output_shard_levels': int,
+    'output_shard_width': int,
+    'pipeline_queue_size': int,
+    'recognition_cache_max_entries': int,
+    'resource_cpu_slots': int,
+    'resource_ionice_level': int,
+    'resource_memory_base_mb': NUMBER,
+    'resource_memory_budget_mb': NUMBER,
+    'resource_memory_per_minute_mb': NUMBER,
+    'resource_memory_per_output_mb': NUMBER,
+    'resource_memory_per_source_mb': NUMBER,
+    'resource_nice': int,
+    'resource_poll_interval': NUMBER,
+    'resource_timeout_per_gb': NUMBER,
+    'resource_timeout_per_minute': NUMBER,
+    'recognition_cache_ttl_days': NUMBER,
+    'recognition_max_attempts': int,
+    'recognition_preferred_offset': NUMBER,
+    'recognition_sample_seconds': NUMBER,
+    'recognition_scan_seconds': NUMBER,
+    'recognition_silence_db': NUMBER,
+    'shazam_backoff_seconds': NUMBER,
+    'shazam_burst': int,
+    'shazam_concurrency': int,
+    'shazam_connect_timeout': NUMBER,
+    'shazam_max_retries': int,
+    'shazam_max_retry_after': NUMBER,
+    'shazam_read_timeout': NUMBER,
+    'shazam_requests_per_second': NUMBER,
+    'validation_decode_timeout': NUMBER,
+    'validation_workers': int,
+    'work_queue_lease_seconds': NUMBER,
+    'work_queue_heartbeat_seconds': NUMBER,
+    'pipeline_workers': dict,
+    'output_profiles': list,
+    'validation_deep_scan': bool,
+    'work_queue_enabled': bool,
+}
+
+# Expected types of the values of object-valued keys
+CONFIG_VALUE_TYPES = {
+    'pipeline_workers': int,
+}
+
+def _freeze(value):
+    # Read-only view all the way down, so no caller can alter the shared config
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+def validate_config(config, config_path):
+    if not isinstance(config, dict):
+        raise ValueError(f"Configuration file must contain a JSON object: {config_path}")
+    for key, value in config.items():
+        if value is None:
+            continue
+        expected = CONFIG_TYPES.get(key)
+        if expected is None:
+            continue
+        if not _is_type(value, expected):
+            raise ValueError(f"Invalid value for '{key}' in {config_path}: {value!r}")
+        item_type = CONFIG_VALUE_TYPES.get(key)
+        if item_type and not all(_is_type(item, item_type) for item in value.values()):
+            raise ValueError(f"Invalid value for '{key}' in {config_path}: {value!r}")
+
+def _is_type(value, expected):
+    # bool is an int subclass; a flag is not a valid count and vice versa
+    return isinstance(value, expected) and (expected is bool or not isinstance(value, bool))
+
+@functools.lru_cache(maxsize=None)
+def _load_config(config_path):
     try:
         with open(config_path) as config_file:
-            return json.load(config_file)
+            config = json.load(config_file)
     except FileNotFoundError:
         logging.error(f"Configuration file not found: {config_path}")
         raise
     except json.JSONDecodeError:
         logging.error(f"Invalid JSON in configuration file: {config_path}")
         raise
+    validate_config(config, config_path)
+    return _freeze(config)
+
+def load_config():
+    """
+    Returns the parsed, validated config as a read-only mapping. The file is read once per
+    path; SONGMEND_CONFIG points elsewhere (benchmarks, tests). reload_config() rereads it.
+    """
+    return _load_config(os.environ.get('SONGMEND_CONFIG', os.path.join(BASE_DIR, 'config', 'config.json')))
+
+def reload_config():
+    _load_config.cache_clear()
+    return load_config()
 
 def get_log_file_path():
     config = load_config()
     return config.get('log_file_path', os.path.join(BASE_DIR, 'logs', 'processing_log.txt'))
 
-def setup_logging():
-    log_file_path = get_log_file_path()
+def get_audio_log_file_path():
+    # Validation and conversion (audio_file_main.py) log separately from recognition
+    config = load_config()
+    return config.get('audio_log_file_path', os.path.join(BASE_DIR, 'logs', 'audio_file_processing_log.txt'))
+
+def setup_logging(log_file_path=None):
+    log_file_path = log_file_path or get_log_file_path()
     os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
     logging.basicConfig(filename=log_file_path, level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s',
                         encoding='utf-8')
 
+def create_directories():
+    for folder in get_folders().values():
+        os.makedirs(folder, exist_ok=True)
+
 def get_api_key():
     config = load_config()
     return config.get('api_key')
@@ -46,5 +175,204 @@ def get_folders():
         'success_folder':   config.get('success_folder',    os.path.join(BASE_DIR, 'output_files', 'song_detection', 'success')),
         'failed_folder':    config.get('failed_folder',     os.path.join(BASE_DIR, 'output_files', 'song_detection', 'failed')),
         
-        'temp_folder':      config.get('temp_folder',       os.path.join(BASE_DIR, 'temp_files'))
-    }
\ No newline at end of file
+        'temp_folder':      config.get('temp_folder',       os.path.join(BASE_DIR, 'temp_files')),
+        'cache_folder':     config.get('cache_folder',      os.path.join(BASE_DIR, 'cache'))
+    }
+
+def get_conversion_settings():
+    config = load_config()
+    return {
+        # Number of parallel ffmpeg conversions; defaults to one per core
+        'workers': config.get('conversion_workers', os.cpu_count() or 1),
+        # Seconds a single conversion job may run before it is killed
+        'timeout': config.get('conversion_timeout', 300),
+    }
+
+def get_shazam_settings():
+    config = load_config()
+    rate = config.get('shazam_requests_per_second', 5)
+    burst = config.get('shazam_burst', 5)
+    if rate <= 0 or burst < 1:
+        raise ValueError(f"shazam_requests_per_second must be positive and shazam_burst at least 1, got {rate} and {burst}")
+    return {
+        # Files kept in flight at once by main.py
+        'concurrency':         config.get('shazam_concurrency', 8),
+        # Token bucket matched to the RapidAPI plan: sustained rate and burst size
+        'requests_per_second': rate,
+        'burst':               burst,
+        'connect_timeout':     config.get('shazam_connect_timeout', 5),
+        'read_timeout':        config.get('shazam_read_timeout', 30),
+        'max_retries':         config.get('shazam_max_retries', 4),
+        'backoff_seconds':     config.get('shazam_backoff_seconds', 1.0),
+        # Longest Retry-After honoured; a larger value would stall a worker for that long
+        'max_retry_after':     config.get('shazam_max_retry_after', 60),
+    }
+
+def get_recognition_cache_settings():
+    config = load_config()
+    return {
+        # Cached Shazam answers older than this are refetched
+        'ttl_days':    config.get('recognition_cache_ttl_days', 90),
+        # Per-table entry limit; least recently used rows are evicted beyond it
+        'max_entries': config.get('recognition_cache_max_entries', 100000),
+    }
+
+def get_daemon_settings():
+    config = load_config()
+    return {
+        # Files processed at once by the watch daemon
+        'workers':        config.get('daemon_workers', 4),
+        # A file is ready once its size and mtime have not changed for this long
+        'settle_seconds': config.get('daemon_settle_seconds', 2),
+        # Rescan interval when inotify is unavailable
+        'poll_interval':  config.get('daemon_poll_interval', 5),
+    }
+
+def get_pipeline_settings():
+    config = load_config()
+    workers = config.get('pipeline_workers', {})
+    return {
+        # Worker threads per stage; convert is CPU bound, recognize is network bound
+        'workers': {
+            'validate':  workers.get('validate', 4),
+            'convert':   workers.get('convert', os.cpu_count() or 1),
+            'recognize': workers.get('recognize', 8),
+            'tag':       workers.get('tag', 4),
+            'move':      workers.get('move', 2),
+        },
+        # Maximum files waiting between two stages
+        'queue_size': config.get('pipeline_queue_size', 64),
+    }
+
+def get_validation_settings():
+    config = load_config()
+    return {
+        # Threads used by detect_corruption
+        'workers':        config.get('validation_workers', (os.cpu_count() or 1) * 2),
+        # Fully decode every file instead of only the ones the header check flags
+        'deep_scan':      config.get('validation_deep_scan', False),
+        'decode_timeout': config.get('validation_decode_timeout', 600),
+    }
+
+def get_album_art_settings():
+    config = load_config()
+    return {
+        # Upper bound for the on-disk artwork cache; least recently used images are evicted
+        'cache_max_mb':    config.get('album_art_cache_max_mb', 500),
+        # Longest edge in pixels for embedded art; 0 embeds the image as downloaded
+        'max_size':        config.get('album_art_max_size', 0),
+        'connect_timeout': config.get('album_art_connect_timeout', 5),
+        'read_timeout':    config.get('album_art_read_timeout', 30),
+    }
+
+def get_fingerprint_settings():
+    config = load_config()
+    return {
+        # Aligned hash matches needed before a local match is trusted over calling Shazam
+        'min_matches':     config.get('fingerprint_min_matches', 20),
+        # Pending hashes are merged into the sorted memory-mapped index beyond this count
+        'compact_every':   config.get('fingerprint_compact_every', 200000),
+    }
+
+def get_recognition_settings():
+    config = load_config()
+    return {
+        'sample_seconds':   config.get('recognition_sample_seconds', 5),
+        # Tried first when it is not silent
+        'preferred_offset': config.get('recognition_preferred_offset', 20),
+        # Only this much of the start of each file is decoded to look for sample windows
+        'scan_seconds':     config.get('recognition_scan_seconds', 120),
+        # Blocks quieter than this (dBFS) count as silence
+        'silence_db':       config.get('recognition_silence_db', -45),
+        # Most sample windows sent for recognition per file
+        'max_attempts':     config.get('recognition_max_attempts', 3),
+    }
+
+def get_output_profiles():
+    config = load_config()
+    # Every source is decoded once and encoded to all profiles by the same ffmpeg process.
+    # The first profile's output is the one recognized, tagged and moved to the library.
+    profiles = config.get('output_profiles') or [{'name': 'main'}]
+    names = [profile.get('name') for profile in profiles]
+    if not all(names):
+        raise ValueError("Every output profile needs a name")
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate output profile name(s) {duplicates}")
+    # Recognition and tagging work on ID3 tags, so the library copy has to be an MP3
+    if profiles[0].get('codec', 'mp3') != 'mp3':
+        raise ValueError(f"The first output profile ({names[0]!r}) must use codec 'mp3'")
+    return [{
+        'name':        profile['name'],
+        # mp3, aac, opus, vorbis or flac
+        'codec':       profile.get('codec', 'mp3'),
+        # kbps; None follows the source, and a profile never exceeds the source's bitrate
+        'bitrate':     profile.get('bitrate'),
+        'sample_rate': profile.get('sample_rate'),
+        # Optional clip: seconds into the source and length
+        'start':       profile.get('start', 0),
+        'duration':    profile.get('duration'),
+        # Defaults to processed_folder for the first profile and processed_folder/<name> otherwise
+        'folder':      profile.get('folder'),
+    } for profile in profiles]
+
+def get_layout_settings():
+    config = load_config()
+    layout = config.get('output_layout', 'flat')
+    if layout not in ('flat', 'hash', 'artist_album'):
+        raise ValueError(f"Invalid output_layout {layout!r}; expected flat, hash or artist_album")
+    return {
+        # Where move_file puts files inside the success/failed folders
+        'layout':       layout,
+        # hash layout: bucket levels and hex characters per level (2 x 2 gives 65536 buckets)
+        'shard_levels': config.get('output_shard_levels', 2),
+        'shard_width':  config.get('output_shard_width', 2),
+    }
+
+def get_work_queue_settings():
+    config = load_config()
+    return {
+        # Claim files before processing so several processes or hosts can share one inbox
+        'enabled':           config.get('work_queue_enabled', False),
+        # A worker silent for this long is presumed dead and its claimed files are requeued
+        'lease_seconds':     config.get('work_queue_lease_seconds', 120),
+        'heartbeat_seconds': config.get('work_queue_heartbeat_seconds', 15),
+        # Defaults to <hostname>-<pid>-<random>
+        'worker_id':         config.get('work_queue_worker_id'),
+    }
+
+def get_resource_settings():
+    config = load_config()
+    ionice_class = config.get('resource_ionice_class')
+    if ionice_class not in (None, 'realtime', 'best-effort', 'idle'):
+        raise ValueError(f"Unknown resource_ionice_class '{ionice_class}'; expected realtime, best-effort or idle")
+    return {
+        # ffmpeg/ffprobe jobs allowed to run at once across every process on this host
+        'cpu_slots':            int(config.get('resource_cpu_slots', os.cpu_count() or 1)),
+        # Jobs wait while their summed memory estimates would exceed this; 0 means half of RAM
+        'memory_budget_mb':     config.get('resource_memory_budget_mb', 0),
+        'memory_base_mb':       config.get('resource_memory_base_mb', 80),
+        'memory_per_source_mb': config.get('resource_memory_per_source_mb', 0.05),
+        'memory_per_minute_mb': config.get('resource_memory_per_minute_mb', 0.5),
+        'memory_per_output_mb': config.get('resource_memory_per_output_mb', 30),
+        # Priority of spawned jobs; nice 0 and no ionice class leave them as they are
+        'nice':                 config.get('resource_nice', 0),
+        'ionice_class':         ionice_class,
+        'ionice_level':         config.get('resource_ionice_level', 4),
+        # Timeouts are the configured base plus this much per minute of audio (or GB of input)
+        'timeout_per_minute':   config.get('resource_timeout_per_minute', 10),
+        'timeout_per_gb':       config.get('resource_timeout_per_gb', 60),
+        'poll_interval':        config.get('resource_poll_interval', 0.5),
+    }
+
+def get_metrics_settings():
+    config = load_config()
+    return {
+        # Per-file timeline of every timed operation, one JSON object per line
+        'trace_file':   config.get('trace_file'),
+        # Prometheus text file written when the run exits (node_exporter textfile collector)
+        'metrics_file': config.get('metrics_file'),
+        # Serves /metrics for scraping while the process runs; 0 disables it
+        'http_port':    config.get('metrics_http_port', 0),
+        'http_host':    config.get('metrics_http_host', '127.0.0.1'),
+    }
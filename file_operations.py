@@ -1,20 +1,15 @@
 import os
-import shutil
+import hashlib
 import subprocess
-import json
 import logging
+import probe_cache
+import metrics
+import storage
+from config import get_layout_settings
 
 def get_bitrate(input_file_path):
-    try:
-        result = subprocess.run(['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams', input_file_path], 
-                                capture_output=True, text=True, timeout=30)
-        data = json.loads(result.stdout)
-        for stream in data['streams']:
-            if stream['codec_type'] == 'audio':
-                return min(int(stream.get('bit_rate', '320000')) // 1000, 320)  # Convert to kbps and cap at 320
-    except Exception as e:
-        logging.warning(f"Failed to get bitrate for {input_file_path}: {e}")
-    return 320  # Default to 320 kbps if unable to determine
+    # Served from the shared probe cache; kbps capped at 320
+    return probe_cache.get_bitrate(input_file_path)
 
 def convert_to_mp3(input_file_path, output_file_path):
     try:
@@ -28,29 +23,93 @@ def convert_to_mp3(input_file_path, output_file_path):
         logging.error(f"Conversion failed for {input_file_path}: {e}")
         raise
 
-def move_file(file_path, target_folder):
-    os.makedirs(target_folder, exist_ok=True)
-    target_path = os.path.join(target_folder, os.path.basename(file_path))
-    if os.path.exists(target_path):
-        existing_bitrate = get_bitrate(target_path)
-        new_bitrate = get_bitrate(file_path)
-        if new_bitrate > existing_bitrate:
-            os.remove(target_path)
-            shutil.move(file_path, target_path)
-            logging.info(f"Replaced duplicate file {os.path.basename(file_path)} with higher bitrate version.")
-        else:
-            os.remove(file_path)
-            logging.info(f"Duplicate file {os.path.basename(file_path)} discarded, existing file has higher or equal bitrate.")
-    else:
-        shutil.move(file_path, target_path)
+def scan_files(folder, recursive=True, suffixes=None):
+    """
+    Lazily yields os.DirEntry objects for the regular files under folder (depth first, in
+    directory order). Hidden entries such as partial outputs are skipped. The entries carry
+    their file type from the directory listing and cache their stat, so callers need no
+    further isfile/stat calls.
+    """
+    pending = [folder]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            pending.append(entry.path)
+                    elif entry.is_file() and (suffixes is None or entry.name.lower().endswith(suffixes)):
+                        yield entry
+        except (FileNotFoundError, NotADirectoryError):
+            # Removed while the scan was running
+            continue
 
-def rename_file(file_path, metadata):
+def safe_component(text, default):
+    # One path component built from tag text: no separators, no leading dots, bounded length
+    text = str(text or '').replace('/', '_').replace('\\', '_').replace('\0', '').strip().lstrip('.')
+    return text[:120].strip() or default
+
+def layout_folder(target_folder, filename, metadata=None):
+    """
+    Subfolder of target_folder that filename belongs in under the configured output layout:
+      flat         - target_folder itself
+      hash         - prefix buckets of a hash of the file name, e.g. 3f/a2/
+      artist_album - Artist/Album/ from the metadata; files without an artist fall back to hash
+    """
+    settings = get_layout_settings()
+    layout = settings['layout']
+    if layout == 'artist_album' and metadata and metadata.get('artist'):
+        artist = safe_component(metadata.get('album_artist') or metadata['artist'], 'Unknown Artist')
+        return os.path.join(target_folder, artist, safe_component(metadata.get('album'), 'Unknown Album'))
+    if layout in ('hash', 'artist_album'):
+        width = settings['shard_width']
+        digest = hashlib.blake2b(filename.encode('utf-8'), digest_size=16).hexdigest()
+        return os.path.join(target_folder, *(digest[level * width:(level + 1) * width] for level in range(settings['shard_levels'])))
+    return target_folder
+
+def move_file(file_path, target_folder, metadata=None):
+    """
+    Moves file_path into target_folder (under the output layout) and returns its new path.
+    A file already there under the same name is never replaced, since a shared name says
+    nothing about the audio: the newcomer gets "name (1).ext". Whether two files are the
+    same track is decided by the library index, not here.
+    """
+    return storage.place(file_path, layout_folder(target_folder, os.path.basename(file_path), metadata))
+
+def track_filename(metadata):
+    # Library file name for a track; the catalog's bulk rename applies changes here to every file
     track_number = metadata.get('track', 'Unknown').zfill(2)  # Ensure track number has leading zeros
-    song_title = metadata.get('title', 'Unknown').replace('/', '_')  # Replace any invalid characters
-    new_name = f"{track_number} - {song_title}.mp3"
-    new_path = os.path.join(os.path.dirname(file_path), new_name)
-    os.rename(file_path, new_path)
+    song_title = safe_component(metadata.get('title'), 'Unknown')  # Replace any invalid characters
+    return f"{track_number} - {song_title}.mp3"
+
+def rename_file(file_path, metadata):
+    folder, filename = os.path.dirname(file_path), track_filename(metadata)
+    if os.path.basename(file_path) == filename:
+        return file_path
+    # Two inbox files may be named after the same track; neither may replace the other
+    with metrics.span('rename', file_path):
+        new_path = storage.publish(file_path, folder, filename)
     return new_path
 
 def is_audio_file(filename):
     return filename.endswith(('.wav', '.mp3', '.m4a', 'm4p', '.wma', '.flac', '.aac'))
+
+def reserve_unique_path(folder, filename):
+    # Atomically claim a free name in folder by creating an empty placeholder.
+    # O_EXCL guarantees two workers (threads or processes) never get the same path;
+    # the caller then moves its file over the placeholder.
+    os.makedirs(folder, exist_ok=True)
+    base, ext = os.path.splitext(filename)
+    candidate = filename
+    counter = 1
+    while True:
+        path = os.path.join(folder, candidate)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.close(fd)
+            return path
+        except FileExistsError:
+            candidate = f"{base} ({counter}){ext}"
+            counter += 1
@@ -0,0 +1,383 @@
+import os
+import sys
+import argparse
+import logging
+import uuid
+import threading
+import contextlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from cache_db import get_connection
+from config import get_folders, get_fingerprint_settings, get_recognition_settings
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (Windows): only the threads of one process are kept apart
+    fcntl = None
+
+# Spectrogram parameters: the 44.1 kHz sample is decimated to 11025 Hz before the FFT
+DECIMATION = 4
+FRAME_SIZE = 1024
+HOP_SIZE = 256
+# Peak picking neighbourhood (frames, bins) and number of peaks kept per second of audio
+PEAK_TIME_RADIUS = 10
+PEAK_FREQ_RADIUS = 10
+PEAKS_PER_SECOND = 30
+# Each anchor peak is paired with up to FAN_OUT later peaks at most MAX_DELTA frames ahead
+FAN_OUT = 10
+MAX_DELTA = 63
+
+# On-disk index layout: pending.bin holds unsorted (hash, track, offset) records appended since
+# the last compaction. The sorted, memory-mapped main index is a generation folder main-<id>/
+# with hashes.npy and entries.npy; CURRENT names the live one, so a compaction publishes both
+# arrays with a single rename. Records a compaction is merging sit in its folder as merged-*.bin.
+CURRENT_FILE = 'CURRENT'
+GENERATION_PREFIX = 'main-'
+RECORD_DTYPE = np.dtype([('hash', '<u4'), ('track', '<u4'), ('offset', '<u4')])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    track_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    song_id  TEXT NOT NULL,
+    path     TEXT
+);
+CREATE INDEX IF NOT EXISTS tracks_song_id ON tracks (song_id);
+"""
+
+def _sliding_max(values, radius, axis):
+    # Maximum over a window of 2*radius+1 along axis, same shape as values
+    pad = [(0, 0)] * values.ndim
+    pad[axis] = (radius, radius)
+    padded = np.pad(values, pad, mode='constant', constant_values=-np.inf)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * radius + 1, axis=axis)
+    return windows.max(axis=-1)
+
+def spectrogram(raw_data):
+    samples = np.frombuffer(raw_data, dtype='<i2').astype(np.float32) / 32768.0
+    usable = len(samples) - len(samples) % DECIMATION
+    samples = samples[:usable].reshape(-1, DECIMATION).mean(axis=1)
+    if len(samples) < FRAME_SIZE:
+        return np.empty((0, FRAME_SIZE // 2), dtype=np.float32)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME_SIZE)[::HOP_SIZE]
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(FRAME_SIZE).astype(np.float32), axis=1))
+    # Drop the Nyquist bin so bins fit in 9 bits
+    return np.log1p(spectrum[:, :FRAME_SIZE // 2] * 1000.0).astype(np.float32)
+
+def find_peaks(spec):
+    """
+    Returns (frame, bin) arrays of spectral peaks: local maxima of their neighbourhood,
+    keeping only the strongest PEAKS_PER_SECOND per second.
+    """
+    if spec.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    local_max = _sliding_max(_sliding_max(spec, PEAK_TIME_RADIUS, 0), PEAK_FREQ_RADIUS, 1)
+    is_peak = (spec == local_max) & (spec > spec.mean())
+    frames, bins = np.nonzero(is_peak)
+
+    seconds = len(spec) * HOP_SIZE * DECIMATION / 44100
+    keep = max(int(PEAKS_PER_SECOND * seconds), 1)
+    if len(frames) > keep:
+        strongest = np.argsort(spec[frames, bins])[-keep:]
+        frames, bins = frames[strongest], bins[strongest]
+    order = np.lexsort((bins, frames))
+    return frames[order], bins[order]
+
+def fingerprint_pcm(raw_data):
+    """
+    Fingerprints 44.1 kHz mono s16le PCM (the output of convert_audio_to_shazam_format).
+    Returns (hashes, offsets): uint32 hashes of peak pairs and the anchor frame of each.
+    """
+    frames, bins = find_peaks(spectrogram(raw_data))
+    hashes, offsets = [], []
+    for step in range(1, FAN_OUT + 1):
+        anchor_frames, target_frames = frames[:-step], frames[step:]
+        delta = target_frames - anchor_frames
+        valid = (delta > 0) & (delta <= MAX_DELTA)
+        if not valid.any():
+            continue
+        # 9 bits anchor bin | 9 bits target bin | 6 bits frame delta
+        packed = (bins[:-step][valid].astype(np.uint32) << 15) | (bins[step:][valid].astype(np.uint32) << 6) | delta[valid].astype(np.uint32)
+        hashes.append(packed)
+        offsets.append(anchor_frames[valid].astype(np.uint32))
+    if not hashes:
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint32)
+    return np.concatenate(hashes), np.concatenate(offsets)
+
+class FingerprintIndex:
+    """
+    Hash index of fingerprints from every tagged file. Lookups use np.searchsorted over
+    memory-mapped sorted arrays, so the index can hold millions of hashes without loading them.
+    """
+    def __init__(self, folder, settings):
+        self.folder = folder
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.hashes = None
+        self.entries = None
+        self.loaded_generation = None
+        os.makedirs(folder, exist_ok=True)
+
+    @property
+    def db(self):
+        return get_connection(os.path.join(self.folder, 'tracks.sqlite'), SCHEMA)
+
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive):
+        # Appends share the lock; a compaction holds it alone, across processes
+        with self.lock if fcntl is None else contextlib.nullcontext():
+            if fcntl is None:
+                yield
+                return
+            fd = os.open(self._path('.lock'), os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                yield
+            finally:
+                os.close(fd)
+
+    def _current_generation(self):
+        try:
+            with open(self._path(CURRENT_FILE)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _load_main(self):
+        generation = self._current_generation()
+        if self.hashes is not None and generation == self.loaded_generation:
+            return
+        # Indexes compacted before generations existed keep their arrays at the top level
+        folder = self._path(generation) if generation else self.folder
+        if not os.path.exists(os.path.join(folder, 'hashes.npy')):
+            self.hashes = np.empty(0, dtype=np.uint32)
+            self.entries = np.empty(0, dtype=np.uint64)
+        else:
+            self.hashes = np.load(os.path.join(folder, 'hashes.npy'), mmap_mode='r')
+            self.entries = np.load(os.path.join(folder, 'entries.npy'), mmap_mode='r')
+        self.loaded_generation = generation
+
+    @staticmethod
+    def _read_records(path):
+        if not os.path.exists(path):
+            return np.empty(0, dtype=RECORD_DTYPE)
+        data = np.fromfile(path, dtype=np.uint8)
+        # Ignore a torn trailing record from a writer that died mid-append
+        usable = len(data) - len(data) % RECORD_DTYPE.itemsize
+        return data[:usable].view(RECORD_DTYPE)
+
+    def _load_pending(self):
+        return self._read_records(self._path('pending.bin'))
+
+    def has_song(self, song_id):
+        return self.db.execute('SELECT 1 FROM tracks WHERE song_id = ? LIMIT 1', (str(song_id),)).fetchone() is not None
+
+    def move_path(self, path, new_path):
+        # Fingerprints of a file replaced by another copy of the song now stand for that copy
+        conn = self.db
+        conn.execute('UPDATE tracks SET path = ? WHERE path = ?', (new_path, path))
+        conn.commit()
+
+    def add(self, song_id, raw_data, path=None):
+        hashes, offsets = fingerprint_pcm(raw_data)
+        if len(hashes) == 0:
+            return 0
+        conn = self.db
+        track_id = conn.execute('INSERT INTO tracks (song_id, path) VALUES (?, ?)', (str(song_id), path)).lastrowid
+        conn.commit()
+
+        records = np.empty(len(hashes), dtype=RECORD_DTYPE)
+        records['hash'] = hashes
+        records['track'] = track_id
+        records['offset'] = offsets
+        with self._locked(exclusive=False):
+            # One O_APPEND write per file keeps concurrent writers from interleaving records
+            fd = os.open(self._path('pending.bin'), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            try:
+                os.write(fd, records.tobytes())
+            finally:
+                os.close(fd)
+        try:
+            full = os.path.getsize(self._path('pending.bin')) // RECORD_DTYPE.itemsize >= self.settings['compact_every']
+        except FileNotFoundError:
+            # Another process compacted it meanwhile
+            full = False
+        if full:
+            self.compact()
+        return len(hashes)
+
+    def compact(self):
+        """
+        Merges pending records into a new generation of the sorted main arrays and publishes
+        it by replacing CURRENT. Holds the index lock exclusively, so no process appends or
+        compacts meanwhile. A compaction that dies before publishing leaves its records in
+        its own folder, and the next one merges them.
+        """
+        with self._locked(exclusive=True):
+            current = self._current_generation()
+            generation = f"{GENERATION_PREFIX}{uuid.uuid4().hex[:12]}"
+            folder = self._path(generation)
+            os.mkdir(folder)
+
+            # Gather the records to merge into the new folder first: pending.bin and any left
+            # by a compaction that never published. Once CURRENT names this folder they count
+            # as merged, so a crash can neither lose them nor merge them twice.
+            batches = []
+            for name in sorted(os.listdir(self.folder)):
+                if name.startswith(GENERATION_PREFIX) and name not in (current, generation):
+                    for merged in sorted(os.listdir(self._path(name))):
+                        if merged.startswith('merged-'):
+                            batches.append(os.path.join(self._path(name), merged))
+            if os.path.exists(self._path('pending.bin')):
+                batches.append(self._path('pending.bin'))
+            for number, path in enumerate(batches):
+                os.rename(path, os.path.join(folder, f"merged-{number}.bin"))
+            pending = [self._read_records(os.path.join(folder, f"merged-{number}.bin")) for number in range(len(batches))]
+            pending = np.concatenate(pending) if pending else np.empty(0, dtype=RECORD_DTYPE)
+            if len(pending) == 0:
+                os.rmdir(folder)
+                return
+
+            self._load_main()
+            hashes = np.concatenate([np.asarray(self.hashes), pending['hash']])
+            entries = np.concatenate([
+                np.asarray(self.entries),
+                (pending['track'].astype(np.uint64) << np.uint64(32)) | pending['offset'].astype(np.uint64)
+            ])
+            order = np.argsort(hashes, kind='stable')
+            for name, values in (('entries.npy', entries[order]), ('hashes.npy', hashes[order])):
+                with open(os.path.join(folder, name), 'wb') as f:
+                    np.save(f, values)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            temp_path = self._path(f"{CURRENT_FILE}.{os.getpid()}.tmp")
+            with open(temp_path, 'w') as f:
+                f.write(generation)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self._path(CURRENT_FILE))
+
+            # Readers still mapping the previous generation keep it; anything older goes
+            for number in range(len(batches)):
+                os.remove(os.path.join(folder, f"merged-{number}.bin"))
+            for name in os.listdir(self.folder):
+                if name.startswith(GENERATION_PREFIX) and name not in (current, generation):
+                    self._remove_generation(name)
+            if current is None:
+                for name in ('hashes.npy', 'entries.npy'):
+                    if os.path.exists(self._path(name)):
+                        os.remove(self._path(name))
+        logging.info(f"Fingerprint index compacted to {len(hashes)} hashes")
+
+    def _remove_generation(self, name):
+        folder = self._path(name)
+        for entry in os.listdir(folder):
+            os.remove(os.path.join(folder, entry))
+        os.rmdir(folder)
+
+    def match(self, raw_data):
+        """
+        Returns (song_id, score) for the best time-aligned match, or (None, score) if no track
+        has at least fingerprint_min_matches aligned hashes.
+        """
+        query_hashes, query_offsets = fingerprint_pcm(raw_data)
+        if len(query_hashes) == 0:
+            return None, 0
+
+        with self.lock:
+            self._load_main()
+            hashes, entries = self.hashes, self.entries
+            pending = self._load_pending()
+
+        tracks, deltas = [], []
+        if len(hashes):
+            left = np.searchsorted(hashes, query_hashes, side='left')
+            right = np.searchsorted(hashes, query_hashes, side='right')
+            counts = right - left
+            if counts.sum():
+                # Expand each [left, right) range into explicit positions without a Python loop
+                positions = np.repeat(left - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+                found = np.asarray(entries[positions])
+                tracks.append((found >> np.uint64(32)).astype(np.int64))
+                deltas.append((found & np.uint64(0xFFFFFFFF)).astype(np.int64) - np.repeat(query_offsets, counts).astype(np.int64))
+        if len(pending):
+            sorter = np.argsort(query_hashes)
+            sorted_query = query_hashes[sorter]
+            position = np.searchsorted(sorted_query, pending['hash'])
+            position = np.minimum(position, len(sorted_query) - 1)
+            hit = sorted_query[position] == pending['hash']
+            if hit.any():
+                # Each pending record is compared with one matching query hash; enough for voting
+                tracks.append(pending['track'][hit].astype(np.int64))
+                deltas.append(pending['offset'][hit].astype(np.int64) - query_offsets[sorter[position[hit]]].astype(np.int64))
+
+        if not tracks:
+            return None, 0
+        tracks = np.concatenate(tracks)
+        deltas = np.concatenate(deltas)
+        # A real match lines up many hashes at the same time offset
+        pairs, votes = np.unique(np.stack([tracks, deltas]), axis=1, return_counts=True)
+        best = int(votes.argmax())
+        score = int(votes[best])
+        if score < self.settings['min_matches']:
+            return None, score
+        row = self.db.execute('SELECT song_id FROM tracks WHERE track_id = ?', (int(pairs[0, best]),)).fetchone()
+        return (row[0] if row else None), score
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = FingerprintIndex(os.path.join(get_folders()['cache_folder'], 'fingerprints'), get_fingerprint_settings())
+        return _index
+
+def build_from_library(workers=None):
+    """
+    Fingerprints every file in the library index that has a song id and is not fingerprinted yet.
+    """
+    from library_index import get_db as get_library_db
+    from metadata_shazam_api import extract_sample_windows
+
+    index = get_index()
+    settings = get_recognition_settings()
+    known = {row[0] for row in index.db.execute('SELECT path FROM tracks WHERE path IS NOT NULL')}
+    rows = get_library_db().execute('SELECT path, song_id FROM tracks WHERE song_id IS NOT NULL').fetchall()
+    pending = [(path, song_id) for path, song_id in rows if path not in known and os.path.exists(path)]
+
+    def add_one(item):
+        path, song_id = item
+        try:
+            # Same window ranking as recognition, so re-rips are queried with a matching sample
+            return index.add(song_id, extract_sample_windows(path, settings)[0], path) > 0
+        except Exception as e:
+            logging.warning(f"Could not fingerprint {path}: {e}")
+            return False
+
+    # ffmpeg decodes run out of process and NumPy releases the GIL, so threads parallelize well
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        added = sum(executor.map(add_one, pending))
+    index.compact()
+    return added
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the local acoustic fingerprint index")
+    parser.add_argument('command', choices=['build', 'compact'],
+                        help="build: fingerprint library files not indexed yet; compact: merge pending hashes")
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        print(f"Fingerprinted {build_from_library(args.workers)} files")
+    else:
+        get_index().compact()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
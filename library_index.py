@@ -0,0 +1,220 @@
+import os
+import sys
+import argparse
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from cache_db import get_connection
+from config import get_folders
+import probe_cache
+import catalog
+from file_operations import scan_files
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    path       TEXT PRIMARY KEY,
+    audio_hash TEXT NOT NULL,
+    song_id    TEXT,
+    bitrate    INTEGER,
+    size       INTEGER NOT NULL,
+    mtime_ns   INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tracks_audio_hash ON tracks (audio_hash);
+CREATE INDEX IF NOT EXISTS tracks_song_id ON tracks (song_id);
+"""
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_db_path = None
+
+def get_db():
+    global _db_path
+    if _db_path is None:
+        _db_path = os.path.join(get_folders()['cache_folder'], 'library_index.sqlite')
+    return get_connection(_db_path, SCHEMA)
+
+def audio_payload_range(file_path, size):
+    # Byte range of an MP3 without its ID3v2 header/footer and ID3v1 trailer; whole file otherwise
+    start, end = 0, size
+    if not file_path.lower().endswith('.mp3'):
+        return start, end
+    with open(file_path, 'rb') as f:
+        header = f.read(10)
+        if len(header) == 10 and header[:3] == b'ID3':
+            tag_size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+            has_footer = header[5] & 0x10
+            start = 10 + tag_size + (10 if has_footer else 0)
+        if size >= 128:
+            f.seek(size - 128)
+            if f.read(3) == b'TAG':
+                end = size - 128
+    return min(start, end), end
+
+def audio_payload_hash(file_path):
+    """
+    Hash of the audio data only, so retagging or renaming a file does not change it.
+    """
+    size = os.path.getsize(file_path)
+    start, end = audio_payload_range(file_path, size)
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(HASH_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+def index_file(file_path, song_id=None, audio_hash=None):
+    path = os.path.abspath(file_path)
+    stat = os.stat(path)
+    audio_hash = audio_hash or audio_payload_hash(path)
+    conn = get_db()
+    if song_id is None:
+        # Keep a song id learned earlier for the same path
+        row = conn.execute('SELECT song_id FROM tracks WHERE path = ?', (path,)).fetchone()
+        song_id = row[0] if row else None
+    conn.execute(
+        'INSERT OR REPLACE INTO tracks (path, audio_hash, song_id, bitrate, size, mtime_ns) VALUES (?, ?, ?, ?, ?, ?)',
+        (path, audio_hash, str(song_id) if song_id else None, probe_cache.get_bitrate(path), stat.st_size, stat.st_mtime_ns)
+    )
+    conn.commit()
+    return audio_hash
+
+def refresh_file(file_path, new_path=None):
+    # Retagging or renaming leaves the audio payload, and so its hash, as it was
+    path = os.path.abspath(file_path)
+    target = os.path.abspath(new_path) if new_path else path
+    stat = os.stat(target)
+    conn = get_db()
+    conn.execute('UPDATE OR REPLACE tracks SET path = ?, size = ?, mtime_ns = ? WHERE path = ?',
+                 (target, stat.st_size, stat.st_mtime_ns, path))
+    conn.commit()
+
+def remove_file(file_path):
+    conn = get_db()
+    conn.execute('DELETE FROM tracks WHERE path = ?', (os.path.abspath(file_path),))
+    conn.commit()
+
+def find_duplicate(audio_hash=None, song_id=None, exclude_path=None):
+    """
+    Returns {'path', 'audio_hash', 'song_id', 'bitrate'} for a library copy with the same audio
+    payload or the same song id, or None. Entries whose file has disappeared are dropped.
+    """
+    conn = get_db()
+    clauses, params = [], []
+    if audio_hash:
+        clauses.append('audio_hash = ?')
+        params.append(audio_hash)
+    if song_id:
+        clauses.append('song_id = ?')
+        params.append(str(song_id))
+    if not clauses:
+        return None
+
+    rows = conn.execute(
+        f"SELECT path, audio_hash, song_id, bitrate FROM tracks WHERE {' OR '.join(clauses)} ORDER BY bitrate DESC",
+        params
+    ).fetchall()
+    exclude_path = os.path.abspath(exclude_path) if exclude_path else None
+    for path, row_hash, row_song_id, bitrate in rows:
+        if path == exclude_path:
+            continue
+        if not os.path.exists(path):
+            remove_file(path)
+            continue
+        return {'path': path, 'audio_hash': row_hash, 'song_id': row_song_id, 'bitrate': bitrate or 0}
+    return None
+
+def remove_superseded(file_path, audio_hash, song_id=None):
+    """
+    Deletes other library copies of the same audio or song that do not beat file_path's bitrate,
+    with their index and catalog entries. Returns the deleted paths.
+    """
+    path = os.path.abspath(file_path)
+    conn = get_db()
+    row = conn.execute('SELECT bitrate FROM tracks WHERE path = ?', (path,)).fetchone()
+    if row is None:
+        return []
+    bitrate = row[0] or 0
+    params = [audio_hash]
+    song_clause = ''
+    if song_id:
+        song_clause = ' OR song_id = ?'
+        params.append(str(song_id))
+    rows = conn.execute(
+        f'SELECT path, bitrate FROM tracks WHERE (audio_hash = ?{song_clause}) AND path != ?', params + [path]
+    ).fetchall()
+    removed = []
+    for other_path, other_bitrate in rows:
+        if (other_bitrate or 0) <= bitrate:
+            try:
+                os.remove(other_path)
+                logging.info(f"Removed superseded library copy {other_path}")
+            except FileNotFoundError:
+                pass
+            remove_file(other_path)
+            catalog.remove_track(other_path)
+            removed.append(other_path)
+    return removed
+
+
+def build_index(folder, workers=None, rebuild=False):
+    """
+    Brings the index in line with the files under folder. Only new or changed files are hashed
+    (all of them with rebuild), in parallel; entries for files that are gone are removed.
+    """
+    conn = get_db()
+    if rebuild:
+        # Song ids cannot be recomputed from the files, so carry them over
+        known_song_ids = dict(conn.execute('SELECT path, song_id FROM tracks WHERE song_id IS NOT NULL').fetchall())
+        conn.execute('DELETE FROM tracks')
+        conn.commit()
+    else:
+        known_song_ids = {}
+    indexed = {row[0]: (row[1], row[2]) for row in conn.execute('SELECT path, size, mtime_ns FROM tracks')}
+
+    pending = []
+    seen = set()
+    for entry in scan_files(os.path.abspath(folder), suffixes=('.mp3',)):
+        path = entry.path
+        seen.add(path)
+        stat = entry.stat()
+        if indexed.get(path) != (stat.st_size, stat.st_mtime_ns):
+            pending.append(path)
+
+    for path in set(indexed) - seen:
+        if path.startswith(os.path.abspath(folder) + os.sep):
+            conn.execute('DELETE FROM tracks WHERE path = ?', (path,))
+    conn.commit()
+
+    def index_one(path):
+        try:
+            index_file(path, song_id=known_song_ids.get(path))
+            return True
+        except Exception as e:
+            logging.warning(f"Could not index {path}: {e}")
+            return False
+
+    # hashlib releases the GIL on large buffers, so threads hash files in parallel
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        indexed_count = sum(executor.map(index_one, pending))
+    logging.info(f"Library index: {indexed_count} files (re)indexed under {folder}")
+    return indexed_count
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the duplicate index of the success library")
+    parser.add_argument('--rebuild', action='store_true', help="Rehash every file instead of only new or changed ones")
+    parser.add_argument('--workers', type=int, default=None, help="Hashing threads (default: number of cores)")
+    args = parser.parse_args()
+
+    folder = get_folders()['success_folder']
+    count = build_index(folder, args.workers, args.rebuild)
+    print(f"Indexed {count} files under {folder}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
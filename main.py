@@ -1,107 +1,270 @@
+import argparse
+import asyncio
 import os
 import logging
-from pydub import AudioSegment
-from metadata_shazam_api import detect_song, get_song_details, extract_song_id, convert_audio_to_shazam_format
+from concurrent.futures import ThreadPoolExecutor
+from metadata_shazam_api import extract_song_id, extract_sample_windows
+from recognition_cache import detect_song_cached, get_song_details_cached, get_cached_detection_by_song_id
 from metadata_extractor import extract_metadata, clean_metadata, validate_metadata
-from metadata_updater import update_metadata, get_current_metadata, compare_metadata
-from file_operations import move_file, rename_file, is_audio_file
-from config import setup_logging, load_config, get_api_key, get_folders
+from metadata_updater import TaggingSession, get_current_metadata
+from file_operations import move_file, rename_file, is_audio_file, get_bitrate, scan_files
+import library_index
+import catalog
+import run_journal
+import metrics
+import storage
+from resources import ResourceExhausted
+from work_queue import get_work_queue
+from config import setup_logging, get_api_key, get_folders, get_shazam_settings, get_recognition_settings
 
-# Setup logging
-setup_logging()
+_fingerprint = None
 
-def process_audio_file(file_path, api_key, success_folder, failed_folder):
+def get_fingerprint_module():
+    # Imported on first use: NumPy is slow to load and only needed for local matching.
+    # Without it every file goes to Shazam.
+    global _fingerprint
+    if _fingerprint is None:
+        try:
+            import fingerprint
+            _fingerprint = fingerprint
+        except ImportError:
+            _fingerprint = False
+    return _fingerprint or None
+
+def mark_failed(file_path, failed_folder, reason):
+    destination = move_file(file_path, failed_folder)
+    run_journal.record_failure(file_path, reason, new_path=destination)
+    catalog.move_track(file_path, destination)
+    return False
+
+def discard_if_duplicate(file_path, audio_hash=None, song_id=None):
+    """
+    Looks file_path up in the library index by audio payload hash or song id and keeps the
+    better copy. Returns True if file_path was the worse copy and has been discarded.
+    """
+    existing = library_index.find_duplicate(audio_hash, song_id, exclude_path=file_path)
+    if not existing:
+        return False
+
+    if existing['audio_hash'] == audio_hash or get_bitrate(file_path) <= existing['bitrate']:
+        os.remove(file_path)
+        run_journal.record_failure(file_path, f"Duplicate of {existing['path']}")
+        catalog.remove_track(file_path)
+        logging.info(f"Discarded {file_path}: library already has {existing['path']}")
+        return True
+
+    # The incoming copy is better; move_to_success retires the library copy once this one is in place
+    logging.info(f"{file_path} will replace lower bitrate library copy {existing['path']}")
+    return False
+
+def match_locally(raw_data):
+    """
+    Looks the sample up in the local fingerprint index. Returns a cached detection result
+    for the matched song, or None on a miss.
+    """
+    fingerprint = get_fingerprint_module()
+    if fingerprint is None:
+        return None
     try:
-        # Convert audio to Shazam format
-        raw_data = convert_audio_to_shazam_format(file_path)
-
-        # Detect song using Shazam API
-        detection_result = detect_song(raw_data, api_key)
-        if not detection_result:
-            logging.warning(f"Song detection failed for {file_path}")
-            move_file(file_path, failed_folder)
-            return False
+        song_id, score = fingerprint.get_index().match(raw_data)
+    except Exception as e:
+        logging.warning(f"Local fingerprint lookup failed: {e}")
+        return None
+    if song_id is None:
+        return None
+    detection_result = get_cached_detection_by_song_id(song_id)
+    if detection_result:
+        logging.info(f"Matched song {song_id} locally ({score} aligned hashes)")
+    return detection_result
 
-        # Extract song ID
-        song_id = extract_song_id(detection_result)
-        if not song_id:
-            logging.warning(f"Failed to extract song ID for {file_path}")
-            move_file(file_path, failed_folder)
-            return False
+def add_fingerprint(file_path, song_id, replaces=()):
+    fingerprint = get_fingerprint_module()
+    if fingerprint is None or not song_id:
+        return
+    try:
+        index = fingerprint.get_index()
+        for old_path in replaces:
+            index.move_path(old_path, os.path.abspath(file_path))
+        if not index.has_song(song_id):
+            # The top-ranked window is the one recognition tries first for re-rips of this song
+            samples = extract_sample_windows(file_path, get_recognition_settings())
+            index.add(song_id, samples[0], os.path.abspath(file_path))
+    except Exception as e:
+        logging.warning(f"Could not fingerprint {file_path}: {e}")
 
-        # Get detailed song information
-        song_details = get_song_details(song_id, api_key)
-        if not song_details:
-            logging.warning(f"Failed to get song details for {file_path}")
-            move_file(file_path, failed_folder)
-            return False
+def recognize_audio_file(file_path, api_key):
+    """
+    Identifies the song in file_path and builds clean, validated metadata for it.
+    Returns (metadata, song_id, None) on success or (None, None, reason) on failure.
+    """
+    # Decode the start of the file once and rank sample windows, skipping silent intros
+    settings = get_recognition_settings()
+    samples = extract_sample_windows(file_path, settings)
 
-        # Extract metadata
-        metadata = extract_metadata(detection_result, song_details)
-        metadata = clean_metadata(metadata)
+    # Try windows in priority order and stop at the first one that yields a song ID.
+    # Songs identified before are matched against the local fingerprint index first;
+    # only a miss costs a Shazam call (which may still be served by the recognition cache)
+    detection_result = None
+    song_id = None
+    for attempt, raw_data in enumerate(samples[:settings['max_attempts']], start=1):
+        detection_result = match_locally(raw_data) or detect_song_cached(raw_data, api_key)
+        song_id = extract_song_id(detection_result) if detection_result else None
+        if song_id:
+            if attempt > 1:
+                logging.info(f"Recognized {file_path} on sample window {attempt}")
+            break
 
-        if not validate_metadata(metadata):
-            logging.warning(f"Invalid metadata for {file_path}")
-            move_file(file_path, failed_folder)
-            return False
+    if not detection_result:
+        logging.warning(f"Song detection failed for {file_path}")
+        return None, None, "Song detection failed"
+
+    # Extract song ID
+    if not song_id:
+        logging.warning(f"Failed to extract song ID for {file_path}")
+        return None, None, "Failed to extract song ID"
+
+    # Get detailed song information
+    song_details = get_song_details_cached(song_id, api_key)
+    if not song_details:
+        logging.warning(f"Failed to get song details for {file_path}")
+        return None, None, "Failed to get song details"
+
+    # Extract metadata
+    raw_metadata = extract_metadata(detection_result, song_details)
+    metadata = clean_metadata(raw_metadata)
 
-        # Get current metadata
-        current_metadata = get_current_metadata(file_path)
-
-        # Compare and update metadata
-        changes = compare_metadata(current_metadata, metadata)
-        if changes:
-            logging.info(f"Metadata changes for {file_path}: {changes}")
-            if update_metadata(file_path, metadata):
-                logging.info(f"Successfully updated metadata for {file_path}")
-
-                # Rename file based on new metadata
-                new_file_path = rename_file(file_path, metadata)
-
-                # Move the file to the success folder
-                move_file(new_file_path, success_folder)
-                return True
-            else:
-                logging.error(f"Failed to update metadata for {file_path}")
-                move_file(file_path, failed_folder)
-                return False
-        else:
+    if not validate_metadata(metadata):
+        logging.warning(f"Invalid metadata for {file_path}")
+        return None, None, "Invalid metadata"
+
+    # Kept so tags and names can be rebuilt later without asking Shazam again
+    catalog.record_track(file_path, song_id, raw_metadata, metadata, detection_result, song_details)
+    run_journal.record_stage(file_path, 'recognized')
+    return metadata, song_id, None
+
+def tag_audio_file(file_path, metadata):
+    """
+    Writes metadata to file_path if it differs from the current tags.
+    Returns True if tags were changed, False if they were already up to date, None if writing failed.
+    """
+    try:
+        # One open for reading, diffing and writing; one atomic save for all changed frames
+        session = TaggingSession(file_path)
+        changes = session.diff(metadata)
+        if not changes:
             logging.info(f"No metadata changes needed for {file_path}")
-            move_file(file_path, success_folder)
-            return True
+            return False
 
+        logging.info(f"Metadata changes for {file_path}: {changes}")
+        session.apply(metadata)
+        session.save()
     except Exception as e:
-        logging.error(f"Error processing {file_path}: {str(e)}")
-        move_file(file_path, failed_folder)
+        logging.error(f"Failed to update metadata for {file_path}: {e}")
+        return None
+
+    logging.info(f"Successfully updated metadata for {file_path}")
+    run_journal.record_stage(file_path, 'tagged')
+    return True
+
+def move_to_success(file_path, metadata, changed, success_folder, song_id=None):
+    recognized_path = file_path
+    if changed:
+        # Rename file based on new metadata
+        new_file_path = rename_file(file_path, metadata)
+        run_journal.record_stage(file_path, 'tagged', new_path=new_file_path)
+        file_path = new_file_path
+
+    # Move the file to the success folder
+    destination = move_file(file_path, success_folder, metadata)
+    run_journal.record_stage(file_path, 'moved', new_path=destination)
+    if not os.path.isfile(destination):
+        # Gone before it could be indexed (another run sharing the library superseded it);
+        # a catalog row pointing at it would describe a file that does not exist
+        catalog.remove_track(recognized_path)
+        logging.warning(f"{destination} disappeared right after being moved into the library")
         return False
+    catalog.move_track(recognized_path, destination)
+    audio_hash = library_index.index_file(destination, song_id)
+    superseded = library_index.remove_superseded(destination, audio_hash, song_id)
+    add_fingerprint(destination, song_id, superseded)
+    return True
+
+@metrics.traced
+def process_audio_file(file_path, api_key, success_folder, failed_folder):
+    try:
+        # A previous run tagged this file but died before renaming/moving it
+        if run_journal.has_reached(file_path, 'tagged'):
+            logging.info(f"Resuming {file_path} after tagging")
+            return move_to_success(file_path, get_current_metadata(file_path), True, success_folder)
 
+        # Identical audio already in the library needs no API calls at all
+        if discard_if_duplicate(file_path, audio_hash=library_index.audio_payload_hash(file_path)):
+            return True
 
-def main():
-    config = load_config()
-    api_key = get_api_key()
-    folders = get_folders()
+        metadata, song_id, reason = recognize_audio_file(file_path, api_key)
+        if metadata is None:
+            return mark_failed(file_path, failed_folder, reason)
 
-    input_folder = folders['audio_folder']
-    success_folder = folders['success_folder']
-    failed_folder = folders['failed_folder']
+        if discard_if_duplicate(file_path, song_id=song_id):
+            return True
 
-    # Ensure necessary folders exist
-    for folder in [input_folder, success_folder, failed_folder]:
-        os.makedirs(folder, exist_ok=True)
+        changed = tag_audio_file(file_path, metadata)
+        if changed is None:
+            return mark_failed(file_path, failed_folder, "Failed to update metadata")
 
-    # Get list of files first
-    audio_files = [f for f in os.listdir(input_folder) if is_audio_file(f)]
-    total_files = len(audio_files)
+        return move_to_success(file_path, metadata, changed, success_folder, song_id)
 
-    print(f"Found {total_files} audio files to process")
+    except ResourceExhausted as e:
+        # The host ran out of memory, not the file; leave it in the inbox for the next pass
+        logging.warning(f"Deferred {file_path}: {e}")
+        return False
+    except Exception as e:
+        logging.error(f"Error processing {file_path}: {str(e)}")
+        return mark_failed(file_path, failed_folder, str(e))
+
+
+async def process_files_concurrently(audio_files, api_key, success_folder, failed_folder, concurrency, progress, queue=None):
+    """
+    Keeps up to `concurrency` files in flight. Each file runs on a worker thread so network
+    round trips overlap; the shared Shazam session pools connections and enforces the rate limit.
+    With a work queue, each file is claimed when its turn comes and skipped if another
+    process claimed it first.
+    """
+    loop = asyncio.get_running_loop()
+    pending = iter(audio_files)
+
+    async def worker(executor):
+        for file_path in pending:
+            if queue:
+                file_path = queue.claim(file_path)
+                if file_path is None:
+                    progress.update(1)
+                    continue
+            try:
+                # Verify file still exists and is accessible before processing
+                if os.access(file_path, os.R_OK):
+                    await loop.run_in_executor(executor, process_audio_file, file_path, api_key, success_folder, failed_folder)
+                else:
+                    logging.warning(f"File no longer accessible: {file_path}")
+            except Exception as e:
+                logging.error(f"Error processing {file_path}: {str(e)}")
+            finally:
+                if queue:
+                    queue.finish(file_path)
+            progress.update(1)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        await asyncio.gather(*(worker(executor) for _ in range(concurrency)))
 
-    # Use tqdm to create a progress bar
-    from tqdm import tqdm
-    for filename in tqdm(audio_files, desc="Processing audio files", unit="file"):
-        if is_audio_file(filename):
-            file_path = os.path.join(input_folder, filename)
 def main():
-    config = load_config()
+    settings = get_shazam_settings()
+    parser = argparse.ArgumentParser(description="Recognize audio files with Shazam and tag them")
+    parser.add_argument('--concurrency', type=int, default=settings['concurrency'],
+                        help="Number of files processed at once")
+    args = parser.parse_args()
+
+    setup_logging()
+    metrics.setup_metrics()
     api_key = get_api_key()
     folders = get_folders()
 
@@ -112,32 +275,29 @@ def main():
     # Ensure necessary folders exist
     for folder in [input_folder, success_folder, failed_folder]:
         os.makedirs(folder, exist_ok=True)
+    storage.log_filesystem_boundaries({'audio_folder': input_folder, 'success_folder': success_folder,
+                                       'failed_folder': failed_folder})
 
-    # Get list of files and create full paths first
-    audio_files = []
-    for filename in os.listdir(input_folder):
-        if is_audio_file(filename):
-            file_path = os.path.join(input_folder, filename)
-            # Only add files that actually exist and are accessible
-            if os.path.isfile(file_path) and os.access(file_path, os.R_OK):
-                audio_files.append(file_path)
+    # Regular files come straight from the directory listing, nested folders included;
+    # accessibility is checked once, when each file's turn comes
+    audio_files = [entry.path for entry in scan_files(input_folder) if is_audio_file(entry.name)]
 
     total_files = len(audio_files)
     print(f"Found {total_files} audio files to process")
 
+    # Other processes sharing the inbox may take some of these files
+    queue = get_work_queue(input_folder)
+
     # Process files with progress bar
     from tqdm import tqdm
-    for file_path in tqdm(audio_files, desc="Processing audio files", unit="file"):
-        try:
-            # Verify file still exists and is accessible before processing
-            if os.path.isfile(file_path) and os.access(file_path, os.R_OK):
-                process_audio_file(file_path, api_key, success_folder, failed_folder)
-            else:
-                logging.warning(f"File no longer accessible: {file_path}")
-        except Exception as e:
-            logging.error(f"Error processing {file_path}: {str(e)}")
-            continue
+    try:
+        with tqdm(total=total_files, desc="Processing audio files", unit="file") as progress:
+            asyncio.run(process_files_concurrently(
+                audio_files, api_key, success_folder, failed_folder, max(args.concurrency, 1), progress, queue
+            ))
+    finally:
+        if queue:
+            queue.close()
 
 if __name__ == "__main__":
     main()
-
@@ -1,22 +1,204 @@
-import requests
 import base64
 import json
 import logging
-import io
-from pydub import AudioSegment
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from config import get_shazam_settings
+import metrics
+import resources
 
 # You might want to move this to config.py if it's used elsewhere
 SHAZAM_API_URL = "https://shazam.p.rapidapi.com"
 
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Shazam expects 44.1 kHz mono signed 16-bit little-endian PCM
+SAMPLE_RATE = 44100
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: allows `burst` requests at once and `rate` requests per second sustained.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+_requests = None
+_session = None
+_settings = None
+_rate_limiter = None
+_client_lock = threading.Lock()
+
+def get_requests_module():
+    # Imported on first use so importing this module (and main.py) stays cheap
+    global _requests
+    if _requests is None:
+        import requests
+        _requests = requests
+    return _requests
+
+def get_session():
+    # A single pooled keep-alive session shared by every worker thread
+    global _session, _settings, _rate_limiter
+    with _client_lock:
+        if _session is None:
+            requests = get_requests_module()
+            settings = _settings = get_shazam_settings()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(settings['concurrency'], 1))
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _rate_limiter = TokenBucket(settings['requests_per_second'], settings['burst'])
+        return _session
+
+def get_retry_delay(response, attempt, backoff_seconds, max_retry_after=60):
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0), max_retry_after)
+        except ValueError:
+            try:
+                return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0), max_retry_after)
+            except (TypeError, ValueError):
+                pass
+    # Exponential backoff with jitter so concurrent workers don't retry in lockstep
+    return backoff_seconds * (2 ** attempt) * (0.5 + random.random())
+
+def send_request(method, url, **kwargs):
+    """
+    Sends a rate-limited request through the shared session, retrying 429/5xx responses
+    and connection errors with Retry-After-aware backoff. Raises on final failure.
+    """
+    requests = get_requests_module()
+    session = get_session()
+    settings = _settings
+    timeout = (settings['connect_timeout'], settings['read_timeout'])
+    operation = 'shazam_' + url.rstrip('/').rsplit('/', 1)[-1].replace('-', '_')
+
+    for attempt in range(settings['max_retries'] + 1):
+        _rate_limiter.acquire()
+        try:
+            # Every attempt is timed separately, labelled with its HTTP status
+            with metrics.span(operation) as span:
+                response = session.request(method, url, timeout=timeout, **kwargs)
+                span.status = response.status_code
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == settings['max_retries']:
+                raise
+            delay = get_retry_delay(None, attempt, settings['backoff_seconds'])
+            logging.warning(f"Shazam request failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+
+        if response.status_code in RETRY_STATUS_CODES and attempt < settings['max_retries']:
+            delay = get_retry_delay(response, attempt, settings['backoff_seconds'], settings['max_retry_after'])
+            logging.warning(f"Shazam returned {response.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+
+        response.raise_for_status()  # Raises a HTTPError if the status is 4xx, 5xx
+        return response
+
 def convert_audio_to_shazam_format(input_file_path, start_time=20, duration=5):
-    audio = AudioSegment.from_file(input_file_path)
-    audio = audio.set_frame_rate(44100).set_channels(1).set_sample_width(2)
-    start_ms = start_time * 1000
-    end_ms = start_ms + (duration * 1000)
-    audio_segment = audio[start_ms:end_ms]
-    raw_data = io.BytesIO()
-    audio_segment.export(raw_data, format="raw")
-    return raw_data.getvalue()
+    # Seek before decoding and read only the requested window, so memory stays constant
+    # regardless of the input length. ffmpeg writes 44.1 kHz mono s16le PCM straight to the pipe.
+    ffmpeg_command = [
+        'ffmpeg', '-v', 'error', '-nostdin',
+        '-ss', str(start_time), '-t', str(duration), '-i', input_file_path,
+        '-map', '0:a:0', '-ac', '1', '-ar', '44100', '-acodec', 'pcm_s16le', '-f', 's16le', 'pipe:1'
+    ]
+    result = resources.run('ffmpeg_sample', ffmpeg_command, capture_output=True, timeout=60)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to extract sample from {input_file_path}: {result.stderr.decode('utf-8', 'replace').strip()}")
+    return result.stdout
+
+def decode_audio_to_pcm(input_file_path, max_seconds):
+    # Decodes at most max_seconds from the start of the file to 44.1 kHz mono s16le PCM
+    ffmpeg_command = [
+        'ffmpeg', '-v', 'error', '-nostdin',
+        '-t', str(max_seconds), '-i', input_file_path,
+        '-map', '0:a:0', '-ac', '1', '-ar', '44100', '-acodec', 'pcm_s16le', '-f', 's16le', 'pipe:1'
+    ]
+    result = resources.run('ffmpeg_decode_pcm', ffmpeg_command, capture_output=True,
+                           timeout=resources.scaled_timeout(120, max_seconds))
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {input_file_path}: {result.stderr.decode('utf-8', 'replace').strip()}")
+    return result.stdout
+
+def select_sample_windows(pcm, duration=5, preferred_start=20, silence_db=-45):
+    """
+    Ranks non-overlapping sample windows of decoded PCM for recognition. Windows that are mostly
+    silent are skipped; the preferred start comes first if it is usable, then the loudest windows.
+    Returns start times in seconds.
+    """
+    total_seconds = len(pcm) / (SAMPLE_RATE * 2)
+    if total_seconds <= duration:
+        return [0.0]
+    try:
+        import numpy as np
+    except ImportError:
+        return [min(preferred_start, total_seconds - duration)]
+
+    # RMS level per half-second block
+    block = SAMPLE_RATE // 2
+    samples = np.frombuffer(pcm, dtype='<i2')
+    block_count = len(samples) // block
+    blocks = samples[:block_count * block].reshape(block_count, block).astype(np.float32) / 32768.0
+    rms = np.sqrt((blocks ** 2).mean(axis=1))
+    loud = 20 * np.log10(rms + 1e-10) > silence_db
+
+    # Loud fraction and mean level for the window starting at every block
+    width = int(duration * 2)
+    if block_count < width:
+        return [0.0]
+    loud_sum = np.concatenate([[0], np.cumsum(loud)])
+    rms_sum = np.concatenate([[0.0], np.cumsum(rms)])
+    loud_fraction = (loud_sum[width:] - loud_sum[:-width]) / width
+    energy = (rms_sum[width:] - rms_sum[:-width]) / width
+
+    candidates = np.nonzero(loud_fraction >= 0.8)[0]
+    if len(candidates) == 0:
+        # Nothing is clearly audible; fall back to the loudest window
+        return [float(energy.argmax()) / 2]
+
+    preferred = int(preferred_start * 2)
+    ranked = sorted(candidates.tolist(), key=lambda start: (start != preferred, -energy[start]))
+    chosen = []
+    for start in ranked:
+        if all(abs(start - other) >= width for other in chosen):
+            chosen.append(start)
+    return [start / 2 for start in chosen]
+
+def extract_sample_windows(input_file_path, settings):
+    """
+    Decodes the start of the file once and returns recognition samples (raw PCM bytes)
+    in priority order, as produced by select_sample_windows.
+    """
+    pcm = decode_audio_to_pcm(input_file_path, settings['scan_seconds'])
+    duration = settings['sample_seconds']
+    window_bytes = int(duration * SAMPLE_RATE) * 2
+    samples = []
+    for start in select_sample_windows(pcm, duration, settings['preferred_offset'], settings['silence_db']):
+        offset = int(start * SAMPLE_RATE) * 2
+        samples.append(pcm[offset:offset + window_bytes])
+    return samples
 
 def extract_song_id(detection_result):
     try:
@@ -35,10 +217,10 @@ def detect_song(raw_data, api_key):
         "X-RapidAPI-Key": api_key,
         "X-RapidAPI-Host": "shazam.p.rapidapi.com"
     }
-    
+    requests = get_requests_module()
+
     try:
-        response = requests.post(url, data=payload, headers=headers, params=querystring)
-        response.raise_for_status()  # Raises a HTTPError if the status is 4xx, 5xx
+        response = send_request('POST', url, data=payload, headers=headers, params=querystring)
         result = response.json()
         if 'track' in result:
             return result
@@ -59,10 +241,10 @@ def get_song_details(song_id, api_key):
         "X-RapidAPI-Key": api_key,
         "X-RapidAPI-Host": "shazam.p.rapidapi.com"
     }
-    
+    requests = get_requests_module()
+
     try:
-        response = requests.get(url, headers=headers, params=querystring)
-        response.raise_for_status()  # Raises a HTTPError if the status is 4xx, 5xx
+        response = send_request('GET', url, headers=headers, params=querystring)
         return response.json()
     except requests.exceptions.RequestException as e:
         logging.error(f"Error getting song details: {e}")
@@ -1,35 +1,124 @@
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, TIT2, TPE1, TALB, TPE2, TCOM, TCON, TYER, TRCK, TPOS, APIC
-import requests
+import os
+import shutil
+import tempfile
 import logging
+from album_art_cache import get_album_art
+import metrics
+import storage
+
+# Metadata key -> ID3 frame id written for it (mutagen is imported when a file is opened)
+FRAMES = [
+    ('title', 'TIT2'),
+    ('artist', 'TPE1'),
+    ('album', 'TALB'),
+    ('album_artist', 'TPE2'),
+    ('composer', 'TCOM'),
+    ('genre', 'TCON'),
+    # ID3v2.4 recording time; mutagen converts a v2.3 TYER into it when the file is loaded
+    ('year', 'TDRC'),
+    ('track', 'TRCK'),
+    ('disc', 'TPOS'),
+]
+
+# Minimum ID3 padding kept after a save so later edits fit in place without rewriting the audio
+MIN_PADDING = 16 * 1024
+
+def keep_padding(info):
+    if info.padding >= MIN_PADDING:
+        return info.padding
+    return max(info.get_default_padding(), MIN_PADDING)
+
+class _TagGrows(Exception):
+    pass
+
+def fit_in_place(info):
+    # Keeps the tag at its current size so the audio after it stays where it is; raised
+    # before anything is written when the new frames need more room than the padding has
+    if info.padding < 0:
+        raise _TagGrows()
+    return info.padding
+
+class TaggingSession:
+    """
+    Opens an MP3 once, diffs its tags against new metadata and writes only the changed
+    frames in a single save: in place when they fit the tag's padding, otherwise atomically
+    (temp file in the same folder, then rename).
+    """
+    def __init__(self, audio_file_path):
+        from mutagen.mp3 import MP3
+        from mutagen.id3 import ID3
+        self.path = audio_file_path
+        with metrics.span('mutagen_read', audio_file_path):
+            self.audio = MP3(audio_file_path, ID3=ID3)
+        if self.audio.tags is None:
+            self.audio.add_tags()
+
+    def current_metadata(self):
+        tags = self.audio.tags
+        metadata = {key: str(tags.get(frame_id, '')) for key, frame_id in FRAMES}
+        # Tags loaded without v2.4 translation may still carry the year as TYER
+        if not metadata['year'] and 'TYER' in tags:
+            metadata['year'] = str(tags['TYER'])
+        return metadata
+
+    def has_album_art(self):
+        return bool(self.audio.tags.getall('APIC'))
+
+    def diff(self, metadata):
+        changes = compare_metadata(self.current_metadata(), {k: v for k, v in metadata.items() if k != 'album_art_url'})
+        if metadata.get('album_art_url') and not self.has_album_art():
+            changes['album_art_url'] = (None, metadata['album_art_url'])
+        return changes
+
+    def apply(self, metadata):
+        # Replaces only the frames whose value changed; returns the changes that were applied
+        changes = self.diff(metadata)
+        import mutagen.id3
+        for key, frame_id in FRAMES:
+            if key in changes:
+                frame = getattr(mutagen.id3, frame_id)
+                self.audio.tags.setall(frame_id, [frame(encoding=3, text=metadata[key])])
+        if 'year' in changes:
+            # A leftover TYER would be read back instead of the new year
+            self.audio.tags.delall('TYER')
+        if 'album_art_url' in changes:
+            add_album_art(self.audio, metadata['album_art_url'])
+        return changes
+
+    def save(self):
+        with metrics.span('mutagen_write', self.path) as span:
+            # Changed frames that fit the existing padding only rewrite the tag's own bytes
+            try:
+                self.audio.tags.save(self.path, padding=fit_in_place)
+                span.status = 'in_place'
+                return
+            except _TagGrows:
+                span.status = 'rewrite'
+            self._save_rewrite()
+
+    def _save_rewrite(self):
+        # Growing the tag moves the audio, so that is done on a copy renamed over the file
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.tagging', dir=directory)
+        os.close(fd)
+        try:
+            # Where the filesystem shares extents the copy costs no audio I/O
+            storage.clone(self.path, temp_path)
+            self.audio.tags.save(temp_path, padding=keep_padding)
+            shutil.copymode(self.path, temp_path)
+            os.replace(temp_path, self.path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
 
 def update_metadata(audio_file_path, metadata):
 
-    # Updates the metadata of an MP3 file.
+    # Updates the metadata of an MP3 file, writing only frames that changed.
 
     try:
-        audio = MP3(audio_file_path, ID3=ID3)
-
-        # Remove existing ID3 tags
-        audio.delete()
-        audio.save()
-
-        # Add new ID3 tags
-        audio.tags.add(TIT2(encoding=3, text=metadata.get('title', '')))
-        audio.tags.add(TPE1(encoding=3, text=metadata.get('artist', '')))
-        audio.tags.add(TALB(encoding=3, text=metadata.get('album', '')))
-        audio.tags.add(TPE2(encoding=3, text=metadata.get('album_artist', '')))
-        audio.tags.add(TCOM(encoding=3, text=metadata.get('composer', '')))
-        audio.tags.add(TCON(encoding=3, text=metadata.get('genre', '')))
-        audio.tags.add(TYER(encoding=3, text=metadata.get('year', '')))
-        audio.tags.add(TRCK(encoding=3, text=metadata.get('track', '')))
-        audio.tags.add(TPOS(encoding=3, text=metadata.get('disc', '')))
-
-        # Add album art if available
-        if metadata.get('album_art_url'):
-            add_album_art(audio, metadata['album_art_url'])
-
-        audio.save()
+        session = TaggingSession(audio_file_path)
+        if session.apply(metadata):
+            session.save()
         logging.info(f"Updated metadata for {audio_file_path}")
         return True
     except Exception as e:
@@ -40,9 +129,13 @@ def add_album_art(audio, album_art_url):
     """
     Adds album art to the audio file.
     """
+    from mutagen.id3 import APIC
     try:
-        album_art_data = requests.get(album_art_url).content
-        audio.tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=album_art_data))
+        album_art_data = get_album_art(album_art_url)
+        if not album_art_data:
+            return
+        mime = 'image/png' if album_art_data.startswith(b'\x89PNG') else 'image/jpeg'
+        audio.tags.add(APIC(encoding=3, mime=mime, type=3, desc='Cover', data=album_art_data))
         logging.info("Added album art")
     except Exception as e:
         logging.error(f"Error adding album art: {e}")
@@ -52,19 +145,7 @@ def get_current_metadata(audio_file_path):
     Retrieves the current metadata of an MP3 file.
     """
     try:
-        audio = MP3(audio_file_path, ID3=ID3)
-        metadata = {
-            'title': str(audio.tags.get('TIT2', '')),
-            'artist': str(audio.tags.get('TPE1', '')),
-            'album': str(audio.tags.get('TALB', '')),
-            'album_artist': str(audio.tags.get('TPE2', '')),
-            'composer': str(audio.tags.get('TCOM', '')),
-            'genre': str(audio.tags.get('TCON', '')),
-            'year': str(audio.tags.get('TYER', '')),
-            'track': str(audio.tags.get('TRCK', '')),
-            'disc': str(audio.tags.get('TPOS', '')),
-        }
-        return metadata
+        return TaggingSession(audio_file_path).current_metadata()
     except Exception as e:
         logging.error(f"Error getting current metadata for {audio_file_path}: {e}")
         return {}
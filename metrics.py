@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import atexit
+import bisect
+import logging
+import threading
+import subprocess
+import contextlib
+import contextvars
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import get_metrics_settings
+
+# Upper bounds (seconds) of the wall time histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+# operation -> [bucket counts..., count, wall sum, cpu sum]
+_histograms = {}
+# (operation, status) -> count
+_counters = {}
+# (operation, status) -> bytes copied; only file transfers report these
+_bytes = {}
+_trace_lock = threading.Lock()
+_trace_path = None
+# The file whose processing the current thread is working on; spans are attributed to it
+_current_file = contextvars.ContextVar('current_file', default=None)
+
+def _observe(operation, status, wall, cpu, copied=None):
+    with _lock:
+        histogram = _histograms.get(operation)
+        if histogram is None:
+            histogram = _histograms[operation] = [0] * (len(BUCKETS) + 3)
+        histogram[bisect.bisect_left(BUCKETS, wall)] += 1
+        histogram[-3] += 1
+        histogram[-2] += wall
+        histogram[-1] += cpu
+        key = (operation, str(status))
+        _counters[key] = _counters.get(key, 0) + 1
+        if copied is not None:
+            _bytes[key] = _bytes.get(key, 0) + copied
+
+def _write_trace(event):
+    if _trace_path is None:
+        return
+    line = json.dumps(event, ensure_ascii=False) + '\n'
+    # One append per event keeps lines whole when conversion worker processes share the file
+    with _trace_lock, open(_trace_path, 'a', encoding='utf-8') as f:
+        f.write(line)
+
+def record(operation, status, started, wall, cpu, file_path=None, copied=None):
+    _observe(operation, status, wall, cpu, copied)
+    event = {
+        'file': file_path or _current_file.get(),
+        'op': operation,
+        'status': status,
+        'start': round(started, 6),
+        'wall': round(wall, 6),
+        'cpu': round(cpu, 6),
+        'pid': os.getpid(),
+    }
+    if copied is not None:
+        event['bytes'] = copied
+    _write_trace(event)
+
+class Span:
+    """
+    Times one operation. Wall and calling-thread CPU time are recorded when the block exits;
+    set `status` inside the block (an HTTP status code, say) or it becomes 'ok' / 'error'.
+    File transfers also set `copied` to the number of bytes they had to copy.
+    """
+    def __init__(self, operation, file_path=None):
+        self.operation = operation
+        self.file_path = file_path
+        self.status = None
+        self.copied = None
+
+    def __enter__(self):
+        self.started = time.time()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        status = self.status
+        if status is None:
+            status = 'ok' if exc_type is None else 'error'
+        record(self.operation, status, self.started, time.perf_counter() - self.wall_start,
+               time.thread_time() - self.cpu_start, self.file_path, self.copied)
+        return False
+
+def span(operation, file_path=None):
+    return Span(operation, file_path)
+
+@contextlib.contextmanager
+def file_trace(file_path):
+    # Attributes every span in the block to file_path
+    token = _current_file.set(os.path.abspath(file_path))
+    try:
+        yield
+    finally:
+        _current_file.reset(token)
+
+def traced(func):
+    # Per-file entry points: spans recorded during the call belong to the first argument
+    @functools.wraps(func)
+    def wrapper(file_path, *args, **kwargs):
+        with file_trace(file_path):
+            return func(file_path, *args, **kwargs)
+    return wrapper
+
+class _RusagePopen(subprocess.Popen):
+    # Reaps the child with wait4 so its own CPU time is known, not the whole process tree's
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            pid, status, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return self.pid, 0
+        if pid == self.pid:
+            self.rusage = rusage
+        return pid, status
+
+def run(operation, command, input=None, capture_output=False, timeout=None, check=False, **kwargs):
+    """
+    subprocess.run for ffmpeg/ffprobe, recording wall time and the child's user+system CPU time.
+    The status is the exit code, or 'timeout'.
+    """
+    if capture_output:
+        kwargs['stdout'] = subprocess.PIPE
+        kwargs['stderr'] = subprocess.PIPE
+    popen = _RusagePopen if hasattr(os, 'wait4') else subprocess.Popen
+    started = time.time()
+    wall_start = time.perf_counter()
+    status = 'error'
+    process = None
+    try:
+        with popen(command, stdin=subprocess.PIPE if input is not None else None, **kwargs) as process:
+            try:
+                stdout, stderr = process.communicate(input, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                status = 'timeout'
+                process.kill()
+                process.wait()
+                raise
+            except BaseException:
+                process.kill()
+                raise
+            status = process.returncode
+    finally:
+        rusage = getattr(process, 'rusage', None)
+        cpu = rusage.ru_utime + rusage.ru_stime if rusage else 0.0
+        record(operation, status, started, time.perf_counter() - wall_start, cpu)
+
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command, stdout, stderr)
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+def snapshot():
+    with _lock:
+        return {
+            'histograms': {operation: list(values) for operation, values in _histograms.items()},
+            'counters': dict(_counters),
+            'bytes': dict(_bytes),
+        }
+
+def merge(data):
+    # Folds metrics collected in a worker process into this process
+    with _lock:
+        for operation, values in data['histograms'].items():
+            histogram = _histograms.setdefault(operation, [0] * len(values))
+            for index, value in enumerate(values):
+                histogram[index] += value
+        for key, count in data['counters'].items():
+            _counters[key] = _counters.get(key, 0) + count
+        for key, copied in data['bytes'].items():
+            _bytes[key] = _bytes.get(key, 0) + copied
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _bytes.clear()
+
+def collect(func, *args, **kwargs):
+    """
+    Runs func in a pool worker and returns (result, metrics recorded by this call) so the
+    parent can merge() them.
+    """
+    reset()
+    result = func(*args, **kwargs)
+    return result, snapshot()
+
+def _format_labels(labels):
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+def render():
+    """
+    Counters and histograms in the Prometheus text exposition format.
+    """
+    data = snapshot()
+    lines = [
+        '# HELP songmend_operation_seconds Wall time of subprocesses, API calls, tag I/O and moves.',
+        '# TYPE songmend_operation_seconds histogram',
+    ]
+    for operation, values in sorted(data['histograms'].items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), values):
+            cumulative += count
+            lines.append(f"songmend_operation_seconds_bucket{_format_labels([('operation', operation), ('le', bound)])} {cumulative}")
+        lines.append(f"songmend_operation_seconds_sum{_format_labels([('operation', operation)])} {values[-2]:.6f}")
+        lines.append(f"songmend_operation_seconds_count{_format_labels([('operation', operation)])} {values[-3]}")
+
+    lines += [
+        '# HELP songmend_operation_cpu_seconds_total CPU time of the operation (the child process for subprocesses).',
+        '# TYPE songmend_operation_cpu_seconds_total counter',
+    ]
+    for operation, values in sorted(data['histograms'].items()):
+        lines.append(f"songmend_operation_cpu_seconds_total{_format_labels([('operation', operation)])} {values[-1]:.6f}")
+
+    lines += [
+        '# HELP songmend_operations_total Operations by outcome: exit code, HTTP status, ok, error or timeout.',
+        '# TYPE songmend_operations_total counter',
+    ]
+    for (operation, status), count in sorted(data['counters'].items()):
+        lines.append(f"songmend_operations_total{_format_labels([('operation', operation), ('status', status)])} {count}")
+
+    lines += [
+        '# HELP songmend_copied_bytes_total Bytes copied by file transfers, by method (rename and hardlink copy none).',
+        '# TYPE songmend_copied_bytes_total counter',
+    ]
+    for (operation, status), copied in sorted(data['bytes'].items()):
+        lines.append(f"songmend_copied_bytes_total{_format_labels([('operation', operation), ('method', status)])} {copied}")
+    return '\n'.join(lines) + '\n'
+
+def write_metrics_file(path):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(render())
+    os.replace(temp_path, path)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def setup_metrics():
+    """
+    Starts the exporters configured in config.json: a JSONL trace file, a Prometheus text
+    file rewritten at exit, and an HTTP endpoint serving /metrics.
+    """
+    global _trace_path
+    settings = get_metrics_settings()
+    if settings['trace_file']:
+        os.makedirs(os.path.dirname(os.path.abspath(settings['trace_file'])), exist_ok=True)
+        _trace_path = settings['trace_file']
+        # Pool workers inherit the path through the environment when they are spawned
+        os.environ['SONGMEND_TRACE_FILE'] = _trace_path
+    if settings['metrics_file']:
+        os.makedirs(os.path.dirname(os.path.abspath(settings['metrics_file'])), exist_ok=True)
+        atexit.register(write_metrics_file, settings['metrics_file'])
+    if settings['http_port']:
+        server = ThreadingHTTPServer((settings['http_host'], settings['http_port']), _MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        logging.info(f"Serving metrics on http://{settings['http_host']}:{server.server_port}/metrics")
+
+# Conversion workers started with spawn re-import this module instead of inheriting globals
+if os.environ.get('SONGMEND_TRACE_FILE'):
+    _trace_path = os.environ['SONGMEND_TRACE_FILE']
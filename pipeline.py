@@ -0,0 +1,211 @@
+import os
+import sys
+import time
+import queue
+import logging
+import threading
+from config import setup_logging, get_api_key, get_folders, get_pipeline_settings
+from audio_file_conversion import convert_to_mp3, clean_partial_files
+from audio_file_error_check import check_file
+import metrics
+from main import recognize_audio_file, tag_audio_file, move_to_success, mark_failed, discard_if_duplicate
+from metadata_updater import get_current_metadata
+import library_index
+import run_journal
+from file_operations import scan_files
+from work_queue import get_work_queue
+
+# Marks the end of the input for one worker
+_DONE = object()
+
+class Stage:
+    """
+    A pool of worker threads reading jobs from a bounded input queue. `func` returns the job
+    for the next stage, or None to drop it. A full output queue blocks the workers (backpressure).
+    """
+    def __init__(self, name, func, workers, queue_size, on_error=None):
+        self.name = name
+        self.func = func
+        self.workers = max(workers, 1)
+        self.on_error = on_error
+        self.input = queue.Queue(maxsize=queue_size)
+        self.output = None
+        self.next_workers = 0
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self.lock = threading.Lock()
+        self.threads = []
+        self.remaining = self.workers
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self.run, name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        try:
+            while True:
+                job = self.input.get()
+                if job is _DONE:
+                    break
+                started = time.monotonic()
+                # Spans recorded by the stage (and its error handler) belong to the job's file
+                with metrics.file_trace(job['path']):
+                    try:
+                        result = self.func(job)
+                    except Exception as e:
+                        logging.error(f"{self.name} stage failed for {job.get('path')}: {e}")
+                        self._handle_error(job, e)
+                        result = None
+                with self.lock:
+                    self.processed += 1
+                    self.busy_seconds += time.monotonic() - started
+                if result is not None and self.output is not None:
+                    self.output.put(result)
+        finally:
+            # The last worker to finish tells every worker of the next stage to stop, even if
+            # this one died, so downstream stages and Pipeline.run never wait forever
+            with self.lock:
+                self.remaining -= 1
+                last = self.remaining == 0
+            if last and self.output is not None:
+                for _ in range(self.next_workers):
+                    self.output.put(_DONE)
+
+    def _handle_error(self, job, error):
+        if not self.on_error:
+            return
+        try:
+            self.on_error(job, error)
+        except Exception as e:
+            logging.error(f"{self.name} stage could not handle the failure of {job.get('path')}: {e}")
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+class Pipeline:
+    def __init__(self, stages):
+        self.stages = stages
+        for current, following in zip(stages, stages[1:]):
+            current.output = following.input
+            current.next_workers = following.workers
+
+    def run(self, jobs):
+        for stage in self.stages:
+            stage.start()
+        first = self.stages[0]
+        for job in jobs:
+            first.input.put(job)
+        for _ in range(first.workers):
+            first.input.put(_DONE)
+        for stage in self.stages:
+            stage.join()
+
+def build_pipeline(folders, api_key, settings, queue=None):
+    workers = settings['workers']
+    queue_size = settings['queue_size']
+
+    def fail(job, error):
+        if os.path.exists(job['path']):
+            mark_failed(job['path'], folders['failed_folder'], str(error))
+
+    def release(job):
+        # The claimed inbox file has been consumed (converted, or moved aside)
+        if queue and 'claim' in job:
+            queue.finish(job['claim'])
+
+    def validate(job):
+        if check_file(job['path'], folders['error_folder'], folders['video_folder'], use_journal=True):
+            return job
+        release(job)
+        return None
+
+    def convert(job):
+        try:
+            output_path = convert_to_mp3(
+                job['path'],
+                folders['processed_folder'],
+                folders['error_folder'],
+                folders['original_folder']
+            )
+        finally:
+            release(job)
+        return {'path': output_path} if output_path else None
+
+    def recognize(job):
+        if run_journal.has_reached(job['path'], 'tagged'):
+            # Tagged by an interrupted run; only the rename/move is left
+            return dict(job, metadata=None, song_id=None, changed=None)
+        if discard_if_duplicate(job['path'], audio_hash=library_index.audio_payload_hash(job['path'])):
+            return None
+        metadata, song_id, reason = recognize_audio_file(job['path'], api_key)
+        if metadata is None:
+            mark_failed(job['path'], folders['failed_folder'], reason)
+            return None
+        if discard_if_duplicate(job['path'], song_id=song_id):
+            return None
+        return dict(job, metadata=metadata, song_id=song_id)
+
+    def tag(job):
+        if job['metadata'] is None:
+            return job
+        changed = tag_audio_file(job['path'], job['metadata'])
+        if changed is None:
+            mark_failed(job['path'], folders['failed_folder'], "Failed to update metadata")
+            return None
+        return dict(job, changed=changed)
+
+    def move(job):
+        if job['metadata'] is None:
+            move_to_success(job['path'], get_current_metadata(job['path']), True, folders['success_folder'])
+        else:
+            move_to_success(job['path'], job['metadata'], job['changed'], folders['success_folder'], job['song_id'])
+        return None
+
+    return Pipeline([
+        Stage('validate', validate, workers['validate'], queue_size),
+        Stage('convert', convert, workers['convert'], queue_size),
+        Stage('recognize', recognize, workers['recognize'], queue_size, on_error=fail),
+        Stage('tag', tag, workers['tag'], queue_size, on_error=fail),
+        Stage('move', move, workers['move'], queue_size, on_error=fail),
+    ])
+
+def iter_inbox(audio_folder, queue=None):
+    # Streams jobs as the scan finds them, so the first files are in flight before the scan ends.
+    # With a work queue each file is claimed as the first stage accepts it, so the bounded
+    # queues decide how far ahead of other processes this one claims.
+    if queue:
+        for claimed_path in queue.iter_claims(audio_folder):
+            yield {'path': claimed_path, 'claim': claimed_path}
+        return
+    for entry in scan_files(audio_folder):
+        yield {'path': entry.path}
+
+def main():
+    setup_logging()
+    metrics.setup_metrics()
+    folders = get_folders()
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+    queue = get_work_queue(folders['audio_folder'])
+    clean_partial_files(folders)
+
+    pipeline = build_pipeline(folders, get_api_key(), get_pipeline_settings(), queue)
+    started = time.monotonic()
+    try:
+        pipeline.run(iter_inbox(folders['audio_folder'], queue))
+    finally:
+        if queue:
+            queue.close()
+    elapsed = time.monotonic() - started
+
+    print(f"Pipeline finished in {elapsed:.1f}s")
+    for stage in pipeline.stages:
+        print(f"  {stage.name:<10} {stage.processed:>6} files  {stage.busy_seconds:>8.1f}s busy  ({stage.workers} workers)")
+    logging.info(f"Pipeline finished in {elapsed:.1f}s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import os
+import json
+import logging
+from cache_db import get_connection
+from config import get_folders
+import resources
+
+PROBE_COMMAND = [
+    'ffprobe',
+    '-v', 'quiet',
+    '-print_format', 'json',
+    '-show_format',
+    '-show_streams',
+    '-analyzeduration', '100M',
+    '-probesize', '100M',
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS probes (
+    path     TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    info     TEXT
+);
+"""
+
+_db_path = None
+
+def get_db_path():
+    global _db_path
+    if _db_path is None:
+        _db_path = os.path.join(get_folders()['cache_folder'], 'probe_cache.sqlite')
+    return _db_path
+
+def probe(file_path, timeout=30):
+    """
+    Returns the ffprobe format/stream info for file_path, or None if ffprobe could not read it.
+    Results are cached on disk and reused until the file's size or mtime changes.
+    """
+    path = os.path.abspath(file_path)
+    stat = os.stat(path)
+    conn = get_connection(get_db_path(), SCHEMA)
+
+    row = conn.execute('SELECT size, mtime_ns, info FROM probes WHERE path = ?', (path,)).fetchone()
+    if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+        return json.loads(row[2]) if row[2] else None
+
+    result = resources.run('ffprobe', PROBE_COMMAND + [path], capture_output=True, text=True,
+                           timeout=resources.scaled_timeout(timeout, file_path=path))
+    if result.returncode == 0:
+        info = json.loads(result.stdout)
+    else:
+        logging.warning(f"FFprobe error for {path}: {result.stderr}")
+        info = None
+
+    # Failed probes are cached too: an unreadable file stays unreadable until it changes
+    conn.execute(
+        'INSERT OR REPLACE INTO probes (path, size, mtime_ns, info) VALUES (?, ?, ?, ?)',
+        (path, stat.st_size, stat.st_mtime_ns, json.dumps(info) if info is not None else None)
+    )
+    conn.commit()
+    return info
+
+def get_audio_stream(info):
+    if info:
+        for stream in info.get('streams', []):
+            if stream.get('codec_type') == 'audio':
+                return stream
+    return None
+
+def get_bitrate(file_path, default=320):
+    # Audio bitrate in kbps, capped at 320
+    try:
+        stream = get_audio_stream(probe(file_path))
+        if stream:
+            return min(int(stream.get('bit_rate', '320000')) // 1000, 320)
+    except Exception as e:
+        logging.warning(f"Failed to get bitrate for {file_path}: {e}")
+    return default
+
+def get_channels(file_path):
+    try:
+        stream = get_audio_stream(probe(file_path))
+        if stream:
+            return int(stream.get('channels', 0))
+    except Exception as e:
+        logging.warning(f"Failed to get channel count for {file_path}: {e}")
+    return 0
+
+def get_duration(file_path):
+    # Duration in seconds, or None if unknown
+    try:
+        info = probe(file_path)
+        if info:
+            duration = info.get('format', {}).get('duration') or (get_audio_stream(info) or {}).get('duration')
+            if duration:
+                return float(duration)
+    except Exception as e:
+        logging.warning(f"Failed to get duration for {file_path}: {e}")
+    return None
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from cache_db import get_connection
+from config import get_folders, get_recognition_cache_settings
+from metadata_shazam_api import detect_song, get_song_details, extract_song_id
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS detections (
+    sample_hash TEXT PRIMARY KEY,
+    song_id     TEXT,
+    detection   TEXT NOT NULL,
+    created_at  REAL NOT NULL,
+    last_used   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS detections_last_used ON detections (last_used);
+CREATE INDEX IF NOT EXISTS detections_song_id ON detections (song_id);
+CREATE TABLE IF NOT EXISTS song_details (
+    song_id    TEXT PRIMARY KEY,
+    details    TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS song_details_last_used ON song_details (last_used);
+"""
+
+_db_path = None
+_settings = None
+
+def get_db():
+    global _db_path, _settings
+    if _db_path is None:
+        _settings = get_recognition_cache_settings()
+        _db_path = os.path.join(get_folders()['cache_folder'], 'recognition_cache.sqlite')
+    return get_connection(_db_path, SCHEMA)
+
+def sample_hash(raw_data):
+    # Content hash of the PCM sample sent to Shazam; identical audio gives identical keys
+    return hashlib.sha256(raw_data).hexdigest()
+
+def _lookup(table, key_column, key, value_column):
+    conn = get_db()
+    row = conn.execute(
+        f'SELECT {value_column}, created_at FROM {table} WHERE {key_column} = ?', (key,)
+    ).fetchone()
+    if row is None:
+        return None
+    if time.time() - row[1] > _settings['ttl_days'] * 86400:
+        conn.execute(f'DELETE FROM {table} WHERE {key_column} = ?', (key,))
+        conn.commit()
+        return None
+    conn.execute(f'UPDATE {table} SET last_used = ? WHERE {key_column} = ?', (time.time(), key))
+    conn.commit()
+    return json.loads(row[0])
+
+def _evict(conn, table, key_column):
+    count = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+    excess = count - _settings['max_entries']
+    if excess > 0:
+        conn.execute(
+            f'DELETE FROM {table} WHERE {key_column} IN '
+            f'(SELECT {key_column} FROM {table} ORDER BY last_used LIMIT ?)', (excess,)
+        )
+
+def get_cached_detection(raw_data):
+    return _lookup('detections', 'sample_hash', sample_hash(raw_data), 'detection')
+
+def get_cached_detection_by_song_id(song_id):
+    # Any unexpired cached detection of the song will do; used when the song was matched locally
+    conn = get_db()
+    now = time.time()
+    conn.execute('DELETE FROM detections WHERE song_id = ? AND created_at < ?',
+                 (str(song_id), now - _settings['ttl_days'] * 86400))
+    row = conn.execute(
+        'SELECT sample_hash, detection FROM detections WHERE song_id = ? ORDER BY last_used DESC LIMIT 1', (str(song_id),)
+    ).fetchone()
+    if row:
+        conn.execute('UPDATE detections SET last_used = ? WHERE sample_hash = ?', (now, row[0]))
+    conn.commit()
+    return json.loads(row[1]) if row else None
+
+def store_detection(raw_data, detection_result):
+    conn = get_db()
+    now = time.time()
+    conn.execute(
+        'INSERT OR REPLACE INTO detections (sample_hash, song_id, detection, created_at, last_used) VALUES (?, ?, ?, ?, ?)',
+        (sample_hash(raw_data), extract_song_id(detection_result), json.dumps(detection_result), now, now)
+    )
+    _evict(conn, 'detections', 'sample_hash')
+    conn.commit()
+
+def get_cached_song_details(song_id):
+    return _lookup('song_details', 'song_id', str(song_id), 'details')
+
+def store_song_details(song_id, song_details):
+    conn = get_db()
+    now = time.time()
+    conn.execute(
+        'INSERT OR REPLACE INTO song_details (song_id, details, created_at, last_used) VALUES (?, ?, ?, ?)',
+        (str(song_id), json.dumps(song_details), now, now)
+    )
+    _evict(conn, 'song_details', 'song_id')
+    conn.commit()
+
+def detect_song_cached(raw_data, api_key):
+    """
+    Same contract as detect_song, but answers from the local cache when this exact sample was seen before.
+    Only successful detections are cached.
+    """
+    detection_result = get_cached_detection(raw_data)
+    if detection_result is not None:
+        logging.info("Detection served from recognition cache")
+        return detection_result
+
+    detection_result = detect_song(raw_data, api_key)
+    if detection_result:
+        store_detection(raw_data, detection_result)
+    return detection_result
+
+def get_song_details_cached(song_id, api_key):
+    """
+    Same contract as get_song_details; details are shared by every detection of the same song_id.
+    """
+    song_details = get_cached_song_details(song_id)
+    if song_details is not None:
+        logging.info(f"Song details for {song_id} served from recognition cache")
+        return song_details
+
+    song_details = get_song_details(song_id, api_key)
+    if song_details:
+        store_song_details(song_id, song_details)
+    return song_details
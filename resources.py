@@ -0,0 +1,188 @@
+import os
+import time
+import shutil
+import signal
+import logging
+import threading
+import contextlib
+from config import get_folders, get_resource_settings
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (Windows): slots are only shared between the threads of one process
+    fcntl = None
+
+class ResourceExhausted(Exception):
+    """
+    A job was killed by the kernel OOM killer. The input is fine and should be retried later,
+    not treated as corrupt. An ffmpeg that fails its own allocations exits with an error
+    instead, which is treated like any other failure: a corrupt file can make it try to
+    allocate absurd amounts, and deferring that would keep it in the inbox forever.
+    """
+
+_settings = None
+_slot_folder = None
+_local_slots = None
+_init_lock = threading.Lock()
+
+def _init():
+    global _settings, _slot_folder, _local_slots
+    with _init_lock:
+        if _settings is None:
+            settings = get_resource_settings()
+            if not settings['memory_budget_mb']:
+                settings = dict(settings, memory_budget_mb=default_memory_budget_mb())
+            _slot_folder = os.path.join(get_folders()['cache_folder'], 'slots')
+            os.makedirs(_slot_folder, exist_ok=True)
+            _local_slots = threading.BoundedSemaphore(settings['cpu_slots'])
+            _settings = settings
+    return _settings
+
+def default_memory_budget_mb():
+    # Half of physical memory, leaving the rest to the OS page cache and everything else
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) // 1024 // 2
+    except OSError:
+        pass
+    return 4096
+
+def estimate_memory_mb(file_path=None, duration=None, outputs=1):
+    """
+    Rough peak memory of an ffmpeg job. Decoding streams, so most of it is a fixed cost;
+    large sources add demuxer buffers, long ones filter and index state, and each extra
+    output adds an encoder.
+    """
+    settings = _init()
+    estimate = settings['memory_base_mb'] + settings['memory_per_output_mb'] * max(outputs - 1, 0)
+    if file_path:
+        try:
+            estimate += os.path.getsize(file_path) / (1024 * 1024) * settings['memory_per_source_mb']
+        except OSError:
+            pass
+    if duration:
+        estimate += duration / 60 * settings['memory_per_minute_mb']
+    return int(estimate)
+
+def scaled_timeout(base, duration=None, file_path=None):
+    """
+    A timeout that grows with the job: base plus an allowance per minute of audio, or per GB
+    of input when the duration is not known (probing a file that has never been probed).
+    """
+    settings = _init()
+    if duration:
+        return base + duration / 60 * settings['timeout_per_minute']
+    if file_path:
+        try:
+            return base + os.path.getsize(file_path) / (1024 ** 3) * settings['timeout_per_gb']
+        except OSError:
+            pass
+    return base
+
+def _slot_path(index):
+    return os.path.join(_slot_folder, f"slot-{index}.lock")
+
+def _held_slots(skip=None):
+    # Estimates of slots currently held by any process on this host; a slot we can lock is free
+    held = []
+    for index in range(_settings['cpu_slots']):
+        if index == skip:
+            continue
+        try:
+            fd = os.open(_slot_path(index), os.O_RDWR | os.O_CREAT, 0o666)
+        except OSError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        except BlockingIOError:
+            content = os.pread(fd, 32, 0).decode('ascii', 'ignore').strip()
+            held.append(int(content) if content.isdigit() else 0)
+        finally:
+            os.close(fd)
+    return held
+
+def _try_acquire(memory_mb):
+    for index in range(_settings['cpu_slots']):
+        fd = os.open(_slot_path(index), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        # The slot file carries this job's memory estimate for other processes to read. It is
+        # written before looking at the other slots, so of two processes acquiring at once
+        # at least one sees the other's estimate; both may back off, neither overcommits.
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, str(memory_mb).encode('ascii'), 0)
+        held = _held_slots(skip=index)
+        # A job larger than the whole budget still runs, but only on an otherwise idle host
+        if held and sum(held) + memory_mb > _settings['memory_budget_mb']:
+            os.ftruncate(fd, 0)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+            return None
+        return fd
+    return None
+
+@contextlib.contextmanager
+def admit(operation, memory_mb):
+    """
+    Blocks until a CPU slot is free and the job's memory estimate fits next to the jobs already
+    running on this host, in any process. Slots are flock-ed files in the cache folder, so
+    conversion pool workers and separate runs share them; the lock dies with its process.
+    """
+    settings = _init()
+    started = time.monotonic()
+    if fcntl is None:
+        with _local_slots:
+            yield
+        return
+
+    fd = _try_acquire(memory_mb)
+    if fd is None:
+        logging.info(f"Queued {operation} ({memory_mb} MB estimated) until resources free up")
+        while fd is None:
+            time.sleep(settings['poll_interval'])
+            fd = _try_acquire(memory_mb)
+    waited = time.monotonic() - started
+    if waited > settings['poll_interval']:
+        metrics.record('admission_wait', operation, time.time() - waited, waited, 0.0)
+    try:
+        yield
+    finally:
+        os.ftruncate(fd, 0)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+def priority_prefix():
+    # Runs jobs under nice/ionice so interactive use of the box stays responsive
+    settings = _init()
+    prefix = []
+    if settings['nice'] and shutil.which('nice'):
+        prefix += ['nice', '-n', str(settings['nice'])]
+    if settings['ionice_class'] and shutil.which('ionice'):
+        ionice_class = {'realtime': '1', 'best-effort': '2', 'idle': '3'}[settings['ionice_class']]
+        prefix += ['ionice', '-c', ionice_class]
+        if ionice_class != '3':
+            prefix += ['-n', str(settings['ionice_level'])]
+    return prefix
+
+def run(operation, command, memory_mb=None, check=False, **kwargs):
+    """
+    metrics.run behind admission control and the configured priority. Raises ResourceExhausted
+    if the job was killed for memory, before check gets to call it a failed job.
+    """
+    memory_mb = memory_mb or estimate_memory_mb()
+    with admit(operation, memory_mb):
+        result = metrics.run(operation, priority_prefix() + command, **kwargs)
+    # Our own timeout raises TimeoutExpired, so a SIGKILL here came from the OOM killer
+    if result.returncode == -signal.SIGKILL:
+        raise ResourceExhausted(f"{operation} ran out of memory ({memory_mb} MB estimated)")
+    if check:
+        result.check_returncode()
+    return result
@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+import logging
+from cache_db import get_connection
+from config import get_folders
+
+# Pipeline stages in the order a file passes through them
+STAGES = ['validated', 'converted', 'recognized', 'tagged', 'moved']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path       TEXT PRIMARY KEY,
+    stage      TEXT NOT NULL,
+    size       INTEGER,
+    mtime_ns   INTEGER,
+    error      TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_stage ON files (stage);
+"""
+
+_db_path = None
+
+def get_db():
+    global _db_path
+    if _db_path is None:
+        _db_path = os.path.join(get_folders()['cache_folder'], 'run_journal.sqlite')
+    conn = get_connection(_db_path, SCHEMA)
+    # The journal is the source of truth for resuming, so commits must survive a power loss
+    conn.execute('PRAGMA synchronous=FULL')
+    return conn
+
+def get_stage(file_path):
+    """
+    Returns the last completed stage for file_path, or None if the file is unknown
+    or has changed on disk since that stage was recorded.
+    """
+    path = os.path.abspath(file_path)
+    row = get_db().execute('SELECT stage, size, mtime_ns FROM files WHERE path = ?', (path,)).fetchone()
+    if row is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if (row[1], row[2]) != (stat.st_size, stat.st_mtime_ns):
+        return None
+    return row[0]
+
+def has_reached(file_path, stage):
+    current = get_stage(file_path)
+    return current is not None and STAGES.index(current) >= STAGES.index(stage)
+
+def record_stage(file_path, stage, new_path=None):
+    """
+    Records that file_path completed `stage`. If the stage moved or renamed the file,
+    pass new_path so the entry follows the file.
+    """
+    path = os.path.abspath(file_path)
+    target = os.path.abspath(new_path) if new_path else path
+    try:
+        stat = os.stat(target)
+        size, mtime_ns = stat.st_size, stat.st_mtime_ns
+    except OSError:
+        size = mtime_ns = None
+
+    conn = get_db()
+    if target != path:
+        conn.execute('DELETE FROM files WHERE path = ?', (path,))
+    conn.execute(
+        'INSERT OR REPLACE INTO files (path, stage, size, mtime_ns, error, updated_at) VALUES (?, ?, ?, ?, NULL, ?)',
+        (target, stage, size, mtime_ns, time.time())
+    )
+    conn.commit()
+
+def record_failure(file_path, error, new_path=None):
+    path = os.path.abspath(file_path)
+    target = os.path.abspath(new_path) if new_path else path
+    conn = get_db()
+    if target != path:
+        conn.execute('DELETE FROM files WHERE path = ?', (path,))
+    conn.execute(
+        'INSERT OR REPLACE INTO files (path, stage, error, updated_at) VALUES (?, ?, ?, ?)',
+        (target, 'failed', str(error), time.time())
+    )
+    conn.commit()
+
+def move_entry(file_path, new_path):
+    # The file was renamed without changing its content; its journal entry follows it
+    conn = get_db()
+    conn.execute('UPDATE OR REPLACE files SET path = ? WHERE path = ?', (os.path.abspath(new_path), os.path.abspath(file_path)))
+    conn.commit()
+
+def clean_temp_folder(temp_folder, suffix=None, min_age=0):
+    # Anything left in temp_folder (or, with suffix, any partial file of that kind) at startup
+    # belongs to a run that died mid-conversion. When other processes share the folders, only
+    # files untouched for min_age seconds are theirs no longer.
+    removed = 0
+    if not os.path.isdir(temp_folder):
+        return removed
+    now = time.time()
+    for entry in os.scandir(temp_folder):
+        if entry.is_file() and (suffix is None or entry.name.endswith(suffix)):
+            if min_age and now - entry.stat().st_mtime < min_age:
+                continue
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except OSError as e:
+                logging.warning(f"Could not remove orphaned temp file {entry.path}: {e}")
+    if removed:
+        logging.info(f"Removed {removed} orphaned temp files from {temp_folder}")
+    return removed
+
+def get_status():
+    conn = get_db()
+    counts = dict(conn.execute('SELECT stage, COUNT(*) FROM files GROUP BY stage').fetchall())
+    errors = conn.execute('SELECT COUNT(*) FROM files WHERE error IS NOT NULL').fetchone()[0]
+    last_update = conn.execute('SELECT MAX(updated_at) FROM files').fetchone()[0]
+    return {'stages': counts, 'errors': errors, 'last_update': last_update}
+
+def print_status():
+    status = get_status()
+    total = sum(status['stages'].values())
+    print(f"Journal entries: {total}")
+    for stage in STAGES + ['failed']:
+        print(f"  {stage:<11} {status['stages'].get(stage, 0)}")
+    print(f"  with errors {status['errors']}")
+    if status['last_update']:
+        print(f"Last update: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(status['last_update']))}")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] != 'status':
+        print("Usage: python run_journal.py [status]")
+        sys.exit(1)
+    print_status()
@@ -0,0 +1,197 @@
+import os
+import errno
+import shutil
+import uuid
+import logging
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl that makes a file share another's extents (copy-on-write: btrfs, XFS, bcachefs)
+FICLONE = 0x40049409
+COPY_CHUNK = 8 * 1024 * 1024
+
+def device_of(path):
+    # st_dev of path, or of its nearest existing parent when path is yet to be created
+    path = os.path.abspath(path)
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except FileNotFoundError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise
+            path = parent
+
+def same_filesystem(path, other):
+    return device_of(path) == device_of(other)
+
+def log_filesystem_boundaries(folders):
+    """
+    Warns about folders that sit on a different filesystem from the inbox: files moving
+    between them are copied byte by byte instead of renamed.
+    """
+    inbox = folders['audio_folder']
+    for name, folder in sorted(folders.items()):
+        if name != 'audio_folder' and not same_filesystem(inbox, folder):
+            logging.warning(f"{name} ({folder}) is on a different filesystem from the inbox; "
+                            f"files moved there are copied")
+
+def _fsync_folder(folder):
+    # Makes a rename or link in folder durable; not every platform can open a directory
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _reflink(source, target):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        return True
+    except OSError:
+        return False
+
+def _stream(source, target):
+    # Kernel-side copy where available, falling back to plain reads and writes
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while True:
+                count = os.copy_file_range(source.fileno(), target.fileno(), COPY_CHUNK)
+                if not count:
+                    return copied
+                copied += count
+        except OSError as e:
+            # Older kernels refuse some filesystem pairs before copying anything
+            if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    shutil.copyfileobj(source, target, COPY_CHUNK)
+    return target.tell()
+
+def clone(source_path, target_path):
+    """
+    Writes a copy of source_path to target_path, sharing extents with the source when the
+    filesystem can, and returns ('reflink' | 'copy', bytes copied).
+    """
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        if _reflink(source, target):
+            return 'reflink', 0
+        return 'copy', _stream(source, target)
+
+def _copy_durably(source_path, target_path):
+    # Copy that is on disk, with the source's mode and times, before it counts. Different
+    # devices can still share extents (btrfs subvolumes), so a reflink is tried first.
+    with open(source_path, 'rb') as source, open(target_path, 'xb') as target:
+        if _reflink(source, target):
+            method, copied = 'reflink', 0
+        else:
+            method, copied = 'copy', _stream(source, target)
+        target.flush()
+        os.fsync(target.fileno())
+    shutil.copystat(source_path, target_path)
+    return method, copied
+
+def _staging_path(folder, filename):
+    # Hidden, so scanners skip a copy that is still in progress
+    return os.path.join(folder, f".{filename}.{uuid.uuid4().hex[:12]}.part")
+
+def move(source_path, target_path):
+    """
+    Moves source_path to target_path, replacing it. A rename on the same filesystem; across
+    filesystems a copy staged beside the target, fsynced and renamed over it before the
+    source is removed. Returns target_path.
+    """
+    with metrics.span('move', source_path) as span:
+        try:
+            os.replace(source_path, target_path)
+            span.status, span.copied = 'rename', 0
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            staged = _staging_path(os.path.dirname(target_path), os.path.basename(target_path))
+            try:
+                span.status, span.copied = _copy_durably(source_path, staged)
+                os.replace(staged, target_path)
+            finally:
+                if os.path.exists(staged):
+                    os.remove(staged)
+            _fsync_folder(os.path.dirname(target_path))
+            os.remove(source_path)
+            logging.info(f"Moved across filesystems by {span.status} ({span.copied} bytes copied): {source_path} -> {target_path}")
+    return target_path
+
+def publish(staged_path, folder, filename):
+    """
+    Links staged_path into folder under filename, or "name (1).ext" and so on if taken, then
+    drops the staged name. Linking never replaces an existing file, so concurrent workers
+    cannot take the same name and no placeholder is ever visible. staged_path must be on
+    the same filesystem as folder. Returns the published path.
+    """
+    base, ext = os.path.splitext(filename)
+    candidate = filename
+    counter = 1
+    while True:
+        path = os.path.join(folder, candidate)
+        try:
+            try:
+                os.link(staged_path, path)
+                os.remove(staged_path)
+            except FileExistsError:
+                raise
+            except OSError as e:
+                if e.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.EMLINK, errno.ENOSYS):
+                    raise
+                # No hard links on this filesystem (FAT, some network shares): reserve the
+                # name with an exclusive create and rename over the placeholder
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                try:
+                    os.replace(staged_path, path)
+                except OSError:
+                    os.remove(path)
+                    raise
+            return path
+        except FileExistsError:
+            candidate = f"{base} ({counter}){ext}"
+            counter += 1
+
+def place(source_path, folder):
+    """
+    Moves source_path into folder under a free name and returns the new path. On the same
+    filesystem the file is hard-linked in and unlinked from its old name, copying nothing;
+    otherwise it is first copied durably into a staging file in folder.
+    """
+    os.makedirs(folder, exist_ok=True)
+    filename = os.path.basename(source_path)
+    with metrics.span('move', source_path) as span:
+        destination = None
+        if same_filesystem(source_path, folder):
+            try:
+                destination = publish(source_path, folder, filename)
+                span.status, span.copied = 'hardlink', 0
+            except OSError as e:
+                # Bind mounts of one filesystem share st_dev, yet link(2) between them fails
+                if e.errno != errno.EXDEV:
+                    raise
+        if destination is None:
+            staged = _staging_path(folder, filename)
+            try:
+                span.status, span.copied = _copy_durably(source_path, staged)
+                destination = publish(staged, folder, filename)
+            finally:
+                if os.path.exists(staged):
+                    os.remove(staged)
+            os.remove(source_path)
+            logging.info(f"Moved across filesystems by {span.status} ({span.copied} bytes copied): {source_path} -> {destination}")
+        _fsync_folder(folder)
+    return destination
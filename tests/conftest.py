@@ -0,0 +1,38 @@
+import os
+import sys
+import json
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import run_journal
+import catalog
+import library_index
+import probe_cache
+import recognition_cache
+
+@pytest.fixture
+def configure(tmp_path, monkeypatch):
+    """
+    Writes a config of its own under tmp_path, with any extra settings given, so the journal
+    and the other caches live there too. Callable again to change the settings.
+    """
+    def configure(**settings):
+        config_path = tmp_path / 'config.json'
+        config_path.write_text(json.dumps(dict({'api_key': 'test', 'cache_folder': str(tmp_path / 'cache')}, **settings)))
+        monkeypatch.setenv('SONGMEND_CONFIG', str(config_path))
+        # Database paths and settings are read once per process
+        for module in (run_journal, catalog, library_index, probe_cache, recognition_cache):
+            monkeypatch.setattr(module, '_db_path', None)
+        monkeypatch.setattr(recognition_cache, '_settings', None)
+        return config.reload_config()
+    yield configure
+    # Later tests must not see this config, which may even be one that failed validation
+    config._load_config.cache_clear()
+
+@pytest.fixture
+def workspace(tmp_path, configure):
+    configure()
+    return tmp_path
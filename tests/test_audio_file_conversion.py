@@ -0,0 +1,27 @@
+import os
+import time
+from config import get_folders
+from audio_file_conversion import clean_partial_files, PARTIAL_SUFFIX
+
+def test_startup_cleanup_removes_only_stale_partial_files(configure, tmp_path):
+    configure(**{key: str(tmp_path / key) for key in ('audio_folder', 'error_folder', 'video_folder',
+                                                      'processed_folder', 'original_folder', 'temp_folder')},
+              work_queue_lease_seconds=60)
+    folders = get_folders()
+    names = {'stale': f".stale{PARTIAL_SUFFIX}", 'fresh': f".fresh{PARTIAL_SUFFIX}", 'output': 'song.mp3'}
+    checked = ['temp_folder', 'processed_folder', 'original_folder', 'error_folder', 'video_folder']
+    for key in checked:
+        os.makedirs(folders[key])
+        for kind, name in names.items():
+            path = os.path.join(folders[key], name)
+            open(path, 'w').close()
+            if kind != 'fresh':
+                then = time.time() - 3600
+                os.utime(path, (then, then))
+
+    clean_partial_files(folders)
+
+    # temp_folder holds nothing but scratch files, so everything stale goes
+    assert sorted(os.listdir(folders['temp_folder'])) == [names['fresh']]
+    for key in checked[1:]:
+        assert sorted(os.listdir(folders[key])) == sorted([names['fresh'], names['output']]), key
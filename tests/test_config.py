@@ -0,0 +1,43 @@
+import pytest
+import config
+
+def test_counts_must_be_whole_numbers(configure):
+    assert configure(conversion_workers=3, recognition_max_attempts=2)['conversion_workers'] == 3
+    for settings in ({'conversion_workers': 2.0}, {'recognition_max_attempts': True},
+                     {'shazam_max_retries': 1.5}, {'pipeline_workers': {'convert': 2.0}}):
+        with pytest.raises(ValueError):
+            configure(**settings)
+
+def test_durations_and_rates_may_be_fractional(configure):
+    configure(shazam_backoff_seconds=0.5, shazam_requests_per_second=2.5, work_queue_lease_seconds=30.0)
+    assert config.get_shazam_settings()['requests_per_second'] == 2.5
+
+def test_flags_must_be_booleans(configure):
+    with pytest.raises(ValueError):
+        configure(work_queue_enabled=1)
+
+@pytest.mark.parametrize('rate, burst', [(0, 5), (-1, 5), (5, 0)])
+def test_shazam_rate_and_burst_must_be_positive(configure, rate, burst):
+    configure(shazam_requests_per_second=rate, shazam_burst=burst)
+    with pytest.raises(ValueError):
+        config.get_shazam_settings()
+
+def test_output_profiles_default_to_one_mp3(configure):
+    configure()
+    profiles = config.get_output_profiles()
+    assert [(profile['name'], profile['codec']) for profile in profiles] == [('main', 'mp3')]
+
+@pytest.mark.parametrize('profiles', [
+    [{'codec': 'mp3'}],
+    [{'name': 'main'}, {'name': 'main', 'codec': 'aac'}],
+    [{'name': 'main', 'codec': 'opus'}, {'name': 'mp3'}],
+])
+def test_invalid_output_profiles_are_rejected(configure, profiles):
+    configure(output_profiles=profiles)
+    with pytest.raises(ValueError):
+        config.get_output_profiles()
+
+def test_unknown_output_layout_is_rejected(configure):
+    configure(output_layout='by_genre')
+    with pytest.raises(ValueError):
+        config.get_layout_settings()
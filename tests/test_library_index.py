@@ -0,0 +1,20 @@
+import os
+import catalog
+import library_index
+
+def test_superseded_copies_leave_the_index_and_the_catalog(workspace):
+    library = workspace / 'library'
+    library.mkdir()
+    old, new = str(library / 'old.mp3'), str(library / 'new.mp3')
+    for path, content in ((old, b'old audio'), (new, b'new audio')):
+        with open(path, 'wb') as f:
+            f.write(content)
+    library_index.index_file(old, '42')
+    audio_hash = library_index.index_file(new, '42')
+    catalog.record_track(old, '42', {}, {'title': 'Intro'}, {}, None)
+
+    assert library_index.remove_superseded(new, audio_hash, '42') == [old]
+
+    assert not os.path.exists(old) and os.path.exists(new)
+    assert library_index.find_duplicate(song_id='42', exclude_path=new) is None
+    assert catalog.find_tracks(song_id='42') == []
@@ -0,0 +1,57 @@
+import os
+import shutil
+import subprocess
+import pytest
+from metadata_updater import TaggingSession
+import library_index
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg is needed to make an MP3")
+
+METADATA = {'title': 'Intro', 'artist': 'Band', 'album': 'Debut', 'album_artist': 'Band', 'composer': '',
+            'genre': 'Rock', 'year': '2010', 'track': '1', 'disc': '1'}
+
+@pytest.fixture
+def mp3(workspace):
+    (workspace / 'music').mkdir()
+    path = str(workspace / 'music/song.mp3')
+    subprocess.run(['ffmpeg', '-v', 'error', '-nostdin', '-f', 'lavfi', '-i', 'sine=frequency=440:duration=1',
+                    '-c:a', 'libmp3lame', path], check=True)
+    return path
+
+def tag(path, metadata):
+    session = TaggingSession(path)
+    changes = session.apply(metadata)
+    session.save()
+    return changes
+
+def test_tags_round_trip_with_the_year_as_tdrc(mp3):
+    tag(mp3, METADATA)
+    session = TaggingSession(mp3)
+    assert session.current_metadata() == METADATA
+    assert 'TDRC' in session.audio.tags and 'TYER' not in session.audio.tags
+    assert session.diff(METADATA) == {}
+
+def test_changes_that_fit_the_padding_are_saved_in_place(mp3):
+    # The first save grows the tag and rewrites the file, leaving padding for later edits
+    tag(mp3, METADATA)
+    inode = os.stat(mp3).st_ino
+    audio_hash = library_index.audio_payload_hash(mp3)
+
+    assert tag(mp3, dict(METADATA, year='2019', title='Outro')) == {'year': ('2010', '2019'), 'title': ('Intro', 'Outro')}
+
+    assert os.stat(mp3).st_ino == inode
+    assert library_index.audio_payload_hash(mp3) == audio_hash
+    assert TaggingSession(mp3).current_metadata()['year'] == '2019'
+
+def test_a_tag_outgrowing_its_padding_is_rewritten_atomically(mp3):
+    tag(mp3, METADATA)
+    inode = os.stat(mp3).st_ino
+    audio_hash = library_index.audio_payload_hash(mp3)
+
+    tag(mp3, dict(METADATA, composer='x' * 64 * 1024))
+
+    assert os.stat(mp3).st_ino != inode
+    assert library_index.audio_payload_hash(mp3) == audio_hash
+    assert TaggingSession(mp3).current_metadata()['composer'] == 'x' * 64 * 1024
+    # No temporary copy is left next to the file
+    assert os.listdir(os.path.dirname(mp3)) == ['song.mp3']
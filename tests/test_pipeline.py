@@ -0,0 +1,53 @@
+import threading
+from pipeline import Stage, Pipeline
+
+def run_in_thread(pipeline, jobs, timeout=10):
+    # A stage that fails to shut down would hang Pipeline.run forever
+    thread = threading.Thread(target=pipeline.run, args=(jobs,), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive()
+
+def jobs(count):
+    return [{'path': f"/inbox/{index:02}.flac"} for index in range(count)]
+
+def test_jobs_flow_through_every_stage():
+    collected = []
+    lock = threading.Lock()
+
+    def collect(job):
+        with lock:
+            collected.append(job['path'])
+
+    first = Stage('double', lambda job: dict(job, value=2), workers=3, queue_size=2)
+    last = Stage('collect', collect, workers=2, queue_size=2)
+    assert run_in_thread(Pipeline([first, last]), jobs(20))
+    assert sorted(collected) == [job['path'] for job in jobs(20)]
+    assert first.processed == last.processed == 20
+
+def test_dropped_and_failed_jobs_do_not_reach_the_next_stage():
+    failed = []
+
+    def route(job):
+        index = int(job['path'][-7:-5])
+        if index % 3 == 0:
+            raise RuntimeError("corrupt")
+        return job if index % 2 else None
+
+    first = Stage('route', route, workers=2, queue_size=4, on_error=lambda job, error: failed.append(job['path']))
+    last = Stage('count', lambda job: None, workers=1, queue_size=4)
+    assert run_in_thread(Pipeline([first, last]), jobs(12))
+    assert len(failed) == 4
+    assert last.processed == 4
+
+def test_a_failing_error_handler_does_not_stop_the_pipeline():
+    def fail(job):
+        raise RuntimeError("conversion failed")
+
+    def broken_handler(job, error):
+        raise OSError("failed folder is gone")
+
+    first = Stage('convert', fail, workers=2, queue_size=2, on_error=broken_handler)
+    last = Stage('tag', lambda job: None, workers=2, queue_size=2)
+    assert run_in_thread(Pipeline([first, last]), jobs(10))
+    assert first.processed == 10
@@ -0,0 +1,22 @@
+import time
+import recognition_cache
+
+DETECTION = {'track': {'hub': {'actions': [{'id': '42'}]}}}
+
+def age_detections(days):
+    conn = recognition_cache.get_db()
+    conn.execute('UPDATE detections SET created_at = ?', (time.time() - days * 86400,))
+    conn.commit()
+
+def test_song_id_lookup_serves_fresh_detections(configure):
+    configure(recognition_cache_ttl_days=30)
+    recognition_cache.store_detection(b'sample', DETECTION)
+    age_detections(29)
+    assert recognition_cache.get_cached_detection_by_song_id('42') == DETECTION
+
+def test_song_id_lookup_honours_the_ttl(configure):
+    configure(recognition_cache_ttl_days=30)
+    recognition_cache.store_detection(b'sample', DETECTION)
+    age_detections(31)
+    assert recognition_cache.get_cached_detection_by_song_id('42') is None
+    assert recognition_cache.get_cached_detection(b'sample') is None
@@ -0,0 +1,75 @@
+import os
+import errno
+import storage
+import audio_file_error_check
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    return str(path)
+
+def visible(folder):
+    return sorted(name for name in os.listdir(folder) if not name.startswith('.'))
+
+def test_publish_never_replaces_an_existing_file(workspace):
+    folder = workspace / 'library'
+    write(folder / 'song.mp3', 'first')
+    staged = write(folder / '.song.part', 'second')
+
+    published = storage.publish(staged, str(folder), 'song.mp3')
+
+    assert published == str(folder / 'song (1).mp3')
+    assert (folder / 'song.mp3').read_text() == 'first'
+    assert (folder / 'song (1).mp3').read_text() == 'second'
+    assert not os.path.exists(staged)
+
+def test_place_moves_under_a_free_name(workspace):
+    first = write(workspace / 'inbox/a/bad.mp3', 'a')
+    second = write(workspace / 'inbox/b/bad.mp3', 'b')
+
+    assert storage.place(first, str(workspace / 'error')) == str(workspace / 'error/bad.mp3')
+    assert storage.place(second, str(workspace / 'error')) == str(workspace / 'error/bad (1).mp3')
+    assert (workspace / 'error/bad.mp3').read_text() == 'a'
+    assert (workspace / 'error/bad (1).mp3').read_text() == 'b'
+    assert not os.path.exists(first) and not os.path.exists(second)
+
+def test_place_copies_when_a_same_device_link_crosses_mounts(workspace, monkeypatch):
+    # Bind mounts of one filesystem share st_dev, but link(2) between them fails with EXDEV
+    link = os.link
+    def bind_mount_link(source, target):
+        if os.path.dirname(source) != os.path.dirname(target):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        link(source, target)
+    monkeypatch.setattr(os, 'link', bind_mount_link)
+    source = write(workspace / 'in/song.mp3', 'audio')
+    write(workspace / 'out/song.mp3', 'other')
+
+    destination = storage.place(source, str(workspace / 'out'))
+
+    assert destination == str(workspace / 'out/song (1).mp3')
+    assert (workspace / 'out/song (1).mp3').read_text() == 'audio'
+    assert (workspace / 'out/song.mp3').read_text() == 'other'
+    assert not os.path.exists(source)
+    # No staged copy is left behind
+    assert sorted(os.listdir(workspace / 'out')) == visible(workspace / 'out')
+
+def test_place_copies_across_filesystems(workspace, monkeypatch):
+    monkeypatch.setattr(storage, 'same_filesystem', lambda path, other: False)
+    source = write(workspace / 'in/song.mp3', 'audio')
+
+    destination = storage.place(source, str(workspace / 'out'))
+
+    assert destination == str(workspace / 'out/song.mp3')
+    assert (workspace / 'out/song.mp3').read_text() == 'audio'
+    assert not os.path.exists(source)
+    assert os.listdir(workspace / 'out') == ['song.mp3']
+
+def test_rejected_files_with_the_same_name_are_all_kept(workspace):
+    first = write(workspace / 'inbox/sub1/bad.mp3', 'one')
+    second = write(workspace / 'inbox/sub2/bad.mp3', 'two')
+
+    audio_file_error_check.move_file(first, str(workspace / 'error'))
+    audio_file_error_check.move_file(second, str(workspace / 'error'))
+
+    contents = sorted((workspace / 'error' / name).read_text() for name in visible(workspace / 'error'))
+    assert contents == ['one', 'two']
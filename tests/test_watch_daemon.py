@@ -0,0 +1,45 @@
+import os
+import sys
+import pytest
+from watch_daemon import InotifyWatcher, PollingWatcher
+
+def write(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'audio')
+    return str(path)
+
+def drain(watcher):
+    paths = set()
+    while True:
+        events = watcher.read_events(timeout=0.2)
+        if not events:
+            return sorted(paths)
+        paths.update(events)
+
+def make_watcher(kind, folder):
+    if kind == 'inotify':
+        if not sys.platform.startswith('linux'):
+            pytest.skip("inotify is Linux only")
+        return InotifyWatcher(str(folder))
+    return PollingWatcher(str(folder), interval=0.01)
+
+@pytest.mark.parametrize('kind', ['inotify', 'polling'])
+def test_arrivals_in_subfolders_are_reported(workspace, kind):
+    inbox = workspace / 'inbox'
+    (inbox / 'existing').mkdir(parents=True)
+    watcher = make_watcher(kind, inbox)
+    try:
+        expected = [write(inbox / 'existing/01.flac'), write(inbox / 'new/deep/02.flac')]
+        # A folder moved in with files already in it
+        write(workspace / 'staging/album/03.flac')
+        os.rename(workspace / 'staging', inbox / 'moved')
+        expected.append(str(inbox / 'moved/album/03.flac'))
+        # The work queue's claims are not arrivals
+        write(inbox / '.claims/worker/token/04.flac')
+        assert drain(watcher) == sorted(expected)
+
+        # Folders that appeared after the watcher started are watched too
+        later = [write(inbox / 'new/deep/05.flac'), write(inbox / 'moved/album/06.flac')]
+        assert drain(watcher) == sorted(later)
+    finally:
+        watcher.close()
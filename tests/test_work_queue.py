@@ -0,0 +1,129 @@
+import os
+import time
+import multiprocessing
+from work_queue import WorkQueue, CLAIMS_FOLDER, HEARTBEAT_FILE, REAPING_PREFIX
+
+SETTINGS = {'enabled': True, 'lease_seconds': 120, 'heartbeat_seconds': 15, 'worker_id': None}
+
+def make_inbox(root, names):
+    inbox = root / 'inbox'
+    for name in names:
+        path = inbox / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Each file holds its own name so a worker can report which one it got
+        path.write_text(name)
+    return inbox
+
+def inbox_files(inbox):
+    found = []
+    for root, dirs, files in os.walk(inbox):
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
+        found += [os.path.relpath(os.path.join(root, name), inbox) for name in files]
+    return sorted(found)
+
+def drain(inbox, worker_id, report):
+    queue = WorkQueue(str(inbox), SETTINGS, worker_id=worker_id).start()
+    try:
+        processed = []
+        for claimed_path in queue.iter_claims():
+            with open(claimed_path) as f:
+                processed.append(f.read())
+            # Consumed, as a successful conversion or move would
+            os.remove(claimed_path)
+            queue.finish(claimed_path)
+    finally:
+        queue.close()
+    with open(report, 'w') as f:
+        f.write('\n'.join(processed))
+
+def test_processes_sharing_an_inbox_take_each_file_once(workspace):
+    names = [f"album{album}/disc{disc}/track{track:02}.flac" for album in range(4) for disc in range(2) for track in range(8)]
+    names += [f"loose{track:02}.wav" for track in range(16)]
+    inbox = make_inbox(workspace, names)
+
+    context = multiprocessing.get_context('fork')
+    reports = [workspace / f"worker{index}.txt" for index in range(4)]
+    workers = [context.Process(target=drain, args=(inbox, f"worker{index}", report)) for index, report in enumerate(reports)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    processed = [line for report in reports for line in report.read_text().splitlines()]
+    assert sorted(processed) == sorted(names)
+    assert inbox_files(inbox) == []
+
+def test_finish_returns_an_unconsumed_file_to_its_subfolder(workspace):
+    inbox = make_inbox(workspace, ['Artist/Album/01.flac'])
+    queue = WorkQueue(str(inbox), SETTINGS, worker_id='worker').start()
+    try:
+        claimed_path = queue.claim(str(inbox / 'Artist/Album/01.flac'))
+        assert claimed_path.startswith(queue.folder)
+        # The emptied subfolders may be tidied away while the file is claimed
+        os.rmdir(inbox / 'Artist/Album')
+        os.rmdir(inbox / 'Artist')
+        queue.finish(claimed_path)
+        assert inbox_files(inbox) == ['Artist/Album/01.flac']
+        assert os.listdir(queue.folder) == [HEARTBEAT_FILE]
+    finally:
+        queue.close()
+
+def test_claim_loses_to_a_file_already_taken(workspace):
+    inbox = make_inbox(workspace, ['a/01.flac'])
+    first = WorkQueue(str(inbox), SETTINGS, worker_id='first').start()
+    second = WorkQueue(str(inbox), SETTINGS, worker_id='second').start()
+    try:
+        assert first.claim(str(inbox / 'a/01.flac'))
+        assert second.claim(str(inbox / 'a/01.flac')) is None
+        assert os.listdir(second.folder) == [HEARTBEAT_FILE]
+    finally:
+        second.close()
+        first.close()
+    assert inbox_files(inbox) == ['a/01.flac']
+
+def test_expired_lease_is_requeued_and_live_lease_is_not(workspace):
+    inbox = make_inbox(workspace, ['dead/01.flac', 'dead/02.flac', 'alive/01.flac'])
+    dead = WorkQueue(str(inbox), SETTINGS, worker_id='dead')
+    alive = WorkQueue(str(inbox), SETTINGS, worker_id='alive')
+    for queue, names in ((dead, ['dead/01.flac', 'dead/02.flac']), (alive, ['alive/01.flac'])):
+        os.makedirs(queue.folder)
+        queue.heartbeat()
+        for name in names:
+            assert queue.claim(str(inbox / name))
+    # The dead worker stopped touching its heartbeat long ago
+    stale = time.time() - 10 * SETTINGS['lease_seconds']
+    os.utime(dead.heartbeat_path, (stale, stale))
+    assert inbox_files(inbox) == []
+
+    reaper = WorkQueue(str(inbox), SETTINGS, worker_id='reaper').start()
+    try:
+        assert inbox_files(inbox) == ['dead/01.flac', 'dead/02.flac']
+        assert sorted(os.listdir(inbox / CLAIMS_FOLDER)) == ['alive', 'reaper']
+        assert reaper.requeue_expired() == 0
+    finally:
+        reaper.close()
+        alive.close()
+    assert inbox_files(inbox) == ['alive/01.flac', 'dead/01.flac', 'dead/02.flac']
+
+def test_files_of_a_reaper_that_died_mid_requeue_are_requeued(workspace):
+    inbox = make_inbox(workspace, ['dead/01.flac', 'dead/02.flac', 'reaper/01.flac'])
+    dead = WorkQueue(str(inbox), SETTINGS, worker_id='dead')
+    crashed = WorkQueue(str(inbox), SETTINGS, worker_id='crashed')
+    for queue, names in ((dead, ['dead/01.flac', 'dead/02.flac']), (crashed, ['reaper/01.flac'])):
+        os.makedirs(queue.folder)
+        queue.heartbeat()
+        for name in names:
+            assert queue.claim(str(inbox / name))
+    # The crashed reaper took over the dead worker's folder, then died before requeueing it
+    os.rename(dead.folder, os.path.join(crashed.folder, REAPING_PREFIX + 'dead'))
+    stale = time.time() - 10 * SETTINGS['lease_seconds']
+    os.utime(crashed.heartbeat_path, (stale, stale))
+    assert inbox_files(inbox) == []
+
+    reaper = WorkQueue(str(inbox), SETTINGS, worker_id='reaper').start()
+    try:
+        assert inbox_files(inbox) == ['dead/01.flac', 'dead/02.flac', 'reaper/01.flac']
+        assert os.listdir(inbox / CLAIMS_FOLDER) == ['reaper']
+    finally:
+        reaper.close()
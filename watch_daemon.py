@@ -0,0 +1,240 @@
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import select
+import signal
+import struct
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import setup_logging, get_api_key, get_folders, get_daemon_settings
+from audio_file_conversion import convert_to_mp3, clean_partial_files
+from audio_file_error_check import check_file
+import metrics
+from file_operations import scan_files
+from work_queue import get_work_queue
+from main import process_audio_file
+
+# inotify event masks (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')
+
+class InotifyWatcher:
+    """
+    Yields paths of files under `folder`, nested folders included, that were closed after
+    writing or moved in. Folders created or moved in later are watched as they appear and
+    the files already in them reported. Hidden folders (the work queue's claims) are not
+    watched. Linux only.
+    """
+    def __init__(self, folder):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.folder = folder
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Watch descriptor -> folder it watches
+        self.watches = {}
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {folder}")
+        self.watch_tree(folder)
+
+    def watch_tree(self, folder):
+        # Watching a folder already watched (moved within the inbox) returns its descriptor
+        # again, so the mapping follows the move
+        for root, dirs, _ in os.walk(folder):
+            dirs[:] = [name for name in dirs if not name.startswith('.')]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                logging.warning(f"Cannot watch {root} (errno {ctypes.get_errno()}); "
+                                f"files arriving there are picked up at the next start")
+                continue
+            self.watches[wd] = root
+
+    def read_events(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped; rescan and report everything
+                self.watch_tree(self.folder)
+                paths += [entry.path for entry in scan_files(self.folder)]
+                continue
+            if mask & IN_IGNORED:
+                # The folder was removed or moved out of the inbox
+                self.watches.pop(wd, None)
+                continue
+            if not name or name.startswith('.') or wd not in self.watches:
+                continue
+            path = os.path.join(self.watches[wd], name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files can land in a new folder before it is watched, so list it afterwards
+                    self.watch_tree(path)
+                    paths += [entry.path for entry in scan_files(path)]
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """
+    Fallback for platforms without inotify: reports paths under folder, nested folders
+    included, that appeared since the last scan.
+    """
+    def __init__(self, folder, interval):
+        self.folder = folder
+        self.interval = interval
+        self.seen = self.scan()
+
+    def scan(self):
+        return {entry.path for entry in scan_files(self.folder)}
+
+    def read_events(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        current = self.scan()
+        new_paths = current - self.seen
+        self.seen = current
+        return sorted(new_paths)
+
+    def close(self):
+        pass
+
+def wait_until_settled(file_path, settle_seconds, stop_event):
+    # Copies over SMB/NFS can close and reopen a file several times; wait for size/mtime to hold still
+    last = None
+    while not stop_event.is_set():
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return False
+        current = (stat.st_size, stat.st_mtime_ns)
+        if current == last:
+            return True
+        last = current
+        stop_event.wait(settle_seconds)
+    return False
+
+class WatchDaemon:
+    def __init__(self, folders, api_key, settings, queue=None):
+        self.folders = folders
+        self.queue = queue
+        self.api_key = api_key
+        self.settings = settings
+        self.stop_event = threading.Event()
+        self.in_progress = set()
+        self.lock = threading.Lock()
+        # Bounds queued + running files so a flood of events cannot grow memory without limit
+        self.slots = threading.BoundedSemaphore(settings['workers'] * 2)
+        self.executor = ThreadPoolExecutor(max_workers=settings['workers'])
+
+    def submit(self, file_path):
+        with self.lock:
+            if file_path in self.in_progress:
+                return
+            self.in_progress.add(file_path)
+        self.slots.acquire()
+        self.executor.submit(self.handle_file, file_path)
+
+    def handle_file(self, file_path):
+        folders = self.folders
+        inbox_path = file_path
+        claimed_path = None
+        try:
+            if not wait_until_settled(file_path, self.settings['settle_seconds'], self.stop_event):
+                return
+            if self.queue:
+                # Several daemons may watch the same shared inbox; only the claimant proceeds
+                claimed_path = file_path = self.queue.claim(file_path)
+                if claimed_path is None:
+                    return
+            if not check_file(file_path, folders['error_folder'], folders['video_folder'], use_journal=True):
+                return
+            output_path = convert_to_mp3(
+                file_path,
+                folders['processed_folder'],
+                folders['error_folder'],
+                folders['original_folder']
+            )
+            if output_path:
+                process_audio_file(output_path, self.api_key, folders['success_folder'], folders['failed_folder'])
+        except Exception as e:
+            logging.error(f"Watch daemon failed on {file_path}: {e}")
+        finally:
+            if claimed_path:
+                self.queue.finish(claimed_path)
+            with self.lock:
+                self.in_progress.discard(inbox_path)
+            self.slots.release()
+
+    def run(self):
+        audio_folder = self.folders['audio_folder']
+        os.makedirs(audio_folder, exist_ok=True)
+        try:
+            watcher = InotifyWatcher(audio_folder)
+            logging.info(f"Watching {audio_folder} with inotify")
+        except (OSError, AttributeError) as e:
+            logging.warning(f"inotify unavailable ({e}), polling {audio_folder} every {self.settings['poll_interval']}s")
+            watcher = PollingWatcher(audio_folder, self.settings['poll_interval'])
+
+        # Pick up whatever landed while the daemon was down, nested folders included
+        for entry in scan_files(audio_folder):
+            if self.stop_event.is_set():
+                break
+            self.submit(entry.path)
+
+        try:
+            while not self.stop_event.is_set():
+                for file_path in watcher.read_events(timeout=1.0):
+                    if os.path.isfile(file_path):
+                        self.submit(file_path)
+        finally:
+            watcher.close()
+            logging.info("Watch daemon stopping, waiting for in-flight files")
+            self.executor.shutdown(wait=True)
+            if self.queue:
+                self.queue.close()
+            logging.info("Watch daemon stopped")
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+def main():
+    setup_logging()
+    metrics.setup_metrics()
+    folders = get_folders()
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+    clean_partial_files(folders)
+
+    daemon = WatchDaemon(folders, get_api_key(), get_daemon_settings(), get_work_queue(folders['audio_folder']))
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    print(f"Watching {folders['audio_folder']} (Ctrl+C to stop)")
+    daemon.run()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+import os
+import sys
+import time
+import uuid
+import socket
+import logging
+import threading
+from config import get_folders, get_work_queue_settings
+from file_operations import scan_files
+import run_journal
+
+CLAIMS_FOLDER = '.claims'
+HEARTBEAT_FILE = '.heartbeat'
+REAPING_PREFIX = '.reaping-'
+
+class WorkQueue:
+    """
+    Lets any number of processes, on one host or many sharing the inbox over NFS, drain the
+    same folder without processing a file twice.
+
+    A file is claimed by renaming it into .claims/<worker>/<token>/<path relative to the
+    inbox>; rename is atomic, so exactly one worker wins, and a file handed back returns to
+    the subfolder it came from. Each worker touches .claims/<worker>/.heartbeat
+    while it runs. A worker whose heartbeat is older than the lease is considered dead, and
+    the first live worker to notice moves its claimed files back into the inbox, after first
+    moving the dead worker's folder under its own so that a reaper dying midway is reaped
+    in turn.
+    """
+    def __init__(self, inbox, settings, worker_id=None):
+        self.inbox = os.path.abspath(inbox)
+        self.settings = settings
+        self.worker_id = worker_id or settings['worker_id'] or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.claims_root = os.path.join(self.inbox, CLAIMS_FOLDER)
+        self.folder = os.path.join(self.claims_root, self.worker_id)
+        self.heartbeat_path = os.path.join(self.folder, HEARTBEAT_FILE)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        os.makedirs(self.folder, exist_ok=True)
+        self.heartbeat()
+        self.requeue_expired()
+        self.thread = threading.Thread(target=self._run, name='work-queue-heartbeat', daemon=True)
+        self.thread.start()
+        logging.info(f"Work queue {self.worker_id} claiming from {self.inbox}")
+        return self
+
+    def _run(self):
+        while not self.stop_event.wait(self.settings['heartbeat_seconds']):
+            try:
+                self.heartbeat()
+                self.requeue_expired()
+            except OSError as e:
+                logging.warning(f"Work queue heartbeat failed: {e}")
+
+    def heartbeat(self):
+        with open(self.heartbeat_path, 'a'):
+            pass
+        os.utime(self.heartbeat_path)
+
+    def claim(self, file_path):
+        """
+        Moves file_path into this worker's claim folder. Returns the claimed path, or None if
+        another worker got it first.
+        """
+        token_folder = os.path.join(self.folder, uuid.uuid4().hex)
+        claimed_path = os.path.join(token_folder, self._relative_path(file_path))
+        os.makedirs(os.path.dirname(claimed_path))
+        try:
+            os.rename(file_path, claimed_path)
+        except FileNotFoundError:
+            self._remove_empty(token_folder)
+            return None
+        run_journal.move_entry(file_path, claimed_path)
+        return claimed_path
+
+    def _relative_path(self, file_path):
+        # Files from outside the inbox keep only their name
+        path = os.path.abspath(file_path)
+        if path.startswith(self.inbox + os.sep):
+            return path[len(self.inbox) + 1:]
+        return os.path.basename(path)
+
+    @staticmethod
+    def _split_claim(claimed_path, worker_folder):
+        # <worker folder>/<token>/<path relative to the inbox> -> (token folder, relative path)
+        parts = os.path.relpath(claimed_path, worker_folder).split(os.sep, 1)
+        if len(parts) == 1:
+            return worker_folder, parts[0]
+        return os.path.join(worker_folder, parts[0]), parts[1]
+
+    @staticmethod
+    def _remove_empty(folder):
+        # Removes folder and the subfolders a nested claim created, unless they still hold files
+        for root, dirs, files in os.walk(folder, topdown=False):
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+
+    def iter_claims(self, folder=None):
+        # Claims files lazily as the caller asks for them, so busy workers leave the rest to others
+        for entry in scan_files(folder or self.inbox):
+            if self.stop_event.is_set():
+                break
+            claimed_path = self.claim(entry.path)
+            if claimed_path:
+                yield claimed_path
+
+    def finish(self, claimed_path):
+        """
+        Ends the claim. A file still in the claim folder was not consumed by processing and
+        goes back to the inbox.
+        """
+        token_folder, relative_path = self._split_claim(claimed_path, self.folder)
+        if os.path.exists(claimed_path):
+            self._return_to_inbox(claimed_path, relative_path)
+        self._remove_empty(token_folder)
+
+    def _return_to_inbox(self, claimed_path, relative_path):
+        target = os.path.join(self.inbox, relative_path)
+        # The subfolder may have been emptied and removed while the file was claimed
+        folder = os.path.dirname(target)
+        os.makedirs(folder, exist_ok=True)
+        if os.path.exists(target):
+            # Another file with this name arrived meanwhile; keep both
+            base, ext = os.path.splitext(os.path.basename(target))
+            target = os.path.join(folder, f"{base}.{uuid.uuid4().hex[:6]}{ext}")
+        os.rename(claimed_path, target)
+        run_journal.move_entry(claimed_path, target)
+        return target
+
+    def requeue_expired(self):
+        """
+        Returns the files of workers whose heartbeat is older than the lease to the inbox.
+        Ages are measured against our own fresh heartbeat, so on NFS both timestamps come
+        from the server's clock.
+        """
+        now = os.stat(self.heartbeat_path).st_mtime
+        requeued = 0
+        with os.scandir(self.claims_root) as entries:
+            workers = [entry for entry in entries if entry.is_dir() and entry.name != self.worker_id
+                       and not entry.name.startswith('.')]
+        for entry in workers:
+            try:
+                last_seen = os.stat(os.path.join(entry.path, HEARTBEAT_FILE)).st_mtime
+            except FileNotFoundError:
+                # A worker that died before its first heartbeat: judge by the folder itself
+                try:
+                    last_seen = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+            if now - last_seen < self.settings['lease_seconds']:
+                continue
+            # Renaming the dead worker's folder first makes exactly one reaper responsible for it.
+            # It goes under our own folder, so our lease covers it: if we die mid-requeue,
+            # whoever reaps us requeues what is left of it too.
+            reaping = os.path.join(self.folder, f"{REAPING_PREFIX}{entry.name}")
+            try:
+                os.rename(entry.path, reaping)
+            except OSError:
+                continue
+            requeued += self._requeue_folder(reaping)
+            logging.warning(f"Work queue lease of {entry.name} expired; requeued its claimed files")
+        return requeued
+
+    def _requeue_folder(self, folder):
+        requeued = 0
+        # Folders this worker was reaping when it died (or closed); scan_files skips them
+        with os.scandir(folder) as entries:
+            reaping = [entry.path for entry in entries if entry.is_dir() and entry.name.startswith(REAPING_PREFIX)]
+        for path in reaping:
+            requeued += self._requeue_folder(path)
+        for entry in scan_files(folder):
+            self._return_to_inbox(entry.path, self._split_claim(entry.path, folder)[1])
+            requeued += 1
+        for root, dirs, files in os.walk(folder, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                os.rmdir(os.path.join(root, name))
+        os.rmdir(folder)
+        return requeued
+
+    def close(self):
+        # Anything still claimed was not finished; hand it back instead of waiting for the lease
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        if os.path.isdir(self.folder):
+            self._requeue_folder(self.folder)
+        logging.info(f"Work queue {self.worker_id} closed")
+
+def get_work_queue(inbox):
+    # A started WorkQueue for inbox if claiming is enabled in config.json, else None
+    settings = get_work_queue_settings()
+    if not settings['enabled']:
+        return None
+    return WorkQueue(inbox, settings).start()
+
+def print_status(inbox):
+    claims_root = os.path.join(inbox, CLAIMS_FOLDER)
+    if not os.path.isdir(claims_root):
+        print("No workers have claimed files from this inbox")
+        return
+    now = time.time()
+    for entry in sorted(os.scandir(claims_root), key=lambda entry: entry.name):
+        if not entry.is_dir() or entry.name.startswith('.'):
+            continue
+        try:
+            age = now - os.stat(os.path.join(entry.path, HEARTBEAT_FILE)).st_mtime
+        except FileNotFoundError:
+            age = None
+        claimed = sum(1 for _ in scan_files(entry.path))
+        seen = f"{age:.0f}s ago" if age is not None else "never"
+        print(f"{entry.name:<40} {claimed:>6} claimed  heartbeat {seen}")
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ('status', 'requeue'):
+        print("Usage: python work_queue.py status|requeue")
+        return 1
+    inbox = get_folders()['audio_folder']
+    if sys.argv[1] == 'status':
+        print_status(inbox)
+    else:
+        queue = WorkQueue(inbox, get_work_queue_settings(), worker_id='requeue')
+        os.makedirs(queue.folder, exist_ok=True)
+        queue.heartbeat()
+        print(f"Requeued {queue.requeue_expired()} files from expired leases")
+        queue.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())